@@ -0,0 +1,134 @@
+"""Byte-bounded LRU caches of per-image NumPy arrays.
+
+Used for decoded images and for the backend's encoded state
+("embeddings"), so each is computed once per image and reused by later
+requests. Entries are kept in LRU order under a byte budget; when a spill
+directory is configured, evicted entries are written with ``np.save`` and
+read back as memory maps instead of being recomputed. With ``mmap=True``
+every entry is written there as soon as it is cached and only the read-only
+memory map is kept, so cached arrays cost no heap.
+"""
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+import numpy as np
+
+
+class ArrayCache:
+    """LRU cache of NumPy arrays bounded by total bytes"""
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, spill_dir: Optional[Path] = None, mmap: bool = False):
+        if mmap and not spill_dir:
+            raise ValueError("mmap=True needs a spill_dir to hold the mapped files")
+        self.max_bytes = max_bytes
+        self.spill_dir = Path(spill_dir) if spill_dir else None
+        self.mmap = mmap
+        if self.spill_dir:
+            self.spill_dir.mkdir(parents=True, exist_ok=True)
+        self._entries: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.spill_hits = 0
+        self.evictions = 0
+        self.spills = 0
+
+    def _spill_path(self, key: str) -> Path:
+        return self.spill_dir / f"{key}.npy"
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """Return the cached array, reloading spilled entries from disk"""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+
+            if self.spill_dir and self._spill_path(key).exists():
+                value = np.load(self._spill_path(key), mmap_mode="r")
+                self.hits += 1
+                self.spill_hits += 1
+                return value
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, value: np.ndarray) -> None:
+        """Cache an array, evicting least recently used entries over budget"""
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= _heap_bytes(old)
+
+            if self.mmap and value.size:
+                # Mapped entries are kept for reuse but never count against the budget
+                self._spill(key, value, replace=True)
+                self._entries[key] = np.load(self._spill_path(key), mmap_mode="r")
+                return
+
+            if value.nbytes > self.max_bytes:
+                # Too large to hold in memory at all
+                self._spill(key, value)
+                return
+
+            self._entries[key] = value
+            self._bytes += value.nbytes
+            while self._bytes > self.max_bytes:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+                self.evictions += 1
+                self._spill(evicted_key, evicted)
+
+    def _spill(self, key: str, value: np.ndarray, replace: bool = False) -> None:
+        if self.spill_dir is None:
+            return
+        path = self._spill_path(key)
+        if replace or not path.exists():
+            # Write beside it and rename, so readers in other processes never see a partial file
+            temporary = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+            with open(temporary, "wb") as f:
+                np.save(f, np.asarray(value))
+            os.replace(temporary, path)
+            self.spills += 1
+
+    def get_or_compute(self, key: str, compute: Callable[[], np.ndarray]) -> np.ndarray:
+        """Return the cached array or compute, cache and return it"""
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def discard(self, key: str) -> None:
+        """Drop an entry from memory and disk"""
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                self._bytes -= _heap_bytes(value)
+            if self.spill_dir:
+                self._spill_path(key).unlink(missing_ok=True)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._entries or bool(self.spill_dir and self._spill_path(str(key)).exists())
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "mmap": self.mmap,
+            "hits": self.hits,
+            "misses": self.misses,
+            "spill_hits": self.spill_hits,
+            "evictions": self.evictions,
+            "spills": self.spills,
+        }
+
+
+def _heap_bytes(value: np.ndarray) -> int:
+    return 0 if isinstance(value, np.memmap) else value.nbytes
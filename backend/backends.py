@@ -0,0 +1,416 @@
+"""Segmentation backends.
+
+Every backend implements :class:`SegmentationBackend`: ``generate_all`` for
+automatic mask generation (``generate_batch`` for several images at once),
+``encode`` to compute the per-image state that prompts reuse, and
+``predict`` for point prompts against that state, and ``propagate`` to
+carry a mask through the following frames of a video. Images are RGB ``uint8``
+arrays of shape ``(height, width, 3)`` and masks are returned as full-frame
+boolean arrays. The backend is chosen once at startup with
+:func:`create_backend`.
+"""
+import logging
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Protocol, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+try:
+    import cv2
+    CV2_AVAILABLE = True
+except ImportError:
+    cv2 = None
+    CV2_AVAILABLE = False
+
+# (embedding, points, labels) or (embedding, points, labels, mask_input)
+PromptRequest = Tuple[Any, ...]
+
+# Longest side of the low-resolution logits returned by predict, as in SAM
+LOW_RES_SIZE = 256
+
+# Longest side of the frames optical flow is estimated on
+FLOW_MAX_SIDE = 512
+
+
+class SegmentationBackend(Protocol):
+    name: str
+
+    def generate_all(self, image: np.ndarray) -> List[Dict[str, Any]]:
+        """Generate every mask for an image"""
+        ...
+
+    def iter_masks(self, image: np.ndarray) -> Iterator[Dict[str, Any]]:
+        """Yield masks one at a time as they are produced"""
+        ...
+
+    def generate_batch(self, images: List[np.ndarray]) -> List[List[Dict[str, Any]]]:
+        """Generate every mask for several images in one call"""
+        ...
+
+    def encode(self, image: np.ndarray) -> np.ndarray:
+        """Compute the encoded image state reused by every prompt"""
+        ...
+
+    def predict(self, embedding: np.ndarray, points: List[List[int]], labels: List[int],
+                mask_input: Optional[np.ndarray] = None) -> Dict[str, Any]:
+        """Predict one mask from foreground (1) and background (0) points.
+
+        ``mask_input`` is the ``low_res_logits`` of the previous prediction in
+        a refinement session; backends with a mask prompt (such as SAM2) use
+        it to refine instead of starting over.
+        """
+        ...
+
+    def predict_batch(self, requests: List[PromptRequest]) -> List[Dict[str, Any]]:
+        """Predict masks for several prompt requests in one call"""
+        ...
+
+    def propagate(self, frames: Iterable[np.ndarray], mask: np.ndarray) -> Iterator[np.ndarray]:
+        """Carry ``mask``, drawn on the first of ``frames``, through the rest; yields one mask per later frame.
+
+        Frames are consumed lazily, so video models (such as SAM2's memory
+        attention) can keep their per-video state inside the generator.
+        """
+        ...
+
+
+class BaseBackend:
+    """Shared behaviour for backends without native batching or streaming.
+
+    Subclasses override at least one of ``generate_all`` and ``iter_masks``.
+    """
+
+    name = "base"
+
+    def generate_all(self, image: np.ndarray) -> List[Dict[str, Any]]:
+        return list(self.iter_masks(image))
+
+    def iter_masks(self, image: np.ndarray) -> Iterator[Dict[str, Any]]:
+        yield from self.generate_all(image)
+
+    def generate_batch(self, images: List[np.ndarray]) -> List[List[Dict[str, Any]]]:
+        return [self.generate_all(image) for image in images]
+
+    def predict_batch(self, requests: List[PromptRequest]) -> List[Dict[str, Any]]:
+        return [self.predict(*request) for request in requests]
+
+    def propagate(self, frames: Iterable[np.ndarray], mask: np.ndarray) -> Iterator[np.ndarray]:
+        """Without a video model, masks follow the optical flow between consecutive frames"""
+        frames = iter(frames)
+        previous = next(frames, None)
+        if previous is None:
+            return
+        previous = grayscale(previous)
+        for frame in frames:
+            current = grayscale(frame)
+            mask = flow_mask(mask, previous, current)
+            previous = current
+            yield mask
+
+
+def low_res_logits(mask: np.ndarray, size: int = LOW_RES_SIZE) -> np.ndarray:
+    """Strided float32 logits (+10 inside, -10 outside) with the longest side at most ``size``"""
+    step = max(1, -(-max(mask.shape) // size))
+    return np.where(mask[::step, ::step], 10.0, -10.0).astype(np.float32)
+
+
+def disk_mask(width: int, height: int, center_x: int, center_y: int, radius: int) -> np.ndarray:
+    """Rasterize a filled disk, evaluating only the pixels inside its bounding box"""
+    mask = np.zeros((height, width), dtype=bool)
+    y0, y1 = max(0, center_y - radius), min(height, center_y + radius)
+    x0, x1 = max(0, center_x - radius), min(width, center_x + radius)
+    if y0 < y1 and x0 < x1:
+        yy, xx = np.ogrid[y0:y1, x0:x1]
+        mask[y0:y1, x0:x1] = (xx - center_x) ** 2 + (yy - center_y) ** 2 <= radius ** 2
+    return mask
+
+
+def box_mask(width: int, height: int, center_x: int, center_y: int, half_size: int) -> np.ndarray:
+    """Rasterize a filled square clipped to the image"""
+    mask = np.zeros((height, width), dtype=bool)
+    mask[max(0, center_y - half_size):max(0, min(height, center_y + half_size)),
+         max(0, center_x - half_size):max(0, min(width, center_x + half_size))] = True
+    return mask
+
+
+def grayscale(image: np.ndarray) -> np.ndarray:
+    """Luma of an RGB uint8 image as uint8"""
+    if CV2_AVAILABLE:
+        return cv2.cvtColor(np.ascontiguousarray(image), cv2.COLOR_RGB2GRAY)
+    return (image @ np.array([0.299, 0.587, 0.114], dtype=np.float32)).astype(np.uint8)
+
+
+def estimate_shift(previous: np.ndarray, current: np.ndarray) -> Tuple[int, int]:
+    """Global ``(dx, dy)`` translation of ``current`` relative to ``previous`` by phase correlation"""
+    height, width = previous.shape
+    window = np.outer(np.hanning(height), np.hanning(width)).astype(np.float32)
+    cross = np.fft.rfft2(current * window) * np.conj(np.fft.rfft2(previous * window))
+    cross /= np.abs(cross) + 1e-9
+    correlation = np.fft.irfft2(cross, s=(height, width))
+    dy, dx = np.unravel_index(int(np.argmax(correlation)), correlation.shape)
+    # Peaks past the middle are negative shifts wrapped around
+    return (int(dx) - width if dx > width // 2 else int(dx)), (int(dy) - height if dy > height // 2 else int(dy))
+
+
+def shift_mask(mask: np.ndarray, dx: int, dy: int) -> np.ndarray:
+    """Translate a mask by whole pixels, leaving uncovered pixels False"""
+    height, width = mask.shape
+    shifted = np.zeros_like(mask)
+    if abs(dx) < width and abs(dy) < height:
+        shifted[max(0, dy):height + min(0, dy), max(0, dx):width + min(0, dx)] = \
+            mask[max(0, -dy):height + min(0, -dy), max(0, -dx):width + min(0, -dx)]
+    return shifted
+
+
+def flow_mask(mask: np.ndarray, previous: np.ndarray, current: np.ndarray) -> np.ndarray:
+    """Move a mask from the grayscale frame ``previous`` onto ``current``.
+
+    With OpenCV, every pixel of ``current`` looks up the mask where dense
+    Farneback flow says it came from, so parts of the scene moving
+    differently (parallax in a walkthrough) are followed separately. The
+    NumPy fallback shifts the whole mask by the global translation found by
+    phase correlation.
+    """
+    if not CV2_AVAILABLE:
+        return shift_mask(mask, *estimate_shift(previous, current))
+    height, width = mask.shape
+    # Flow is smooth, so it is estimated at a reduced size and scaled back up
+    scale = min(1.0, FLOW_MAX_SIDE / max(height, width))
+    if scale < 1:
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        previous = cv2.resize(previous, size, interpolation=cv2.INTER_AREA)
+        current = cv2.resize(current, size, interpolation=cv2.INTER_AREA)
+    # Flow from the current frame back to the previous one, for backward warping
+    flow = cv2.calcOpticalFlowFarneback(current, previous, None, 0.5, 3, 15, 3, 5, 1.2, 0)
+    if scale < 1:
+        flow = cv2.resize(flow, (width, height), interpolation=cv2.INTER_LINEAR) / scale
+    map_x = flow[..., 0] + np.arange(width, dtype=np.float32)
+    map_y = flow[..., 1] + np.arange(height, dtype=np.float32)[:, None]
+    warped = cv2.remap(mask.view(np.uint8), map_x, map_y, cv2.INTER_NEAREST,
+                       borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    return warped.view(bool)
+
+
+class MockBackend(BaseBackend):
+    """Geometric masks for testing without a model"""
+
+    name = "mock"
+
+    def iter_masks(self, image: np.ndarray) -> Iterator[Dict[str, Any]]:
+        height, width = image.shape[:2]
+
+        # Create one disk per quadrant
+        mask_size = min(width, height) // 8
+        quadrants = [
+            (width // 4, height // 4),
+            (3 * width // 4, height // 4),
+            (width // 4, 3 * height // 4),
+            (3 * width // 4, 3 * height // 4)
+        ]
+
+        for i, (center_x, center_y) in enumerate(quadrants):
+            yield {
+                "id": str(i),
+                "segmentation": disk_mask(width, height, center_x, center_y, mask_size),
+                "predicted_iou": 0.9,
+                "point_coords": [[center_x, center_y]],
+                "stability_score": 0.95
+            }
+
+    def encode(self, image: np.ndarray) -> np.ndarray:
+        # No encoder; an empty array keeps the frame shape for predict
+        return np.empty(image.shape[:2] + (0,), dtype=np.uint8)
+
+    def predict(self, embedding: np.ndarray, points: List[List[int]], labels: List[int],
+                mask_input: Optional[np.ndarray] = None) -> Dict[str, Any]:
+        height, width = embedding.shape[:2]
+
+        # Create a circular mask around the first point
+        if points:
+            center_x, center_y = points[0]
+            mask = disk_mask(width, height, center_x, center_y, min(width, height) // 16)
+        else:
+            mask = np.zeros((height, width), dtype=bool)
+
+        return {"segmentation": mask, "score": 0.9, "low_res_logits": low_res_logits(mask)}
+
+
+def connected_components(mask: np.ndarray) -> Tuple[int, np.ndarray]:
+    """Label 4-connected components of a boolean mask.
+
+    Returns ``(count, labels)`` where ``labels`` is an int32 image with 0 for
+    background and 1..count for components. Uses OpenCV when available and a
+    run-length union-find otherwise.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    if CV2_AVAILABLE:
+        count, labels = cv2.connectedComponents(mask.view(np.uint8), connectivity=4, ltype=cv2.CV_32S)
+        return count - 1, labels
+
+    height, width = mask.shape
+    labels = np.zeros((height, width), dtype=np.int32)
+    padded = np.zeros((height, width + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    edges = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+    if rows.size == 0:
+        return 0, labels
+
+    # Runs overlapping a run in the previous row form a contiguous index range
+    stride = width + 1
+    start_keys = rows * stride + starts
+    end_keys = rows * stride + ends
+    prev_row_base = (rows - 1) * stride
+    lo = np.searchsorted(end_keys, prev_row_base + starts, side="right")
+    hi = np.searchsorted(start_keys, prev_row_base + ends, side="left")
+    counts = np.maximum(hi - lo, 0)
+    run_a = np.repeat(np.arange(rows.size), counts)
+    run_b = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+    # Min-label propagation with pointer jumping
+    parent = np.arange(rows.size)
+    while True:
+        low = np.minimum(parent[run_a], parent[run_b])
+        updated = parent.copy()
+        np.minimum.at(updated, run_a, low)
+        np.minimum.at(updated, run_b, low)
+        updated = updated[updated]
+        if np.array_equal(updated, parent):
+            break
+        parent = updated
+
+    _, run_labels = np.unique(parent, return_inverse=True)
+    lengths = ends - starts
+    flat_starts = rows * width + starts
+    offsets = np.repeat(flat_starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    labels.ravel()[offsets] = np.repeat(run_labels.astype(np.int32) + 1, lengths)
+    return int(run_labels.max()) + 1, labels
+
+
+class LocalCPUBackend(BaseBackend):
+    """CPU segmenter based on colour quantization and connected components.
+
+    Pixels are clustered into ``clusters`` colours with a few rounds of
+    k-means on a pixel sample, and each connected region of a colour becomes
+    a mask. Point prompts select the regions under the foreground points and
+    remove those under background points.
+    """
+
+    name = "cpu"
+
+    def __init__(self, clusters: int = 8, min_area_ratio: float = 0.005, max_masks: int = 32,
+                 iterations: int = 8, sample_size: int = 16384):
+        self.clusters = clusters
+        self.min_area_ratio = min_area_ratio
+        self.max_masks = max_masks
+        self.iterations = iterations
+        self.sample_size = sample_size
+
+    def quantize(self, image: np.ndarray) -> np.ndarray:
+        """Return a uint8 cluster label for every pixel"""
+        pixels = image.reshape(-1, image.shape[-1]).astype(np.float32)
+        rng = np.random.default_rng(0)
+        sample = pixels[rng.choice(len(pixels), size=min(self.sample_size, len(pixels)), replace=False)]
+
+        # Seed centres at luminance quantiles so results are deterministic
+        order = np.argsort(sample.sum(axis=1))
+        centers = sample[order[np.linspace(0, len(order) - 1, self.clusters).astype(int)]]
+        for _ in range(self.iterations):
+            assignment = self._nearest(sample, centers)
+            for k in range(self.clusters):
+                members = sample[assignment == k]
+                if len(members):
+                    centers[k] = members.mean(axis=0)
+
+        labels = np.empty(len(pixels), dtype=np.uint8)
+        chunk = 1 << 20
+        for start in range(0, len(pixels), chunk):
+            labels[start:start + chunk] = self._nearest(pixels[start:start + chunk], centers)
+        return labels.reshape(image.shape[:2])
+
+    @staticmethod
+    def _nearest(pixels: np.ndarray, centers: np.ndarray) -> np.ndarray:
+        distances = (pixels ** 2).sum(axis=1)[:, None] - 2 * pixels @ centers.T + (centers ** 2).sum(axis=1)
+        return distances.argmin(axis=1)
+
+    def iter_masks(self, image: np.ndarray) -> Iterator[Dict[str, Any]]:
+        height, width = image.shape[:2]
+        cluster_map = self.quantize(image)
+        min_area = max(1, int(self.min_area_ratio * height * width))
+
+        # Rank regions by area first; masks are materialized one at a time
+        regions = []
+        for cluster in range(self.clusters):
+            count, components = connected_components(cluster_map == cluster)
+            if count == 0:
+                continue
+            areas = np.bincount(components.ravel(), minlength=count + 1)
+            for component in np.flatnonzero(areas[1:] >= min_area) + 1:
+                regions.append((int(areas[component]), components, int(component)))
+
+        regions.sort(key=lambda region: region[0], reverse=True)
+        for i, (area, components, component) in enumerate(regions[:self.max_masks]):
+            mask = components == component
+            ys, xs = np.nonzero(mask)
+            middle = len(ys) // 2
+            yield {
+                "id": str(i),
+                "segmentation": mask,
+                "predicted_iou": round(min(1.0, 0.5 + area / (height * width)), 4),
+                "point_coords": [[int(xs[middle]), int(ys[middle])]],
+                "stability_score": 0.8
+            }
+
+    def encode(self, image: np.ndarray) -> np.ndarray:
+        """Label every connected single-colour region, so prompts are one comparison per point"""
+        cluster_map = self.quantize(image)
+        regions = np.zeros(cluster_map.shape, dtype=np.int32)
+        offset = 0
+        for cluster in range(self.clusters):
+            count, components = connected_components(cluster_map == cluster)
+            if count:
+                regions += np.where(components > 0, components + offset, 0).astype(np.int32)
+                offset += count
+        return regions
+
+    def predict(self, regions: np.ndarray, points: List[List[int]], labels: List[int],
+                mask_input: Optional[np.ndarray] = None) -> Dict[str, Any]:
+        """Union the regions under foreground points, minus those under background points.
+
+        Regions are exact, so ``mask_input`` adds nothing and is ignored.
+        """
+        height, width = regions.shape
+        prompts = [((x, y), label) for (x, y), label in zip(points, labels) if 0 <= x < width and 0 <= y < height]
+        foreground = [int(regions[y, x]) for (x, y), label in prompts if label]
+        background = [int(regions[y, x]) for (x, y), label in prompts if not label]
+
+        # Background points carve out regions selected by foreground points
+        selected = sorted(set(foreground) - set(background))
+        if not selected:
+            mask = np.zeros((height, width), dtype=bool)
+        elif len(selected) == 1:
+            mask = regions == selected[0]
+        else:
+            mask = np.isin(regions, selected)
+
+        return {"segmentation": mask, "score": 0.8 if mask.any() else 0.0, "low_res_logits": low_res_logits(mask)}
+
+
+BACKENDS = {
+    "mock": MockBackend,
+    "cpu": LocalCPUBackend,
+}
+
+
+def create_backend(name: Optional[str] = None) -> SegmentationBackend:
+    """Create the backend registered under ``name`` (defaults to mock)"""
+    name = (name or "mock").lower()
+    if name == "modal":
+        # The Modal SAM2 deployment is not wired up yet; keep the previous mock behaviour
+        logger.warning("Modal SAM2 backend not implemented, using mock mask generation")
+        name = "mock"
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown segmentation backend '{name}', expected one of: {', '.join(BACKENDS)}")
+    return BACKENDS[name]()
@@ -0,0 +1,75 @@
+"""Helpers for the batch endpoint: zip input listing and streamed zip output."""
+import io
+import shutil
+import zipfile
+from pathlib import Path
+from typing import List
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff")
+
+
+def list_archive_images(archive_path: Path, max_images: int, max_size: int) -> List[str]:
+    """Names of the image members of a zip, validated against count and size limits"""
+    with zipfile.ZipFile(archive_path) as archive:
+        members = [
+            info for info in archive.infolist()
+            if not info.is_dir()
+            and not Path(info.filename).name.startswith(".")
+            and Path(info.filename).suffix.lower() in IMAGE_EXTENSIONS
+        ]
+    if len(members) > max_images:
+        raise ValueError(f"Archive holds {len(members)} images, more than the limit of {max_images}")
+    for info in members:
+        if info.file_size > max_size:
+            raise ValueError(f"{info.filename} exceeds the {max_size} byte limit")
+    return [info.filename for info in members]
+
+
+def extract_archive_member(archive_path: Path, name: str, destination: Path) -> None:
+    """Copy one zip member to ``destination`` without loading it all into memory"""
+    with zipfile.ZipFile(archive_path) as archive, archive.open(name) as source, open(destination, "wb") as target:
+        shutil.copyfileobj(source, target)
+
+
+class _ChunkSink(io.RawIOBase):
+    """Non-seekable file object that collects written bytes until drained"""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        data, self._chunks = b"".join(self._chunks), []
+        return data
+
+
+class ZipStream:
+    """Build a zip incrementally, handing back its bytes as each entry is added.
+
+    Entries are stored uncompressed since rendered images are already
+    compressed. Usage: ``yield stream.add(name, data)`` per entry, then
+    ``yield stream.close()``.
+    """
+
+    def __init__(self):
+        self._sink = _ChunkSink()
+        self._zip = zipfile.ZipFile(self._sink, mode="w", compression=zipfile.ZIP_STORED)
+
+    def add(self, name: str, data: bytes) -> bytes:
+        self._zip.writestr(name, data)
+        return self._sink.drain()
+
+    def close(self) -> bytes:
+        self._zip.close()
+        return self._sink.drain()
@@ -0,0 +1,86 @@
+"""Micro-batching of concurrent requests into single backend calls."""
+import asyncio
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+
+
+class MicroBatcher:
+    """Group concurrently submitted items into batches for one handler call.
+
+    A batch is dispatched when it reaches ``max_batch_size`` items or when
+    ``max_wait_ms`` has passed since its first item arrived. ``handler``
+    receives the list of items and must return one result per item, in order.
+    When ``runner`` is given, the handler is awaited through it (for example to
+    run on a worker pool) instead of being called on the event loop.
+    """
+
+    def __init__(self, handler: Callable[[List[Any]], List[Any]], max_batch_size: int = 8,
+                 max_wait_ms: float = 5.0,
+                 runner: Optional[Callable[..., Awaitable[List[Any]]]] = None):
+        self.handler = handler
+        self.runner = runner
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self.batches_dispatched = 0
+        self.items_dispatched = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    async def submit(self, item: Any) -> Any:
+        """Queue an item and wait for its result"""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._worker = None
+
+        future = loop.create_future()
+        self._queue.put_nowait((item, future))
+        if self._worker is None or self._worker.done():
+            # The worker exits once the queue drains, so idle batchers hold no tasks
+            self._worker = loop.create_task(self._run())
+        return await future
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while not self._queue.empty():
+            batch = [self._queue.get_nowait()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._dispatch(batch)
+
+    async def _dispatch(self, batch: List[Tuple[Any, asyncio.Future]]) -> None:
+        items = [item for item, _ in batch]
+        self.batches_dispatched += 1
+        self.items_dispatched += len(items)
+        try:
+            if self.runner is not None:
+                results = await self.runner(self.handler, items)
+            else:
+                results = self.handler(items)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "batches": self.batches_dispatched,
+            "items": self.items_dispatched,
+        }
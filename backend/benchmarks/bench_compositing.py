@@ -0,0 +1,68 @@
+"""Recoloring cost versus mask count.
+
+Compares the previous per-mask full-frame boolean write against the single
+pass palette compositor used by /apply-colors. Run from ``backend/``:
+
+    python benchmarks/bench_compositing.py [--width 4000 --height 3000]
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from backends import disk_mask  # noqa: E402
+from compositing import composite_masks, parse_color  # noqa: E402
+from mask_store import StoredMask  # noqa: E402
+
+MASK_COUNTS = [1, 8, 32, 128]
+
+
+def legacy_paint(image, masks, color):
+    """The original loop: hex parsed per mask, one full-frame boolean write each"""
+    colored_image = image.copy()
+    for mask in masks:
+        color_rgb = tuple(int(color[i:i+2], 16) for i in (1, 3, 5))
+        colored_image[np.array(mask)] = color_rgb
+    return colored_image
+
+
+def best_of(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--width", type=int, default=4000)
+    parser.add_argument("--height", type=int, default=3000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    width, height = args.width, args.height
+    image = np.random.default_rng(0).integers(0, 255, (height, width, 3), dtype=np.uint8)
+    rng = np.random.default_rng(1)
+    radius = min(width, height) // 20
+
+    print(f"{width}x{height} ({width * height / 1e6:.1f} MP)")
+    print(f"{'masks':>6} {'legacy s':>9} {'palette s':>10} {'speedup':>8}")
+    for count in MASK_COUNTS:
+        arrays = [disk_mask(width, height, int(rng.integers(width)), int(rng.integers(height)), radius)
+                  for _ in range(count)]
+        stored = [StoredMask.from_array(str(i), mask) for i, mask in enumerate(arrays)]
+        layers = [(mask, parse_color("#ff0000")) for mask in stored]
+
+        legacy = best_of(lambda: legacy_paint(image, arrays, "#ff0000"), args.repeat)
+        palette = best_of(lambda: composite_masks(image, layers), args.repeat)
+        print(f"{count:>6} {legacy:9.3f} {palette:10.3f} {legacy / palette:7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Latency of /health while heavy requests keep the worker pool busy.
+
+Probes /health on an idle app, then again while concurrent /generate-masks
+calls on large uploads are running, through httpx's ASGI transport. With
+decode, segmentation and serialization on the worker pool the event loop
+stays free, so busy probes should take about as long as idle ones. Run from
+``backend/``:
+
+    python benchmarks/bench_health.py [--width 3000 --height 2000 --requests 4 --probes 20]
+"""
+import argparse
+import asyncio
+import gc
+import io
+import logging
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import main  # noqa: E402
+
+
+def noisy_jpeg(width, height, seed=0):
+    pixels = np.random.default_rng(seed).integers(0, 255, (height, width, 3), dtype=np.uint8)
+    encoded = io.BytesIO()
+    Image.fromarray(pixels).save(encoded, format="JPEG")
+    return encoded.getvalue()
+
+
+async def probe(client):
+    start = time.perf_counter()
+    response = await client.get("/health")
+    response.raise_for_status()
+    return time.perf_counter() - start
+
+
+async def run(args):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as client:
+        idle = [await probe(client) for _ in range(args.probes)]
+
+        # A distinct upload per request, so each one decodes and segments
+        image_ids = []
+        for seed in range(args.requests):
+            files = {"file": (f"big-{seed}.jpg", noisy_jpeg(args.width, args.height, seed), "image/jpeg")}
+            response = await client.post("/upload-image", files=files, params={"return_image": "false"})
+            image_ids.append(response.json()["image_id"])
+        for image_id in image_ids:
+            # Drop what the upload precomputed, so the timed requests do the work
+            main.forget_image(image_id)
+        heavy_start = time.perf_counter()
+        heavy = asyncio.ensure_future(asyncio.gather(*(
+            client.post("/generate-masks", json={"image_id": image_id}) for image_id in image_ids
+        )))
+        busy = []
+        while not heavy.done():
+            busy.append(await probe(client))
+            await asyncio.sleep(0.005)
+        await heavy
+        return idle, busy, time.perf_counter() - heavy_start
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--width", type=int, default=3000)
+    parser.add_argument("--height", type=int, default=2000)
+    parser.add_argument("--requests", type=int, default=4)
+    parser.add_argument("--probes", type=int, default=20)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    with tempfile.TemporaryDirectory() as tmp:
+        main.UPLOADS_DIR = Path(tmp)
+        gc.collect()
+        idle, busy, heavy_seconds = asyncio.run(run(args))
+
+    print(f"{args.requests} x /generate-masks on {args.width}x{args.height} took {heavy_seconds:.2f}s, "
+          f"{main.worker_pool.max_workers} {main.worker_pool.kind} workers")
+    print(f"{'state':>6} {'probes':>7} {'p50 ms':>8} {'max ms':>8}")
+    for name, latencies in (("idle", idle), ("busy", busy)):
+        print(f"{name:>6} {len(latencies):7d} {statistics.median(latencies) * 1000:8.2f} {max(latencies) * 1000:8.2f}")
+
+
+if __name__ == "__main__":
+    main_()
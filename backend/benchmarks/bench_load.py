@@ -0,0 +1,205 @@
+"""In-process load test of the upload -> generate -> apply-colors flow.
+
+Drives the FastAPI app through httpx's ASGI transport at a fixed
+concurrency and reports throughput plus p50/p99 latency for each step and
+for whole flows. Results are written as JSON so runs on different commits
+can be compared; ``--compare`` flags steps whose p50 or p99 got slower than
+``--threshold`` and exits non-zero. The ASGI transport waits for background
+tasks, so upload latency includes the post-upload decode and encode. Run
+from ``backend/``:
+
+    python benchmarks/bench_load.py --flows 64 --concurrency 8 --output load.json
+    python benchmarks/bench_load.py --flows 64 --concurrency 8 --compare load.json
+"""
+import argparse
+import asyncio
+import io
+import json
+import logging
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import httpx
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import main  # noqa: E402
+from backends import create_backend  # noqa: E402
+from render_cache import RenderCache  # noqa: E402
+
+STEPS = ("upload", "generate", "apply", "flow")
+
+
+def synthetic_jpeg(width, height):
+    pixels = np.random.default_rng(0).integers(0, 255, (height, width, 3), dtype=np.uint8)
+    encoded = io.BytesIO()
+    Image.fromarray(pixels).save(encoded, format="JPEG", quality=90)
+    return encoded.getvalue()
+
+
+async def run_flow(client, image_bytes, index, latencies):
+    """One upload -> generate -> apply-colors flow, recording each step's latency"""
+    flow_start = time.perf_counter()
+
+    start = time.perf_counter()
+    response = await client.post(
+        "/upload-image",
+        files={"file": (f"bench-{index}.jpg", image_bytes, "image/jpeg")},
+        params={"return_image": "false"}
+    )
+    response.raise_for_status()
+    image_id = response.json()["image_id"]
+    latencies["upload"].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    response = await client.post("/generate-masks", json={"image_id": image_id})
+    response.raise_for_status()
+    mask_ids = [mask["id"] for mask in response.json()["masks"]]
+    latencies["generate"].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    response = await client.post("/apply-colors", json={
+        "image_id": image_id,
+        "mask_ids": mask_ids[::2],
+        # A different color per flow so renders are not served from the cache
+        "color": f"#{index % 256:02x}8040"
+    })
+    response.raise_for_status()
+    latencies["apply"].append(time.perf_counter() - start)
+
+    latencies["flow"].append(time.perf_counter() - flow_start)
+
+
+async def run_load(flows, concurrency, image_bytes):
+    latencies = {step: [] for step in STEPS}
+    semaphore = asyncio.Semaphore(concurrency)
+    errors = []
+
+    async def limited(client, index):
+        async with semaphore:
+            try:
+                await run_flow(client, image_bytes, index, latencies)
+            except httpx.HTTPStatusError as e:
+                errors.append(e.response.status_code)
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(limited(client, index) for index in range(flows)))
+        elapsed = time.perf_counter() - start
+    return latencies, elapsed, errors
+
+
+def summarize(latencies, elapsed):
+    steps = {}
+    for step, values in latencies.items():
+        if not values:
+            continue
+        values = np.array(values)
+        steps[step] = {
+            "count": len(values),
+            "mean_ms": float(values.mean() * 1000),
+            "p50_ms": float(np.percentile(values, 50) * 1000),
+            "p99_ms": float(np.percentile(values, 99) * 1000),
+            "max_ms": float(values.max() * 1000)
+        }
+    return {
+        "elapsed_s": elapsed,
+        "flows_per_s": len(latencies["flow"]) / elapsed if elapsed else 0.0,
+        "steps": steps
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    """Print per-step changes against a baseline run; return the regressed steps"""
+    regressions = []
+    print(f"\nversus {baseline.get('commit') or 'baseline'} ({baseline.get('timestamp', '?')})")
+    print(f"{'step':>9} {'p50 ms':>9} {'was':>9} {'p99 ms':>9} {'was':>9}")
+    for step, current in results["steps"].items():
+        previous = baseline.get("steps", {}).get(step)
+        if previous is None:
+            continue
+        print(f"{step:>9} {current['p50_ms']:9.1f} {previous['p50_ms']:9.1f} "
+              f"{current['p99_ms']:9.1f} {previous['p99_ms']:9.1f}")
+        for key in ("p50_ms", "p99_ms"):
+            if current[key] > previous[key] * (1 + threshold):
+                regressions.append(f"{step} {key[:3]}")
+    return regressions
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--flows", type=int, default=32, help="upload -> generate -> apply flows to run")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--width", type=int, default=1600)
+    parser.add_argument("--height", type=int, default=1200)
+    parser.add_argument("--backend", default="mock", help="segmentation backend to load")
+    parser.add_argument("--output", type=Path, help="write results to this JSON file")
+    parser.add_argument("--compare", type=Path, help="baseline JSON from an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.1, help="allowed slowdown before --compare fails")
+    args = parser.parse_args()
+    main.segmentation_backend = create_backend(args.backend)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    image_bytes = synthetic_jpeg(args.width, args.height)
+    with tempfile.TemporaryDirectory() as tmp:
+        # Keep uploads and renders out of the working tree
+        main.UPLOADS_DIR = Path(tmp)
+        main.render_cache = RenderCache(Path(tmp) / "renders")
+        try:
+            latencies, elapsed, errors = asyncio.run(run_load(args.flows, args.concurrency, image_bytes))
+        finally:
+            main.worker_pool.shutdown()
+
+    results = {
+        "benchmark": "load",
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "flows": args.flows,
+            "concurrency": args.concurrency,
+            "width": args.width,
+            "height": args.height,
+            "backend": args.backend,
+            "workers": main.worker_pool.stats()["max_workers"],
+            "working_max_side": main.WORKING_MAX_SIDE
+        },
+        "errors": len(errors),
+        **summarize(latencies, elapsed)
+    }
+
+    print(f"{args.flows} flows at concurrency {args.concurrency}, {args.width}x{args.height}: "
+          f"{results['flows_per_s']:.1f} flows/s, {len(errors)} errors")
+    print(f"{'step':>9} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for step, stats in results["steps"].items():
+        print(f"{step:>9} {stats['p50_ms']:9.1f} {stats['p99_ms']:9.1f} {stats['max_ms']:9.1f}")
+
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2) + "\n")
+
+    if args.compare:
+        regressions = compare(results, json.loads(args.compare.read_text()), args.threshold)
+        if regressions:
+            print(f"Slower than baseline by more than {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,75 @@
+"""pytest-benchmark micro-benchmarks of the mask pipeline at 1, 12 and 24 MP.
+
+Covers mask synthesis, RLE serialization of stored masks and single-pass
+compositing. Requires pytest-benchmark; the file is skipped without it and
+is not collected by the regular test run. Run from ``backend/``:
+
+    python -m pytest benchmarks/bench_micro.py --benchmark-json=bench-micro.json
+
+Compare against an earlier run with ``--benchmark-compare`` (see
+``--benchmark-storage``) or ``pytest-benchmark compare`` on the JSON files.
+"""
+import sys
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from backends import MockBackend  # noqa: E402
+from compositing import composite_masks, parse_color  # noqa: E402
+from main import serialize_masks  # noqa: E402
+from mask_store import ImageRecord, pack_masks  # noqa: E402
+
+SIZES = {"1MP": (1152, 864), "12MP": (4000, 3000), "24MP": (6000, 4000)}
+
+backend = MockBackend()
+
+
+@lru_cache(maxsize=None)
+def synthetic_image(size: str) -> np.ndarray:
+    width, height = SIZES[size]
+    return np.random.default_rng(0).integers(0, 255, (height, width, 3), dtype=np.uint8)
+
+
+@lru_cache(maxsize=None)
+def segmented_record(size: str) -> ImageRecord:
+    image = synthetic_image(size)
+    height, width = image.shape[:2]
+    return ImageRecord("bench", width, height, pack_masks(backend.generate_all(image)))
+
+
+def run(benchmark, func, *args):
+    # A few rounds of one call each; a 24 MP call is too slow for auto-calibration
+    return benchmark.pedantic(func, args, rounds=5, iterations=1, warmup_rounds=1)
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_mask_synthesis(benchmark, size):
+    image = synthetic_image(size)
+    benchmark.extra_info["megapixels"] = image.shape[0] * image.shape[1] / 1e6
+    masks = run(benchmark, lambda: pack_masks(backend.generate_all(image)))
+    assert len(masks) == 4
+
+
+@pytest.mark.parametrize("size", SIZES)
+@pytest.mark.parametrize("mask_format", ["rle", "bitmask"])
+def test_serialization(benchmark, size, mask_format):
+    record = segmented_record(size)
+    benchmark.extra_info["megapixels"] = record.width * record.height / 1e6
+    masks = run(benchmark, serialize_masks, record, mask_format)
+    assert len(masks) == len(record.masks)
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_compositing(benchmark, size):
+    image = synthetic_image(size)
+    record = segmented_record(size)
+    layers = [(mask, parse_color("#ff0000", 0.6)) for mask in record.masks]
+    benchmark.extra_info["megapixels"] = record.width * record.height / 1e6
+    colored = run(benchmark, composite_masks, image, layers, record.scale, "nearest")
+    assert colored.shape == image.shape
@@ -0,0 +1,129 @@
+"""Resident memory and latency of in-memory versus memory-mapped storage.
+
+Each mode runs in a fresh subprocess. It stores ``--sessions`` images, each
+with the decoded working-resolution RGB image and its mock masks, in an
+ArrayCache and a MaskStore configured like ``STORAGE_MODE``. It then reports
+anonymous (heap) and file-backed resident memory from ``/proc/self/status``
+and the latency of mask serialization, a viewport tile and compositing on
+random sessions. Run from ``backend/``:
+
+    python benchmarks/bench_mmap.py [--sessions 50 --width 1024 --height 768]
+"""
+import argparse
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from array_cache import ArrayCache  # noqa: E402
+from backends import MockBackend  # noqa: E402
+from compositing import composite_masks, parse_color  # noqa: E402
+from main import serialize_masks  # noqa: E402
+from mask_store import ImageRecord, MaskStore, pack_masks  # noqa: E402
+from tiles import mask_tile, parse_region  # noqa: E402
+
+
+def resident_kb():
+    """(anonymous, file-backed) resident KiB of this process, zeros where /proc is unavailable"""
+    fields = {}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in ("RssAnon", "RssFile"):
+                    fields[name] = int(value.split()[0])
+    except OSError:
+        pass
+    return fields.get("RssAnon", 0), fields.get("RssFile", 0)
+
+
+def percentile_ms(timings, q):
+    return float(np.percentile(timings, q)) * 1000
+
+
+def run_mode(mode, sessions, width, height, requests):
+    directory = Path(tempfile.mkdtemp(prefix=f"bench-{mode}-"))
+    mmap = mode == "mmap"
+    images = ArrayCache(max_bytes=1 << 40, spill_dir=directory / "images" if mmap else None, mmap=mmap)
+    store = MaskStore(mmap_dir=directory / "masks" if mmap else None)
+    backend = MockBackend()
+
+    anon_before, file_before = resident_kb()
+    rng = np.random.default_rng(0)
+    for index in range(sessions):
+        image = rng.integers(0, 255, (height, width, 3), dtype=np.uint8)
+        image_id = f"session-{index}"
+        store.add(ImageRecord(image_id, width, height, pack_masks(backend.generate_all(image))))
+        images.put(image_id, image)
+        del image
+    anon_after, file_after = resident_kb()
+
+    color = parse_color("#ff0000", 0.5)
+    region = parse_region(f"{width // 8},{height // 8},{width // 2},{height // 2}", width, height)
+    timings = {"serialize": [], "tile": [], "composite": []}
+    for _ in range(requests):
+        image_id = f"session-{rng.integers(sessions)}"
+        record = store[image_id]
+        for step, work in (
+            ("serialize", lambda: serialize_masks(record, "rle")),
+            ("tile", lambda: mask_tile(record.masks[0], record.scale, region, 0.25)),
+            ("composite", lambda: composite_masks(images.get(image_id), [(record.masks[0], color)])),
+        ):
+            start = time.perf_counter()
+            work()
+            timings[step].append(time.perf_counter() - start)
+
+    store.close()
+    shutil.rmtree(directory)
+    return {
+        "mode": mode,
+        "heap_mb": (anon_after - anon_before) / 1024,
+        "file_mb": (file_after - file_before) / 1024,
+        "store_heap_mb": store.nbytes / 2 ** 20,
+        "cache_heap_mb": images.stats()["bytes"] / 2 ** 20,
+        **{f"{step}_p50_ms": percentile_ms(values, 50) for step, values in timings.items()},
+        **{f"{step}_p99_ms": percentile_ms(values, 99) for step, values in timings.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=50)
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--height", type=int, default=768)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--mode", choices=("memory", "mmap"), help="run one mode in this process and print JSON")
+    args = parser.parse_args()
+
+    if args.mode:
+        print(json.dumps(run_mode(args.mode, args.sessions, args.width, args.height, args.requests)))
+        return
+
+    results = []
+    for mode in ("memory", "mmap"):
+        output = subprocess.run(
+            [sys.executable, __file__, "--mode", mode, "--sessions", str(args.sessions), "--width", str(args.width),
+             "--height", str(args.height), "--requests", str(args.requests)],
+            check=True, capture_output=True, text=True
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(f"{args.sessions} sessions of {args.width}x{args.height}, {args.requests} requests")
+    print(f"{'mode':>7} {'heap MB':>8} {'file MB':>8} {'serialize p50/p99':>18} {'tile p50/p99':>14} "
+          f"{'composite p50/p99':>18}")
+    for result in results:
+        print(f"{result['mode']:>7} {result['heap_mb']:8.1f} {result['file_mb']:8.1f} "
+              f"{result['serialize_p50_ms']:8.2f}/{result['serialize_p99_ms']:<9.2f} "
+              f"{result['tile_p50_ms']:6.2f}/{result['tile_p99_ms']:<7.2f} "
+              f"{result['composite_p50_ms']:8.2f}/{result['composite_p99_ms']:<9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Per-megapixel timings of mock mask synthesis.
+
+Compares the previous pure-Python loop rasterizer against the vectorized
+NumPy one used by ``MockBackend.generate_all``. Run from ``backend/``:
+
+    python benchmarks/bench_mock_masks.py [--legacy-max-mp 4]
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from backends import MockBackend  # noqa: E402
+
+SIZES = [(1000, 1000), (4000, 3000), (6000, 4000)]
+
+
+def legacy_generate_mock_masks(width, height):
+    """The original nested-list implementation, kept for comparison"""
+    masks = []
+    mask_size = min(width, height) // 8
+    quadrants = [
+        (width // 4, height // 4),
+        (3 * width // 4, height // 4),
+        (width // 4, 3 * height // 4),
+        (3 * width // 4, 3 * height // 4)
+    ]
+    for center_x, center_y in quadrants:
+        mock_mask = [[False for _ in range(width)] for _ in range(height)]
+        for y in range(max(0, center_y - mask_size), min(height, center_y + mask_size)):
+            for x in range(max(0, center_x - mask_size), min(width, center_x + mask_size)):
+                if (x - center_x) ** 2 + (y - center_y) ** 2 <= mask_size ** 2:
+                    mock_mask[y][x] = True
+        masks.append(mock_mask)
+    return masks
+
+
+def best_of(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--legacy-max-mp", type=float, default=4.0,
+                        help="skip the slow legacy implementation above this size")
+    args = parser.parse_args()
+
+    print(f"{'size':>11} {'MP':>5} {'legacy s/MP':>12} {'numpy s/MP':>11} {'speedup':>8}")
+    for width, height in SIZES:
+        megapixels = width * height / 1e6
+        image = np.zeros((height, width, 3), dtype=np.uint8)
+        backend = MockBackend()
+        vectorized = best_of(lambda: backend.generate_all(image), args.repeat) / megapixels
+
+        if megapixels <= args.legacy_max_mp:
+            legacy = best_of(lambda: legacy_generate_mock_masks(width, height), 1) / megapixels
+            legacy_text = f"{legacy:12.4f}"
+            speedup_text = f"{legacy / vectorized:7.0f}x"
+        else:
+            legacy_text, speedup_text = f"{'skipped':>12}", f"{'-':>8}"
+
+        print(f"{width:>5}x{height:<5} {megapixels:5.1f} {legacy_text} {vectorized:11.5f} {speedup_text}")
+
+
+if __name__ == "__main__":
+    main()
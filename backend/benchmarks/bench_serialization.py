@@ -0,0 +1,66 @@
+"""Response serialization cost of the four-mask mock segmentation.
+
+Builds the /generate-masks payload for a synthetic image and times turning
+it into bytes the previous way (FastAPI's ``jsonable_encoder`` plus
+``JSONResponse``) against the pre-serialized path (orjson, and MessagePack
+when installed), reporting payload sizes too. Run from ``backend/``:
+
+    python benchmarks/bench_serialization.py [--width 4000 --height 3000] [--formats rle,bitmask]
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from backends import MockBackend  # noqa: E402
+from main import serialize_masks  # noqa: E402
+from mask_store import ImageRecord, pack_masks  # noqa: E402
+from responses import MSGPACK_AVAILABLE, ORJSON_AVAILABLE, encode_body  # noqa: E402
+
+
+def best_of(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--width", type=int, default=4000)
+    parser.add_argument("--height", type=int, default=3000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--formats", default="rle,bitmask", help="mask formats; dense is very slow at 12 MP")
+    args = parser.parse_args()
+
+    image = np.zeros((args.height, args.width, 3), dtype=np.uint8)
+    record = ImageRecord("bench", args.width, args.height, pack_masks(MockBackend().generate_all(image)))
+
+    encoders = {"jsonable_encoder": lambda content: JSONResponse(jsonable_encoder(content)).body}
+    if ORJSON_AVAILABLE:
+        encoders["orjson"] = lambda content: encode_body(content)[0]
+    else:
+        encoders["json"] = lambda content: encode_body(content)[0]
+    if MSGPACK_AVAILABLE:
+        encoders["msgpack"] = lambda content: encode_body(content, "msgpack")[0]
+
+    print(f"{args.width}x{args.height} ({args.width * args.height / 1e6:.1f} MP), {len(record.masks)} masks")
+    print(f"{'format':>8} {'encoder':>17} {'masks ms':>9} {'body ms':>8} {'bytes':>10}")
+    for mask_format in args.formats.split(","):
+        mask_seconds, masks = best_of(lambda: serialize_masks(record, mask_format), args.repeat)
+        content = {"image_id": record.image_id, "masks": masks, "message": f"Generated {len(masks)} masks"}
+        for name, encode in encoders.items():
+            body_seconds, body = best_of(lambda: encode(content), args.repeat)
+            print(f"{mask_format:>8} {name:>17} {mask_seconds * 1000:9.1f} {body_seconds * 1000:8.2f} {len(body):>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Throughput of video mask propagation with and without frame prefetching.
+
+Writes a synthetic panning clip as a zip of JPEG frames, then tracks a
+prompted mask through it with the mock backend's optical-flow propagation:
+once decoding each frame inline and once through the bounded prefetch
+queue, so decoding overlaps with propagation. The overlap needs a spare
+core; on a single CPU both runs take about as long. Run from ``backend/``:
+
+    python benchmarks/bench_video.py [--frames 60 --width 1920 --height 1080 --max-side 1024]
+"""
+import argparse
+import io
+import sys
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import video  # noqa: E402
+from backends import MockBackend  # noqa: E402
+from resampling import working_size  # noqa: E402
+
+
+def write_clip(path, frames, width, height, step=6):
+    rng = np.random.default_rng(0)
+    scene = Image.fromarray((rng.random((height // 16, (width + step * frames) // 16, 3)) * 255).astype(np.uint8))
+    scene = np.asarray(scene.resize((width + step * frames, height), Image.BICUBIC))
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_STORED) as archive:
+        for index in range(frames):
+            left = step * (frames - 1 - index)
+            data = io.BytesIO()
+            Image.fromarray(scene[:, left:left + width]).save(data, format="JPEG", quality=90)
+            archive.writestr(f"frame{index:05d}.jpg", data.getvalue())
+
+
+def run(path, max_side, point, prefetch):
+    backend = MockBackend()
+    if not prefetch:
+        # Inline decoding: the same pipeline with a pass-through in place of the prefetcher
+        original, video.Prefetcher = video.Prefetcher, lambda source, depth: _Inline(source)
+    try:
+        start = time.perf_counter()
+        count = sum(1 for _ in video.track_video(backend, path, 0, [point], [1], max_side, prefetch=prefetch or 1))
+        return count, time.perf_counter() - start
+    finally:
+        if not prefetch:
+            video.Prefetcher = original
+
+
+class _Inline:
+    def __init__(self, source):
+        self._source = iter(source)
+
+    def __iter__(self):
+        return self._source
+
+    def __next__(self):
+        return next(self._source)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=60)
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--max-side", type=int, default=1024)
+    parser.add_argument("--prefetch", type=int, default=8)
+    args = parser.parse_args()
+
+    working_width, working_height = working_size(args.width, args.height, args.max_side)
+    point = [working_width // 2, working_height // 2]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "clip.zip"
+        write_clip(path, args.frames, args.width, args.height)
+        print(f"{args.frames} frames of {args.width}x{args.height}, tracked at {working_width}x{working_height}, "
+              f"OpenCV {'on' if video.CV2_AVAILABLE else 'off'}")
+        print(f"{'prefetch':>9} {'frames':>7} {'seconds':>8} {'frames/s':>9}")
+        for prefetch in (0, args.prefetch):
+            count, seconds = run(path, args.max_side, point, prefetch)
+            print(f"{prefetch:9d} {count:7d} {seconds:8.2f} {count / seconds:9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""Throughput of the full request flow across uvicorn worker processes.
+
+Starts ``uvicorn main:app --workers N`` for each worker count against a
+fresh uploads directory and drives upload -> generate -> two refinement clicks
+-> apply-colors -> download flows over HTTP at a fixed concurrency. Consecutive
+requests of one flow land on whichever worker accepts them, so every step
+after the upload relies on the state backend to see what another worker
+did. Reports flows per second, the speedup over the first worker count and
+the number of flows that failed; with ``--state memory`` the failures show
+what is lost without shared state. Workers beyond the number of cores only
+add contention, so scaling must be measured on a host with at least as many
+cores as the largest worker count (the load generator needs a core too).
+Run from ``backend/``:
+
+    python benchmarks/bench_workers.py [--workers 1 2 4 --flows 64 --concurrency 16 --state sqlite --recheck 0]
+"""
+import argparse
+import asyncio
+import io
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+import numpy as np
+from PIL import Image
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+
+def synthetic_jpeg(width, height, seed):
+    pixels = np.random.default_rng(seed).integers(0, 255, (height, width, 3), dtype=np.uint8)
+    encoded = io.BytesIO()
+    Image.fromarray(pixels).save(encoded, format="JPEG", quality=90)
+    return encoded.getvalue()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(workers, args, uploads_dir, port):
+    env = dict(os.environ, STATE_BACKEND=args.state, UPLOADS_DIR=str(uploads_dir), SEGMENTATION_BACKEND="mock",
+               MASK_STORE_RECHECK_SECONDS=str(args.recheck))
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--workers", str(workers),
+         "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+
+async def wait_ready(client, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get("/health")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("server did not start")
+
+
+async def run_flow(client, image_bytes, index):
+    """One full flow; True if every step succeeded"""
+    response = await client.post(
+        "/upload-image",
+        files={"file": (f"bench-{index}.jpg", image_bytes, "image/jpeg")},
+        params={"return_image": "false"}
+    )
+    if response.status_code != 200:
+        return False
+    image_id = response.json()["image_id"]
+    steps = [
+        ("POST", "/generate-masks", {"image_id": image_id}),
+        # Two clicks of one refinement session
+        ("POST", "/get-mask", {"image_id": image_id, "points": [{"x": 32, "y": 32}], "labels": [1], "session_id": "bench"}),
+        ("POST", "/get-mask", {"image_id": image_id, "points": [{"x": 96, "y": 64}], "labels": [0], "session_id": "bench"}),
+        ("POST", "/apply-colors", {"image_id": image_id, "mask_ids": ["0"], "color": "#ff0000"}),
+        ("GET", f"/download/{image_id}", None),
+    ]
+    for method, url, body in steps:
+        response = await client.request(method, url, json=body)
+        if response.status_code != 200:
+            return False
+    return True
+
+
+async def run(workers, args):
+    port = free_port()
+    with tempfile.TemporaryDirectory() as uploads_dir:
+        server = start_server(workers, args, uploads_dir, port)
+        try:
+            limits = httpx.Limits(max_connections=args.concurrency)
+            async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=60.0, limits=limits) as client:
+                await wait_ready(client)
+                # Distinct images, so dedupe does not turn uploads into cache hits
+                images = [synthetic_jpeg(args.width, args.height, seed) for seed in range(args.flows)]
+                semaphore = asyncio.Semaphore(args.concurrency)
+
+                async def bounded(index):
+                    async with semaphore:
+                        return await run_flow(client, images[index], index)
+
+                start = time.perf_counter()
+                results = await asyncio.gather(*(bounded(index) for index in range(args.flows)))
+                seconds = time.perf_counter() - start
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+    return seconds, results.count(False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--flows", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--state", choices=("memory", "sqlite", "redis"), default="sqlite")
+    parser.add_argument("--recheck", type=float, default=0.0, help="MASK_STORE_RECHECK_SECONDS for the workers")
+    args = parser.parse_args()
+
+    cpus = os.cpu_count() or 1
+    print(f"{args.flows} flows of {args.width}x{args.height} at concurrency {args.concurrency}, "
+          f"STATE_BACKEND={args.state}, {cpus} CPUs")
+    if max(args.workers) >= cpus:
+        print(f"warning: {max(args.workers)} workers on {cpus} CPUs can't show scaling")
+    print(f"{'workers':>8} {'seconds':>8} {'flows/s':>8} {'speedup':>8} {'failed':>7}")
+    base = None
+    for workers in args.workers:
+        seconds, failed = asyncio.run(run(workers, args))
+        rate = args.flows / seconds
+        base = base or rate
+        print(f"{workers:8d} {seconds:8.2f} {rate:8.1f} {rate / base:7.2f}x {failed:7d}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Latency and peak memory of the mask pipeline versus image size.
+
+Times decode, segmentation plus RLE serialization, and full-resolution
+coloring for synthetic JPEGs, once at native resolution and once at a capped
+working resolution. Peak memory is the tracemalloc high-water mark of decode
+and segmentation, the part that stays resident per image. Run from ``backend/``:
+
+    python benchmarks/bench_working_resolution.py [--max-side 1024] [--backend cpu]
+"""
+import argparse
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import main  # noqa: E402
+from backends import create_backend  # noqa: E402
+
+SIZES = [(1600, 1200), (4000, 3000), (6000, 4000)]
+
+
+def run_stages(image_path, output_path, max_side):
+    """Time decode, segment + serialize and full-resolution coloring separately"""
+    timings = {}
+    start = time.perf_counter()
+    image, original_size = main.decode_image_file(image_path, max_side)
+    timings["decode"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    record, _ = main.segment_image("bench", image, original_size, False)
+    main.serialize_masks(record, "rle")
+    timings["segment"] = time.perf_counter() - start
+
+    full_image = image if max_side == 0 else main.decode_image_file(image_path)[0]
+    start = time.perf_counter()
+    layers = [(mask, main.parse_color("#ff0000")) for mask in record.masks]
+    output_path.write_bytes(main.render_colored_image(full_image, record, layers, "jpeg", main.RENDER_QUALITY))
+    timings["render"] = time.perf_counter() - start
+    return timings
+
+
+def measure(image_path, output_path, max_side, repeat):
+    runs = [run_stages(image_path, output_path, max_side) for _ in range(repeat)]
+    best = {stage: min(run[stage] for run in runs) for stage in runs[0]}
+
+    # Peak memory of the resident part of the pipeline: the decoded image and its masks
+    tracemalloc.start()
+    image, original_size = main.decode_image_file(image_path, max_side)
+    record, _ = main.segment_image("bench", image, original_size, False)
+    main.serialize_masks(record, "rle")
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--max-side", type=int, default=1024)
+    parser.add_argument("--backend", default="mock", help="segmentation backend to benchmark")
+    args = parser.parse_args()
+    main.segmentation_backend = create_backend(args.backend)
+
+    header = f"{'decode s':>9} {'segment s':>10} {'render s':>9} {'peak MB':>8}"
+    print(f"{'size':>11} {'MP':>5} {'mode':>8} {header}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for width, height in SIZES:
+            image_path = Path(tmp) / f"{width}x{height}.jpg"
+            output_path = Path(tmp) / "colored.jpg"
+            pixels = np.random.default_rng(0).integers(0, 255, (height, width, 3), dtype=np.uint8)
+            Image.fromarray(pixels).save(image_path, quality=90)
+
+            for mode, max_side in (("native", 0), ("working", args.max_side)):
+                timings, peak = measure(image_path, output_path, max_side, args.repeat)
+                print(f"{width:>5}x{height:<5} {width * height / 1e6:5.1f} {mode:>8} "
+                      f"{timings['decode']:9.3f} {timings['segment']:10.3f} {timings['render']:9.3f} "
+                      f"{peak / 1e6:8.1f}")
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,83 @@
+"""Palette compositing of colored masks onto an image.
+
+Masks are first rasterized into a single uint8 label map (0 for untouched
+pixels, ``i`` for the ``i``-th layer, later layers on top), writing only
+inside each mask's bbox. The output is then produced with one palette
+lookup and alpha blend over the painted rows and columns, so the cost is
+roughly proportional to the painted area rather than to masks x pixels.
+"""
+from typing import Sequence, Tuple
+
+import numpy as np
+
+from resampling import upsample_region
+
+# Label 0 means "no mask", leaving 255 palette entries for layers
+MAX_LAYERS = 255
+
+# Rows blended per step; each band is trimmed to its painted columns, which
+# also bounds the uint16 temporaries on large images
+BAND_ROWS = 256
+
+Color = Tuple[int, int, int, int]
+
+
+def parse_color(color: str, alpha: float = 1.0) -> Color:
+    """Parse ``#RRGGBB`` or ``#RRGGBBAA`` into 0-255 RGBA, scaling alpha by ``alpha``"""
+    digits = color[1:] if color.startswith("#") else ""
+    if len(digits) not in (6, 8):
+        raise ValueError(f"Invalid color '{color}', expected #RRGGBB or #RRGGBBAA")
+    try:
+        channels = [int(digits[i:i + 2], 16) for i in range(0, len(digits), 2)]
+    except ValueError:
+        raise ValueError(f"Invalid color '{color}', expected #RRGGBB or #RRGGBBAA")
+    opacity = channels[3] if len(channels) == 4 else 255
+    return channels[0], channels[1], channels[2], round(opacity * min(1.0, max(0.0, alpha)))
+
+
+def composite_masks(image: np.ndarray, layers: Sequence[Tuple[object, Color]],
+                    scale: Tuple[float, float] = (1.0, 1.0), method: str = "nearest") -> np.ndarray:
+    """Return a copy of ``image`` with each ``(mask, rgba)`` layer blended on top.
+
+    Masks are :class:`mask_store.StoredMask` crops at a working resolution
+    that is ``scale`` times smaller than ``image``.
+    """
+    if len(layers) > MAX_LAYERS:
+        raise ValueError(f"At most {MAX_LAYERS} masks can be composited at once")
+
+    height, width = image.shape[:2]
+    labels = np.zeros((height, width), dtype=np.uint8)
+    palette_color = np.zeros((MAX_LAYERS + 1, 3), dtype=np.uint16)  # color premultiplied by alpha
+    palette_keep = np.full(MAX_LAYERS + 1, 255, dtype=np.uint16)  # weight of the original pixel
+    top, left, bottom, right = height, width, 0, 0
+
+    for label, (mask, (red, green, blue, alpha)) in enumerate(layers, start=1):
+        palette_color[label] = (red * alpha, green * alpha, blue * alpha)
+        palette_keep[label] = 255 - alpha
+        if not mask.area:
+            continue
+        x, y, region = upsample_region(mask.crop(), mask.bbox, scale[0], scale[1], width, height, method)
+        if not region.size:
+            continue
+        labels[y:y + region.shape[0], x:x + region.shape[1]][region] = label
+        top, left = min(top, y), min(left, x)
+        bottom, right = max(bottom, y + region.shape[0]), max(right, x + region.shape[1])
+
+    output = image.copy()
+    for band_top in range(top, bottom, BAND_ROWS):
+        rows = slice(band_top, min(bottom, band_top + BAND_ROWS))
+        painted_cols = np.flatnonzero(labels[rows, left:right].any(axis=0))
+        if not painted_cols.size:
+            continue
+        cols = slice(left + painted_cols[0], left + painted_cols[-1] + 1)
+        window = labels[rows, cols]
+        blended = image[rows, cols].astype(np.uint16)
+        blended *= palette_keep[window][..., None]
+        blended += palette_color[window]
+        # Rounded division by 255 without an integer divide; exact for values up to 255 * 255
+        blended += 128
+        blended += blended >> 8
+        blended >>= 8
+        output[rows, cols] = blended
+    return output
+
@@ -0,0 +1,171 @@
+"""Upload deduplication.
+
+Every upload gets its own image_id, but identical photos share one
+*canonical* image whose masks, embedding, decoded copy and renders serve all
+of them. Uploads are matched by the SHA-256 of their bytes and, optionally,
+by a 64-bit difference hash (dHash) of their pixels, which survives
+re-encoding and small edits. Perceptual matches must also have the same
+size, since the canonical masks are in its pixel coordinates.
+
+:class:`UploadIndex` maps image ids onto canonical ids and counts the ids
+referring to each canonical image, so its shared state is released only
+when the last of them is gone. dHash lookups use multi-index hashing: the
+hash is split into ``HASH_BANDS`` bands, and any hash within
+``HASH_BANDS - 1`` bits of a query equals it in at least one band, so only
+ids sharing a band value are compared.
+
+With a shared :mod:`state` backend, the canonical id of every upload and
+the SHA-256 digests are written through as well, so any worker process
+resolves an alias and finds exact duplicates of uploads made to another.
+dHash buckets and reference counts stay per process: a perceptual match
+is only found in the process holding the original, and state shared by
+aliases from several processes expires with the uploads themselves.
+"""
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+from PIL import Image
+
+from state import SharedValues, StateBackend
+
+DEDUPE_MODES = ("off", "exact", "perceptual")
+HASH_BANDS = 8
+BAND_BITS = 64 // HASH_BANDS
+
+# (dHash, width, height)
+PerceptualHash = Tuple[int, int, int]
+
+
+def perceptual_hash(path: Path) -> PerceptualHash:
+    """dHash of an image file: one bit per horizontally adjacent pair of a 9x8 grayscale thumbnail"""
+    with Image.open(path) as image:
+        size = image.size
+        # JPEGs decode straight at a reduced scale
+        image.draft("L", (64, 64))
+        pixels = np.asarray(image.convert("L").resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big"), size[0], size[1]
+
+
+def _bands(value: int) -> List[Tuple[int, int]]:
+    mask = (1 << BAND_BITS) - 1
+    return [(band, (value >> (band * BAND_BITS)) & mask) for band in range(HASH_BANDS)]
+
+
+class UploadIndex:
+    """Content hashes of canonical uploads and the image ids referring to each"""
+
+    def __init__(self, max_distance: int = 4, state: Optional[StateBackend] = None, ttl: Optional[float] = None):
+        if not 0 <= max_distance < HASH_BANDS:
+            raise ValueError(f"max_distance must be between 0 and {HASH_BANDS - 1}")
+        self.max_distance = max_distance
+        self.shared = state is not None
+        self._shared_canonical = SharedValues(state, "upload:canonical:", ttl)
+        self._shared_digests = SharedValues(state, "upload:digest:", ttl)
+        self._canonical: Dict[str, str] = {}  # image id -> canonical id
+        self._references: Dict[str, Set[str]] = {}  # canonical id -> ids referring to it, itself included
+        self._by_digest: Dict[str, str] = {}
+        self._digests: Dict[str, str] = {}
+        self._hashes: Dict[str, PerceptualHash] = {}
+        self._buckets: Dict[Tuple[int, int], Set[str]] = defaultdict(set)
+        self.exact_hits = 0
+        self.perceptual_hits = 0
+
+    def find_exact(self, digest: str) -> Optional[str]:
+        """Canonical id of an upload with this SHA-256"""
+        canonical = self._by_digest.get(digest)
+        if canonical is None and self.shared:
+            canonical = self._shared_digests.get(digest)
+        if canonical is not None:
+            self.exact_hits += 1
+        return canonical
+
+    def find_similar(self, phash: PerceptualHash) -> Optional[str]:
+        """Canonical id of the same-size upload with the closest dHash, within ``max_distance`` bits"""
+        value, width, height = phash
+        candidates = set()
+        for band in _bands(value):
+            candidates.update(self._buckets.get(band, ()))
+        best, best_distance = None, self.max_distance + 1
+        for candidate in candidates:
+            other, other_width, other_height = self._hashes[candidate]
+            distance = bin(value ^ other).count("1")
+            if (other_width, other_height) == (width, height) and distance < best_distance:
+                best, best_distance = candidate, distance
+        if best is not None:
+            self.perceptual_hits += 1
+        return best
+
+    def register(self, image_id: str, digest: str, phash: Optional[PerceptualHash] = None) -> None:
+        """Record a new canonical upload"""
+        self._canonical[image_id] = image_id
+        self._references[image_id] = {image_id}
+        self._by_digest[digest] = image_id
+        self._digests[image_id] = digest
+        if self.shared:
+            self._shared_canonical[image_id] = image_id
+            self._shared_digests[digest] = image_id
+        if phash is not None:
+            self._hashes[image_id] = phash
+            for band in _bands(phash[0]):
+                self._buckets[band].add(image_id)
+
+    def alias(self, image_id: str, canonical: str) -> None:
+        """Point a new upload at an existing canonical image, possibly registered by another process"""
+        self._canonical[image_id] = canonical
+        self._references.setdefault(canonical, {canonical}).add(image_id)
+        if self.shared:
+            self._shared_canonical[image_id] = canonical
+
+    def resolve(self, image_id: str) -> str:
+        """Canonical id for an image id; ids never deduplicated are their own"""
+        canonical = self._canonical.get(image_id)
+        if canonical is None and self.shared:
+            canonical = self._shared_canonical.get(image_id)
+        return canonical or image_id
+
+    def references(self, canonical: str) -> int:
+        return len(self._references.get(canonical, ()))
+
+    def referring(self, canonical_ids: Iterable[str]) -> Set[str]:
+        """Every image id resolving to one of ``canonical_ids``"""
+        ids = set()
+        for canonical in canonical_ids:
+            ids.update(self._references.get(canonical, ()))
+        return ids
+
+    def release(self, image_id: str) -> List[str]:
+        """Drop an image id; returns the canonical id if no ids refer to it any more"""
+        canonical = self._canonical.pop(image_id, None)
+        if self.shared:
+            self._shared_canonical.pop(image_id)
+        if canonical is None:
+            return []
+        references = self._references[canonical]
+        references.discard(image_id)
+        if references:
+            return []
+        del self._references[canonical]
+        # Canonical images registered by another process have no digest here
+        digest = self._digests.pop(canonical, None)
+        if digest is not None and self._by_digest.get(digest) == canonical:
+            del self._by_digest[digest]
+            if self.shared and self._shared_digests.get(digest) == canonical:
+                self._shared_digests.pop(digest)
+        phash = self._hashes.pop(canonical, None)
+        if phash is not None:
+            for band in _bands(phash[0]):
+                self._buckets[band].discard(canonical)
+                if not self._buckets[band]:
+                    del self._buckets[band]
+        return [canonical]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "images": len(self._canonical),
+            "canonical": len(self._references),
+            "exact_hits": self.exact_hits,
+            "perceptual_hits": self.perceptual_hits,
+        }
@@ -0,0 +1,113 @@
+"""Spatial index for click and lasso selection.
+
+Built once per image from its stored masks, at the working resolution:
+
+- a label map holding, for every pixel, the topmost mask (the smallest one
+  covering it, so nested parts win over the surfaces they sit on), and
+- a uniform grid of bbox buckets listing which masks may cover each cell.
+
+A point query is one label-map read for the topmost mask plus, for the full
+stack, a bbox test and a single packed-bit read per mask in the point's
+cell. Rectangles and lassos read the label map inside their bounds only, so
+they report the masks visible there. Masks are never unpacked.
+"""
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from mask_store import StoredMask
+
+GRID_CELL_SIZE = 64  # working pixels per grid cell side
+
+
+class HitIndex:
+    """Topmost-mask label map plus a bbox grid over one image's masks"""
+
+    def __init__(self, labels: np.ndarray, order: np.ndarray, cells: List[List[int]], cell_size: int):
+        self.labels = labels  # 0 = no mask, otherwise position in ``order`` + 1
+        self.order = order  # mask indices, topmost (smallest) first
+        self.cells = cells  # row-major grid of mask indices whose bbox touches the cell
+        self.cell_size = cell_size
+        self.grid_width = -(-labels.shape[1] // cell_size)
+
+    @classmethod
+    def build(cls, masks: Sequence[StoredMask], width: int, height: int,
+              cell_size: int = GRID_CELL_SIZE) -> "HitIndex":
+        """Index masks stored at ``width`` x ``height`` working pixels"""
+        order = np.array(sorted(range(len(masks)), key=lambda i: masks[i].area), dtype=np.int64)
+        labels = np.zeros((height, width), dtype=np.uint16 if len(masks) < 2 ** 16 else np.uint32)
+        # Paint largest first so smaller masks end up on top
+        for rank in range(len(order) - 1, -1, -1):
+            mask = masks[order[rank]]
+            if mask.area:
+                x, y, bbox_width, bbox_height = mask.bbox
+                labels[y:y + bbox_height, x:x + bbox_width][mask.crop()] = rank + 1
+
+        grid_width = -(-width // cell_size)
+        cells: List[List[int]] = [[] for _ in range(grid_width * -(-height // cell_size))]
+        for index in order:
+            x, y, bbox_width, bbox_height = masks[index].bbox
+            if not masks[index].area:
+                continue
+            for row in range(y // cell_size, (y + bbox_height - 1) // cell_size + 1):
+                for col in range(x // cell_size, (x + bbox_width - 1) // cell_size + 1):
+                    cells[row * grid_width + col].append(int(index))
+        return cls(labels, order, cells, cell_size)
+
+    @property
+    def nbytes(self) -> int:
+        return self.labels.nbytes + self.order.nbytes
+
+    def top_at(self, x: int, y: int) -> Optional[int]:
+        """Index of the topmost mask at a working pixel, or None"""
+        if not (0 <= y < self.labels.shape[0] and 0 <= x < self.labels.shape[1]):
+            return None
+        label = int(self.labels[y, x])
+        return int(self.order[label - 1]) if label else None
+
+    def masks_at(self, masks: Sequence[StoredMask], x: int, y: int) -> List[int]:
+        """Indices of every mask covering a working pixel, topmost first"""
+        if not (0 <= y < self.labels.shape[0] and 0 <= x < self.labels.shape[1]):
+            return []
+        hits = []
+        for index in self.cells[(y // self.cell_size) * self.grid_width + x // self.cell_size]:
+            if _covers(masks[index], x, y):
+                hits.append(index)
+        return hits
+
+    def masks_in_rect(self, x0: int, y0: int, x1: int, y1: int) -> List[int]:
+        """Indices of masks visible inside the working-pixel rectangle [x0, x1) x [y0, y1), topmost first"""
+        height, width = self.labels.shape
+        x0, y0, x1, y1 = max(0, x0), max(0, y0), min(width, x1), min(height, y1)
+        if x1 <= x0 or y1 <= y0:
+            return []
+        return self._visible(self.labels[y0:y1, x0:x1])
+
+    def masks_in_polygon(self, points: Sequence[Tuple[float, float]]) -> List[int]:
+        """Indices of masks visible inside a lasso polygon in working pixels, topmost first"""
+        height, width = self.labels.shape
+        xs = [x for x, _ in points]
+        ys = [y for _, y in points]
+        x0, y0 = max(0, int(np.floor(min(xs)))), max(0, int(np.floor(min(ys))))
+        x1, y1 = min(width, int(np.ceil(max(xs))) + 1), min(height, int(np.ceil(max(ys))) + 1)
+        if x1 <= x0 or y1 <= y0:
+            return []
+        # Rasterize the lasso over its own bounds only
+        canvas = Image.new("1", (x1 - x0, y1 - y0), 0)
+        ImageDraw.Draw(canvas).polygon([(x - x0, y - y0) for x, y in points], fill=1, outline=1)
+        inside = np.array(canvas, dtype=bool)
+        return self._visible(self.labels[y0:y1, x0:x1][inside])
+
+    def _visible(self, labels: np.ndarray) -> List[int]:
+        ranks = np.unique(labels)
+        return [int(self.order[rank - 1]) for rank in ranks if rank]
+
+
+def _covers(mask: StoredMask, x: int, y: int) -> bool:
+    """Read one pixel of a mask straight from its packed bits"""
+    bbox_x, bbox_y, bbox_width, bbox_height = mask.bbox
+    if not (bbox_x <= x < bbox_x + bbox_width and bbox_y <= y < bbox_y + bbox_height):
+        return False
+    bit = (y - bbox_y) * bbox_width + (x - bbox_x)
+    return bool(mask.bits[bit >> 3] >> (7 - (bit & 7)) & 1)
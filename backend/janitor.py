@@ -0,0 +1,32 @@
+"""Periodic cleanup of expired uploads and rendered outputs."""
+import time
+from pathlib import Path
+from typing import Collection, List, Optional
+
+
+def sweep_uploads(directory: Path, max_age: float, keep: Collection[str] = (),
+                  now: Optional[float] = None) -> List[str]:
+    """Delete top-level files in ``directory`` not modified for ``max_age`` seconds.
+
+    Original uploads of image ids in ``keep`` are skipped. Returns the image
+    ids whose original upload was removed; rendered outputs such as
+    ``{image_id}_colored.jpg`` can always be re-rendered, so they are removed
+    regardless of ``keep`` and without being reported.
+    Subdirectories (spill stores, caches) are left alone.
+    """
+    cutoff = (now if now is not None else time.time()) - max_age
+    removed = []
+    for path in Path(directory).iterdir():
+        is_original = "_" not in path.stem
+        if is_original and path.stem in keep:
+            continue
+        try:
+            if not path.is_file() or path.stat().st_mtime >= cutoff:
+                continue
+            path.unlink()
+        except FileNotFoundError:
+            # Removed concurrently, e.g. by a request replacing its output
+            continue
+        if is_original:
+            removed.append(path.stem)
+    return removed
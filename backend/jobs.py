@@ -0,0 +1,242 @@
+"""Background mask-generation jobs.
+
+A :class:`Job` collects serialized masks as the backend produces them. Jobs
+are updated from worker threads and observed from the event loop, so every
+update is taken under a lock and waiters are woken with
+``call_soon_threadsafe``.
+
+With a shared :mod:`state` backend every update is also written through:
+the status as one JSON value and each mask appended to a list. Another
+worker process asked about the job loads that copy, and streams its events
+by polling it every ``POLL_INTERVAL`` seconds.
+"""
+import asyncio
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from state import StateBackend
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+FINISHED = (COMPLETED, FAILED)
+POLL_INTERVAL = 0.25
+
+
+class Job:
+    """State and partial results of one mask-generation job"""
+
+    def __init__(self, image_id: str, mask_format: str, state: Optional[StateBackend] = None,
+                 ttl: Optional[float] = None, job_id: Optional[str] = None):
+        self.id = job_id or str(uuid.uuid4())
+        self.image_id = image_id
+        self.mask_format = mask_format
+        self.status = QUEUED
+        self.error: Optional[str] = None
+        self.total: Optional[int] = None
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.masks: List[Dict[str, Any]] = []
+        self.task: Optional[asyncio.Task] = None
+        self.state = state
+        self.ttl = ttl
+        self.remote = False  # run by another process; read from the state backend
+        self._lock = threading.Lock()
+        self._waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = []
+        self._save()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED
+
+    def _save(self) -> None:
+        if self.state is None or self.remote:
+            return
+        header = {"image_id": self.image_id, "mask_format": self.mask_format, "status": self.status,
+                  "error": self.error, "total": self.total, "created_at": self.created_at,
+                  "finished_at": self.finished_at}
+        self.state.set_value(f"job:{self.id}", json.dumps(header).encode(), self.ttl)
+
+    @classmethod
+    def load(cls, state: StateBackend, job_id: str) -> Optional["Job"]:
+        """A job run by another process, from the state backend, or None"""
+        if state.get_value(f"job:{job_id}") is None:
+            return None
+        job = cls("", "", job_id=job_id)
+        job.state, job.remote = state, True
+        job.refresh()
+        return job
+
+    def refresh(self) -> None:
+        """Bring a remote job up to date with the state backend"""
+        header = self.state.get_value(f"job:{self.id}")
+        if header is None:
+            return
+        header = json.loads(header)
+        # Masks are appended before the status changes, so read the status first
+        masks = [json.loads(mask) for mask in self.state.list_values(f"job:{self.id}:masks", len(self.masks))]
+        with self._lock:
+            self.image_id, self.mask_format = header["image_id"], header["mask_format"]
+            self.status, self.error, self.total = header["status"], header["error"], header["total"]
+            self.created_at, self.finished_at = header["created_at"], header["finished_at"]
+            self.masks.extend(masks)
+
+    def _notify(self) -> None:
+        waiters, self._waiters = self._waiters, []
+        for loop, event in waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    def start(self, total: Optional[int] = None) -> None:
+        with self._lock:
+            self.status = RUNNING
+            self.total = total
+            self._save()
+            self._notify()
+
+    def add_mask(self, mask: Dict[str, Any]) -> None:
+        """Publish one serialized mask; safe to call from any thread"""
+        with self._lock:
+            self.masks.append(mask)
+            if self.state is not None:
+                self.state.append_value(f"job:{self.id}:masks", json.dumps(mask, separators=(",", ":")).encode(),
+                                        self.ttl)
+            self._notify()
+
+    def complete(self) -> None:
+        with self._lock:
+            self.status = COMPLETED
+            self.total = len(self.masks)
+            self.finished_at = time.time()
+            self._save()
+            self._notify()
+
+    def fail(self, error: str) -> None:
+        with self._lock:
+            self.status = FAILED
+            self.error = error
+            self.finished_at = time.time()
+            self._save()
+            self._notify()
+
+    async def wait_for_update(self, seen: int, timeout: Optional[float] = None) -> None:
+        """Wait until more than ``seen`` masks exist or the job finishes"""
+        if self.remote:
+            await self._poll(seen, timeout)
+            return
+        event = asyncio.Event()
+        with self._lock:
+            if len(self.masks) > seen or self.finished:
+                return
+            self._waiters.append((asyncio.get_running_loop(), event))
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _poll(self, seen: int, timeout: Optional[float]) -> None:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout if timeout is not None else None
+        while len(self.masks) <= seen and not self.finished:
+            if deadline is not None and loop.time() >= deadline:
+                return
+            await asyncio.sleep(POLL_INTERVAL)
+            self.refresh()
+
+    def summary(self, since: int = 0) -> Dict[str, Any]:
+        """Status, progress and the masks produced after index ``since``"""
+        with self._lock:
+            masks = self.masks[since:]
+            ready = len(self.masks)
+        return {
+            "job_id": self.id,
+            "image_id": self.image_id,
+            "status": self.status,
+            "error": self.error,
+            "mask_format": self.mask_format,
+            "progress": {
+                "masks_ready": ready,
+                "total": self.total,
+            },
+            "since": since,
+            "masks": masks,
+        }
+
+    async def events(self, start: int = 0, keepalive: float = 15.0) -> AsyncIterator[str]:
+        """Yield Server-Sent Events: one ``mask`` event per mask, then ``done`` or ``error``"""
+        sent = start
+        yield _sse("status", {"status": self.status, "masks_ready": len(self.masks)})
+        while True:
+            with self._lock:
+                pending = self.masks[sent:]
+                finished = self.finished
+            for mask in pending:
+                yield _sse("mask", mask, event_id=sent)
+                sent += 1
+            if finished and sent >= len(self.masks):
+                if self.status == FAILED:
+                    yield _sse("error", {"status": self.status, "error": self.error})
+                else:
+                    yield _sse("done", {"status": self.status, "mask_count": sent})
+                return
+            before = sent
+            await self.wait_for_update(sent, timeout=keepalive)
+            if sent == before and len(self.masks) == sent and not self.finished:
+                # Comment line keeps proxies from closing an idle stream
+                yield ": keepalive\n\n"
+
+
+def _sse(event: str, data: Any, event_id: Optional[int] = None) -> str:
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, separators=(',', ':'))}")
+    return "\n".join(lines) + "\n\n"
+
+
+class JobManager:
+    """Registry of jobs, dropping the oldest finished ones beyond ``max_jobs``.
+
+    With a shared ``state`` backend jobs are written through and expire from
+    it ``ttl`` seconds after their last update; jobs run by other processes
+    are loaded from it.
+    """
+
+    def __init__(self, max_jobs: int = 256, state: Optional[StateBackend] = None, ttl: Optional[float] = 3600):
+        self.max_jobs = max_jobs
+        self.state = state
+        self.ttl = ttl
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+
+    def create(self, image_id: str, mask_format: str) -> Job:
+        job = Job(image_id, mask_format, self.state, self.ttl)
+        self._jobs[job.id] = job
+        self._prune()
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        job = self._jobs.get(job_id)
+        if job is None and self.state is not None:
+            job = Job.load(self.state, job_id)
+        return job
+
+    def _prune(self) -> None:
+        excess = len(self._jobs) - self.max_jobs
+        if excess <= 0:
+            return
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.finished][:excess]:
+            del self._jobs[job_id]
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    def stats(self) -> Dict[str, int]:
+        counts = {QUEUED: 0, RUNNING: 0, COMPLETED: 0, FAILED: 0}
+        for job in self._jobs.values():
+            counts[job.status] += 1
+        return counts
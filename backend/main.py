@@ -1,21 +1,52 @@
 import os
 import uuid
+import asyncio
 import base64
-from typing import List, Dict, Any, Optional
+import hashlib
+import json
+import logging
+import zipfile
+from contextlib import asynccontextmanager
+from typing import List, Dict, Any, Optional, Tuple
 from pathlib import Path
 import aiofiles
 import httpx
-from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks
+from fastapi import FastAPI, File, Form, UploadFile, HTTPException, BackgroundTasks, Depends, Request, Response, Query, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
-from pydantic import BaseModel
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from mask_codec import encode_mask, encode_mask_crop, negotiate_mask_format
+from mask_store import MaskStore, StoredMask, ImageRecord, pack_masks
+from backends import create_backend, box_mask
+from batching import MicroBatcher
+from array_cache import ArrayCache
+from workers import WorkerPool, PoolOverloaded
+from jobs import Job, JobManager
+from janitor import sweep_uploads
+from compositing import MAX_LAYERS, composite_masks, parse_color
+from render_cache import RenderCache
+from batch import ZipStream, list_archive_images, extract_archive_member
+from sessions import SessionManager, mask_diff
+from state import HashRing, SharedValues, create_state
+from dedupe import DEDUPE_MODES, UploadIndex, perceptual_hash
+from hit_index import HitIndex
+from image_codec import (CONTAINERS, OUTPUT_FORMATS, SNIFF_BYTES, UPLOAD_EXTENSIONS, container_of, decode_image,
+                         encode_image, extension_for, media_type)
+from postprocess import clean_mask, is_duplicate, postprocess_masks
+from tiles import intersects, mask_tile, parse_region, tile_size
+from resampling import UPSAMPLING_METHODS, to_working_points, upsample_mask, upsample_region, working_size
+from video import VIDEO_EXTENSIONS, MaskWriter, probe_video, sniff_video, track_video
+from responses import EncodedResponse, encode_body, negotiate_encoding
+from metrics import MetricsMiddleware, counter, gauge, record_stages, registry, stage, timed_call
+
+logger = logging.getLogger("sam2")
 # Try to import modal, fallback to mock if not available
 try:
     import modal
     MODAL_AVAILABLE = True
 except ImportError:
     MODAL_AVAILABLE = False
-    print("Warning: Modal not available, using mock mask generation")
+    logger.warning("Modal not available, using mock mask generation")
     modal = None
 
 from PIL import Image
@@ -26,27 +57,188 @@ try:
     CV2_AVAILABLE = True
 except ImportError:
     CV2_AVAILABLE = False
-    print("Warning: OpenCV not available, using PIL fallback")
+    logger.warning("OpenCV not available, using PIL fallback")
 import io
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+# Leveled logging; hot-path messages are DEBUG and cost nothing above that level
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+)
+
 # Initialize Modal client (only if available)
 if MODAL_AVAILABLE:
     stub = modal.App("sam2-building-app")
 else:
     stub = None
 
-# Create uploads directory
-UPLOADS_DIR = Path("uploads")
-UPLOADS_DIR.mkdir(exist_ok=True)
+# Segmentation backend, selected once at startup
+segmentation_backend = create_backend(os.getenv("SEGMENTATION_BACKEND", "mock"))
+logger.info("Using segmentation backend: %s", segmentation_backend.name)
+
+# CPU-bound stages run here so the event loop stays responsive
+worker_pool = WorkerPool(
+    kind=os.getenv("WORKER_POOL", "thread"),
+    max_workers=int(os.getenv("WORKER_COUNT", "0")) or None,
+    max_queue=int(os.getenv("WORKER_QUEUE_DEPTH", "32"))
+)
+
+# Concurrent point prompts are grouped into a single backend call
+predict_batcher = MicroBatcher(
+    segmentation_backend.predict_batch,
+    max_batch_size=int(os.getenv("BATCH_MAX_SIZE", "8")),
+    max_wait_ms=float(os.getenv("BATCH_MAX_WAIT_MS", "5")),
+    runner=worker_pool.run
+)
+
+# Create uploads directory; spill stores, caches and renders live under it too
+UPLOADS_DIR = Path(os.getenv("UPLOADS_DIR", "uploads"))
+UPLOADS_DIR.mkdir(parents=True, exist_ok=True)
+
+# Upload limits
+MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE", str(10 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Batch limits: images per request, archive size and images in flight at once
+BATCH_MAX_IMAGES = int(os.getenv("BATCH_MAX_IMAGES", "500"))
+BATCH_MAX_ARCHIVE_SIZE = int(os.getenv("BATCH_MAX_ARCHIVE_SIZE", str(1024 * 1024 * 1024)))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "0")) or worker_pool.max_workers
+BATCH_OVERLOAD_RETRIES = 3
+
+# STORAGE_MODE=mmap writes decoded images and packed masks as .npy files under
+# uploads/images and uploads/masks and serves them from read-only memory maps,
+# so the OS page cache rather than the heap holds idle sessions
+STORAGE_MODE = os.getenv("STORAGE_MODE", "memory").lower()
+if STORAGE_MODE not in ("memory", "mmap"):
+    raise ValueError("STORAGE_MODE must be one of: memory, mmap")
+MMAP_STORAGE = STORAGE_MODE == "mmap"
+
+# Encoded image state reused by every point prompt on the same image
+embedding_cache = ArrayCache(
+    max_bytes=int(os.getenv("EMBEDDING_CACHE_BYTES", str(256 * 1024 * 1024))),
+    spill_dir=UPLOADS_DIR / "embeddings" if os.getenv("EMBEDDING_CACHE_SPILL", "false").lower() == "true" else None
+)
+
+# Decoded RGB images shared by segmentation, prompts and coloring
+image_cache = ArrayCache(
+    max_bytes=int(os.getenv("IMAGE_CACHE_BYTES", str(512 * 1024 * 1024))),
+    spill_dir=UPLOADS_DIR / "images" if MMAP_STORAGE else None,
+    mmap=MMAP_STORAGE
+)
+
+# Segmentation and mask storage run on a copy whose longest side is at most
+# WORKING_MAX_SIDE (0 keeps the original size); masks are upsampled only when
+# a full-resolution output needs them
+WORKING_MAX_SIDE = int(os.getenv("WORKING_MAX_SIDE", "1024"))
+MASK_UPSAMPLING = os.getenv("MASK_UPSAMPLING", "nearest")
+if MASK_UPSAMPLING not in UPSAMPLING_METHODS:
+    raise ValueError(f"MASK_UPSAMPLING must be one of: {', '.join(UPSAMPLING_METHODS)}")
+
+# Optional clean-up of generated masks at the working resolution (0 disables
+# each step): drop components and fill holes smaller than the given pixel
+# areas, and suppress masks overlapping a better one by at least POSTPROCESS_NMS_IOU
+POSTPROCESS_MIN_COMPONENT_AREA = int(os.getenv("POSTPROCESS_MIN_COMPONENT_AREA", "0"))
+POSTPROCESS_MAX_HOLE_AREA = int(os.getenv("POSTPROCESS_MAX_HOLE_AREA", "0"))
+POSTPROCESS_NMS_IOU = float(os.getenv("POSTPROCESS_NMS_IOU", "0"))
+
+# STATE_BACKEND=memory keeps masks, jobs, refinement sessions, latest renders
+# and upload aliases in this process; sqlite (in uploads/store) and redis (at
+# REDIS_URL) share them between worker processes and replicas, which must
+# then also share UPLOADS_DIR
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory").lower()
+MASK_STORE_TTL_SECONDS = float(os.getenv("MASK_STORE_TTL_SECONDS", "86400")) or None
+shared_state = create_state(STATE_BACKEND, UPLOADS_DIR / "store", os.getenv("REDIS_URL"), MASK_STORE_TTL_SECONDS)
+
+# Uploads and rendered outputs older than this are removed by the janitor
+UPLOAD_TTL_SECONDS = float(os.getenv("UPLOAD_TTL_SECONDS", "86400"))
+JANITOR_INTERVAL_SECONDS = float(os.getenv("JANITOR_INTERVAL_SECONDS", "300"))
+
+# UPLOAD_DEDUPE=exact maps uploads byte-identical to an earlier one onto it, so
+# they share its masks, embedding, decoded copy and renders; perceptual also
+# matches same-size re-encodes within UPLOAD_DEDUPE_DISTANCE dHash bits
+UPLOAD_DEDUPE = os.getenv("UPLOAD_DEDUPE", "off").lower()
+if UPLOAD_DEDUPE not in DEDUPE_MODES:
+    raise ValueError(f"UPLOAD_DEDUPE must be one of: {', '.join(DEDUPE_MODES)}")
+upload_index = UploadIndex(
+    max_distance=int(os.getenv("UPLOAD_DEDUPE_DISTANCE", "4")),
+    state=shared_state if UPLOAD_DEDUPE != "off" else None,
+    ttl=UPLOAD_TTL_SECONDS
+)
+
+# Original (width, height) of each decoded upload
+image_sizes: Dict[str, Tuple[int, int]] = {}
+# Upload file of each image id, named with the extension of its sniffed container
+upload_paths: Dict[str, Path] = {}
+
+# Rendered outputs, content-addressed by image, masks, colors and format
+render_cache = RenderCache(
+    UPLOADS_DIR / "renders",
+    max_bytes=int(os.getenv("RENDER_CACHE_BYTES", str(512 * 1024 * 1024)))
+)
+# Format and JPEG/WebP quality of renders whose request doesn't choose them
+RENDER_FORMAT = os.getenv("RENDER_FORMAT", "jpeg").lower()
+if RENDER_FORMAT not in OUTPUT_FORMATS:
+    raise ValueError(f"RENDER_FORMAT must be one of: {', '.join(OUTPUT_FORMATS)}")
+RENDER_QUALITY = int(os.getenv("RENDER_QUALITY", "85"))
+RENDER_EXTENSIONS = [CONTAINERS[output_format][0] for output_format in OUTPUT_FORMATS]
+# Most recent render key per image, served by /download without ?render=
+latest_renders = SharedValues(shared_state, "latest-render:", UPLOAD_TTL_SECONDS)
+# Renders in progress, so identical concurrent requests share one
+pending_renders: Dict[str, asyncio.Future] = {}
+
+# Stored masks: bounded by bytes and idle time. Without a shared state backend,
+# evicted records spill to disk in this process
+image_store = MaskStore(
+    max_bytes=int(os.getenv("MASK_STORE_BYTES", str(256 * 1024 * 1024))),
+    ttl=MASK_STORE_TTL_SECONDS,
+    spill_dir=UPLOADS_DIR / "store"
+    if STATE_BACKEND == "memory" and os.getenv("MASK_STORE_SPILL", "true").lower() == "true" else None,
+    state=shared_state,
+    mmap_dir=UPLOADS_DIR / "masks" if MMAP_STORAGE else None,
+    recheck=float(os.getenv("MASK_STORE_RECHECK_SECONDS", "0"))
+)
+
+# Replica names for consistent-hash routing hints; any replica can serve any
+# image with shared state, but the owner has its image and embedding warm
+STATE_NODES = [node.strip() for node in os.getenv("STATE_NODES", "").split(",") if node.strip()]
+route_ring = HashRing(STATE_NODES)
+
+# Videos and frame sequences: upload size, frames tracked per prompt and
+# decoded frames buffered ahead of propagation
+VIDEO_MAX_FILE_SIZE = int(os.getenv("VIDEO_MAX_FILE_SIZE", str(512 * 1024 * 1024)))
+VIDEO_MAX_FRAMES = int(os.getenv("VIDEO_MAX_FRAMES", "3000"))
+VIDEO_PREFETCH_FRAMES = int(os.getenv("VIDEO_PREFETCH_FRAMES", "8"))
+# Propagation jobs run for the whole video on their own threads, so they never
+# hold the stage workers that uploads and clicks are waiting for
+video_pool = WorkerPool(
+    kind="thread",
+    max_workers=int(os.getenv("VIDEO_WORKERS", "2")),
+    max_queue=int(os.getenv("VIDEO_QUEUE_DEPTH", "0"))
+)
+# Path, frame count, size and frame rate of each uploaded video
+videos: Dict[str, Dict[str, Any]] = {}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    janitor = asyncio.create_task(run_janitor()) if JANITOR_INTERVAL_SECONDS > 0 else None
+    yield
+    if janitor is not None:
+        janitor.cancel()
+    worker_pool.shutdown()
+    video_pool.shutdown()
+    # Persist in-memory masks so a restarted instance can reload them
+    image_store.spill_all()
+    image_store.close()
 
 app = FastAPI(
     title="SAM2 Building Segmentation API",
     description="API for interactive building segmentation and coloring using SAM2",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # CORS middleware
@@ -63,6 +255,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Request latency, body sizes and, when SERVER_TIMING is on, per-stage Server-Timing headers
+app.add_middleware(MetricsMiddleware, server_timing=os.getenv("SERVER_TIMING", "false").lower() == "true")
+
+@app.exception_handler(PoolOverloaded)
+async def pool_overloaded_handler(request: Request, exc: PoolOverloaded):
+    """Shed load with 503 instead of queueing without bound"""
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+
 # Pydantic models
 class Point(BaseModel):
     x: int
@@ -72,380 +277,1287 @@ class MaskRequest(BaseModel):
     image_id: str
     points: List[Point]
     labels: List[int]  # 1 for foreground, 0 for background
+    session_id: Optional[str] = None  # Refinement session; points are then only the new clicks
+    reset: bool = False  # Clear the session's earlier clicks first
 
 class ColorRequest(BaseModel):
     image_id: str
     mask_ids: List[str]
-    color: str  # Hex color code
+    color: str  # Hex color code, #RRGGBB or #RRGGBBAA
+    colors: Optional[Dict[str, str]] = None  # Per-mask hex colors overriding `color`
+    alpha: float = Field(1.0, ge=0.0, le=1.0)  # Opacity applied to every color
+    format: Optional[str] = Field(None, pattern="^(jpeg|png|webp)$")  # Output format, RENDER_FORMAT by default
+    quality: Optional[int] = Field(None, ge=1, le=100)  # JPEG/WebP quality, RENDER_QUALITY by default
 
-class GenerateMasksRequest(BaseModel):
+class HitTestRequest(BaseModel):
     image_id: str
+    point: Optional[Point] = None  # Masks under a click
+    rect: Optional[List[int]] = Field(None, min_length=4, max_length=4)  # [x, y, width, height]
+    lasso: Optional[List[Point]] = Field(None, min_length=3)  # Polygon vertices
 
-class ImageData(BaseModel):
+class GenerateMasksRequest(BaseModel):
     image_id: str
-    masks: List[Dict[str, Any]]
-    original_image: str
-
-# In-memory storage (in production, use a proper database)
-image_store: Dict[str, ImageData] = {}
-
-def generate_mock_masks(image_data: bytes) -> List[Dict[str, Any]]:
-    """Generate mock masks for testing without Modal"""
-    from PIL import Image
-    import io
-    
-    # Load image to get dimensions
-    image = Image.open(io.BytesIO(image_data))
-    width, height = image.size
-    
-    # Create multiple smaller masks instead of one large mask
-    masks = []
-    mask_size = min(width, height) // 8
-    quadrants = [
-        (width // 4, height // 4),
-        (3 * width // 4, height // 4),
-        (width // 4, 3 * height // 4),
-        (3 * width // 4, 3 * height // 4)
-    ]
-    
-    for i, (center_x, center_y) in enumerate(quadrants):
-        # Create a simple mock mask
-        mock_mask = [[False for _ in range(width)] for _ in range(height)]
-        
-        # Create a circular mask around the center point
-        for y in range(max(0, center_y - mask_size), min(height, center_y + mask_size)):
-            for x in range(max(0, center_x - mask_size), min(width, center_x + mask_size)):
-                if (x - center_x) ** 2 + (y - center_y) ** 2 <= mask_size ** 2:
-                    mock_mask[y][x] = True
-        
-        # Calculate bounding box
-        bbox_x = max(0, center_x - mask_size)
-        bbox_y = max(0, center_y - mask_size)
-        bbox_width = min(width - bbox_x, 2 * mask_size)
-        bbox_height = min(height - bbox_y, 2 * mask_size)
-        
-        masks.append({
-            "id": str(i),
-            "segmentation": mock_mask,
-            "area": bbox_width * bbox_height,
-            "bbox": [bbox_x, bbox_y, bbox_width, bbox_height],
-            "predicted_iou": 0.9,
-            "point_coords": [[center_x, center_y]],
-            "stability_score": 0.95
-        })
-    
-    return masks
 
-def get_mock_mask_for_points(image_data: bytes, points: List[List[int]], labels: List[int]) -> Dict[str, Any]:
-    """Generate mock mask for specific points"""
-    from PIL import Image
-    import io
-    
-    # Load image to get dimensions
-    image = Image.open(io.BytesIO(image_data))
-    width, height = image.size
-    
-    # Create a simple mock mask for the requested point
-    mock_mask = [[False for _ in range(width)] for _ in range(height)]
-    
-    # Create a circular mask around the first point
-    if points:
-        center_x, center_y = points[0]
-        mask_size = min(width, height) // 16
-        
-        for y in range(max(0, center_y - mask_size), min(height, center_y + mask_size)):
-            for x in range(max(0, center_x - mask_size), min(width, center_x + mask_size)):
-                if (x - center_x) ** 2 + (y - center_y) ** 2 <= mask_size ** 2:
-                    mock_mask[y][x] = True
-    
-    return {
-        "segmentation": mock_mask,
-        "score": 0.9
-    }
+class VideoPromptRequest(BaseModel):
+    frame_index: int = Field(0, ge=0)  # Frame the points are on; masks propagate from it to later frames
+    points: List[Point] = Field(..., min_length=1)
+    labels: List[int]  # 1 for foreground, 0 for background
+    max_frames: Optional[int] = Field(None, ge=1)  # Frames to track, the prompted one included; VIDEO_MAX_FRAMES at most
 
-def generate_masks_modal(image_data: bytes) -> List[Dict[str, Any]]:
-    """Generate masks using SAM2 on Modal GPU (or mock if Modal unavailable)"""
-    if not MODAL_AVAILABLE:
-        # Return mock masks if Modal is not available
-        return generate_mock_masks(image_data)
-    
-    # Original Modal implementation would go here
-    # For now, return mock masks
-    return generate_mock_masks(image_data)
+class BatchSpec(BaseModel):
+    color: str = "#ff0000"  # Hex color code, #RRGGBB or #RRGGBBAA
+    colors: Optional[Dict[str, str]] = None  # Per-mask hex colors overriding `color`
+    alpha: float = Field(1.0, ge=0.0, le=1.0)
+    mask_ids: Optional[List[str]] = None  # Masks to color in every image; all masks when omitted
+    include_masks: bool = False  # Add serialized masks to NDJSON results
+    format: Optional[str] = Field(None, pattern="^(jpeg|png|webp)$")  # Output format, RENDER_FORMAT by default
+    quality: Optional[int] = Field(None, ge=1, le=100)  # JPEG/WebP quality, RENDER_QUALITY by default
+
+# Asynchronous mask-generation jobs; with shared state, finished jobs and
+# their masks stay readable from any worker for JOB_TTL_SECONDS
+job_manager = JobManager(
+    max_jobs=int(os.getenv("MAX_JOBS", "256")),
+    state=shared_state,
+    ttl=float(os.getenv("JOB_TTL_SECONDS", "3600")) or None
+)
+
+# Click history and last mask of interactive /get-mask sessions
+refinement_sessions = SessionManager(
+    max_sessions=int(os.getenv("MAX_REFINEMENT_SESSIONS", "1024")),
+    ttl=float(os.getenv("REFINEMENT_SESSION_TTL_SECONDS", "1800")) or None,
+    state=shared_state
+)
+
+def get_mask_format(request: Request, response: Response, mask_format: Optional[str] = None) -> str:
+    """Negotiate the mask wire format from the mask_format query parameter or Accept header"""
+    try:
+        selected = negotiate_mask_format(mask_format, request.headers.get("accept"))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    response.headers["X-Mask-Format"] = selected
+    response.headers["Vary"] = "Accept"
+    return selected
+
+def get_response_encoding(request: Request, response: Response) -> str:
+    """Negotiate the response body encoding: MessagePack when accepted and available, else JSON"""
+    response.headers["Vary"] = "Accept"
+    return negotiate_encoding(request.headers.get("accept"))
+
+def get_mask_resolution(mask_resolution: str = "working") -> str:
+    """Validate the mask_resolution query parameter: working or original"""
+    if mask_resolution not in ("working", "original"):
+        raise HTTPException(status_code=400, detail="mask_resolution must be 'working' or 'original'")
+    return mask_resolution
 
-def get_mask_for_points_modal(image_data: bytes, points: List[List[int]], labels: List[int]) -> Dict[str, Any]:
-    """Get mask for specific points using SAM2 (or mock if Modal unavailable)"""
-    if not MODAL_AVAILABLE:
-        # Return mock mask if Modal is not available
-        return get_mock_mask_for_points(image_data, points, labels)
+def serialize_mask(mask: StoredMask, mask_format: str, record: Optional[ImageRecord] = None,
+                   resolution: str = "working") -> Dict[str, Any]:
+    """Return a stored mask's metadata with its segmentation in the requested wire format.
+
+    Metadata is always in original image coordinates. The segmentation stays
+    at the working resolution unless ``resolution`` is ``"original"``.
+    """
+    if record is None:
+        serialized = mask.metadata()
+    else:
+        serialized = record.mask_metadata(mask)
     
-    # Original Modal implementation would go here
-    # For now, return mock mask
-    return get_mock_mask_for_points(image_data, points, labels)
+    # Encode from the bbox crop so RLE never materializes the full frame
+    if record is not None and resolution == "original" and record.scale != (1, 1):
+        x, y, crop = upsample_region(mask.crop(), mask.bbox, *record.scale, record.width, record.height, MASK_UPSAMPLING)
+        serialized["segmentation"] = encode_mask_crop(crop, x, y, record.height, record.width, mask_format)
+    else:
+        x, y = mask.bbox[:2]
+        serialized["segmentation"] = encode_mask_crop(mask.crop(), x, y, mask.height, mask.width, mask_format)
+    return serialized
+
+def serialize_masks(record: ImageRecord, mask_format: str, resolution: str = "working") -> List[Dict[str, Any]]:
+    return [serialize_mask(mask, mask_format, record, resolution) for mask in record.masks]
+
+# Worker stages: module-level so they can run in a thread or process pool
+
+def decode_image_file(image_path: Path, max_side: int = 0) -> Tuple[np.ndarray, Tuple[int, int]]:
+    """Decode an image file into a read-only RGB uint8 array at most ``max_side`` pixels on its longest side.
+
+    Returns the array and the original ``(width, height)``.
+    """
+    with stage("read"):
+        data = image_path.read_bytes()
+    with stage("decode"):
+        # JPEGs decode straight at a reduced scale when a working copy is enough
+        image, original_size = decode_image(data, max_side)
+    image.flags.writeable = False
+    return image, original_size
+
+def transcode_file(path: Path, output_format: str, quality: int) -> bytes:
+    """Re-encode an image file in another format or quality"""
+    with stage("read"):
+        data = path.read_bytes()
+    with stage("decode"):
+        image, _ = decode_image(data)
+    with stage("encode"):
+        return encode_image(image, output_format, quality)
+
+def postprocess(masks: List[StoredMask]) -> List[StoredMask]:
+    """Apply the configured mask clean-up to freshly packed masks"""
+    return postprocess_masks(masks, POSTPROCESS_MIN_COMPONENT_AREA, POSTPROCESS_MAX_HOLE_AREA, POSTPROCESS_NMS_IOU)
+
+def segment_image(image_id: str, image: np.ndarray, original_size: Tuple[int, int], with_embedding: bool) -> tuple:
+    """Generate and pack masks at the working resolution, optionally encoding the image too"""
+    height, width = image.shape[:2]
+    masks = segmentation_backend.generate_all(image)
+    embedding = segmentation_backend.encode(image) if with_embedding else None
+    return ImageRecord(image_id, *original_size, postprocess(pack_masks(masks)), width, height), embedding
+
+def segment_images(requests: List[tuple]) -> List[tuple]:
+    """Segment several images with one backend call; each request holds segment_image's arguments"""
+    all_masks = segmentation_backend.generate_batch([image for _, image, _, _ in requests])
+    results = []
+    for (image_id, image, original_size, with_embedding), masks in zip(requests, all_masks):
+        height, width = image.shape[:2]
+        embedding = segmentation_backend.encode(image) if with_embedding else None
+        results.append((ImageRecord(image_id, *original_size, postprocess(pack_masks(masks)), width, height), embedding))
+    return results
+
+# Images segmented concurrently by batch requests share backend calls
+segment_batcher = MicroBatcher(
+    segment_images,
+    max_batch_size=int(os.getenv("BATCH_MAX_SIZE", "8")),
+    max_wait_ms=float(os.getenv("BATCH_MAX_WAIT_MS", "5")),
+    runner=worker_pool.run
+)
+
+def stream_segment_image(job: Job, image_id: str, image: np.ndarray, original_size: Tuple[int, int],
+                         with_embedding: bool) -> tuple:
+    """Like segment_image, but publish each mask to the job as soon as it is packed.
+
+    Masks cannot be ranked before they have all arrived, so duplicates are
+    suppressed first come, first kept.
+    """
+    height, width = image.shape[:2]
+    record = ImageRecord(image_id, *original_size, [], width, height)
+    job.start()
+    crops: Dict[str, np.ndarray] = {}
+    for mask in segmentation_backend.iter_masks(image):
+        stored = clean_mask(pack_masks([mask])[0], POSTPROCESS_MIN_COMPONENT_AREA, POSTPROCESS_MAX_HOLE_AREA)
+        if not stored.area or (POSTPROCESS_NMS_IOU > 0
+                               and is_duplicate(stored, record.masks, POSTPROCESS_NMS_IOU, crops)):
+            continue
+        record.add_mask(stored)
+        job.add_mask(serialize_mask(stored, job.mask_format, record))
+    embedding = segmentation_backend.encode(image) if with_embedding else None
+    return record, embedding
+
+def upsample_prompt_mask(segmentation: np.ndarray, record: ImageRecord, mask_format: str, resolution: str) -> Any:
+    """Encode a working-resolution prompt mask, upsampling it first if asked to"""
+    if resolution == "original" and record.scale != (1, 1):
+        bbox = [0, 0, record.working_width, record.working_height]
+        segmentation = upsample_mask(segmentation, bbox, *record.scale, record.width, record.height, MASK_UPSAMPLING)
+    return encode_mask(segmentation, mask_format)
+
+def refine_diff(previous: Optional[StoredMask], segmentation: np.ndarray, record: ImageRecord, mask_format: str,
+                resolution: str) -> Tuple[StoredMask, Dict[str, Any]]:
+    """Pack a refined working-resolution mask and diff it against the previous one, in original pixels if asked to.
+
+    The session keeps its mask at the working resolution either way.
+    """
+    stored, diff = mask_diff(previous, segmentation, mask_format)
+    if resolution != "original" or record.scale == (1, 1):
+        return stored, diff
+
+    def upsampled(mask: StoredMask) -> np.ndarray:
+        if not mask.area:
+            return np.zeros((record.height, record.width), dtype=bool)
+        return upsample_mask(mask.crop(), mask.bbox, *record.scale, record.width, record.height, MASK_UPSAMPLING)
+
+    full_previous = StoredMask.from_array("previous", upsampled(previous)) if previous is not None else None
+    _, diff = mask_diff(full_previous, upsampled(stored), mask_format)
+    return stored, diff
+
+def serialize_tile(mask: StoredMask, scale_xy: Tuple[float, float], region: Tuple[int, int, int, int],
+                   scale: float, mask_format: str) -> Any:
+    """Cut a viewport tile from a stored mask and encode it"""
+    return encode_mask(mask_tile(mask, scale_xy, region, scale), mask_format)
+
+def image_tag(image_id: str) -> str:
+    """First half of every render key of an image, so a key shows which image it was rendered from"""
+    return hashlib.blake2b(image_id.encode(), digest_size=8).hexdigest()
+
+def render_key(record: ImageRecord, layers: List[tuple], output_format: str, quality: int) -> str:
+    """Content address of a render: the image's tag, then a digest of everything that determines its bytes"""
+    digest = hashlib.sha256(
+        f"{record.image_id}:{record.width}x{record.height}:{output_format}:{quality}:{MASK_UPSAMPLING}".encode()
+    )
+    for mask, color in layers:
+        digest.update(json.dumps([mask.bbox, color]).encode())
+        digest.update(mask.bits)
+    return image_tag(record.image_id) + digest.hexdigest()[:16]
+
+def render_colored_image(image: np.ndarray, record: ImageRecord, layers: List[tuple], output_format: str,
+                         quality: int) -> bytes:
+    """Blend (mask, rgba) layers over the full-resolution image in one pass and encode the result"""
+    with stage("composite"):
+        colored_image = composite_masks(image, layers, record.scale, MASK_UPSAMPLING)
+    with stage("encode"):
+        return encode_image(colored_image, output_format, quality)
+
+def write_file(path: Path, data: bytes) -> None:
+    path.write_bytes(data)
+
+async def run_stage(name: Optional[str], func, *args) -> Any:
+    """Run ``func(*args)`` on the worker pool, recording it as stage ``name``.
+
+    With ``name=None`` the stages ``func`` marks itself are recorded instead.
+    """
+    timings, result = await worker_pool.run(timed_call, name, func, *args)
+    record_stages(timings)
+    return result
+
+async def respond(response: Response, content: Dict[str, Any], encoding: str) -> EncodedResponse:
+    """Serialize a mask payload straight to bytes on the worker pool, keeping negotiated headers"""
+    body = await run_stage("serialize", encode_body, content, encoding)
+    return EncodedResponse(body, headers=dict(response.headers))
+
+async def get_hit_index(record: ImageRecord) -> HitIndex:
+    """Return the record's selection index, building it on first use"""
+    if record.hit_index is None:
+        record.hit_index = await run_stage(
+            "segment", HitIndex.build, record.masks, record.working_width, record.working_height
+        )
+    return record.hit_index
+
+async def warm_hit_index(record: ImageRecord) -> None:
+    """Build the selection index right after segmentation, ahead of the first click"""
+    try:
+        await get_hit_index(record)
+    except PoolOverloaded:
+        # The first hit test builds it instead
+        pass
+
+def upload_path(image_id: str) -> Optional[Path]:
+    """The upload file of an image id, or None; uploads from other workers are found by extension"""
+    path = upload_paths.get(image_id)
+    if path is not None and path.exists():
+        return path
+    for extension in UPLOAD_EXTENSIONS:
+        path = UPLOADS_DIR / f"{image_id}.{extension}"
+        if path.exists():
+            upload_paths[image_id] = path
+            return path
+    return None
+
+def get_record(image_id: str) -> Optional[ImageRecord]:
+    """Stored masks for an image id, shared with the other uploads of the same image"""
+    return image_store.get(upload_index.resolve(image_id))
+
+async def load_image(image_id: str) -> np.ndarray:
+    """Return the decoded image, decoding the upload only on a cache miss.
+
+    Cached under the canonical id; decoded from this id's own upload, which
+    outlives the canonical one when the uploads were not hard-linked.
+    """
+    canonical = upload_index.resolve(image_id)
+    image = image_cache.get(canonical)
+    if image is None or canonical not in image_sizes:
+        path = upload_path(image_id)
+        if path is None:
+            raise HTTPException(status_code=404, detail="Image not found")
+        image, image_sizes[canonical] = await run_stage(None, decode_image_file, path, WORKING_MAX_SIDE)
+        image_cache.put(canonical, image)
+    return image
+
+async def load_full_image(image_id: str) -> np.ndarray:
+    """Return the image at its original resolution, for rendering outputs"""
+    image = await load_image(image_id)
+    if image.shape[1::-1] == image_sizes[upload_index.resolve(image_id)]:
+        return image
+    path = upload_path(image_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    full_image, _ = await run_stage(None, decode_image_file, path)
+    return full_image
+
+async def load_embedding(image_id: str) -> np.ndarray:
+    """Return the cached encoded state for an image, encoding it on a miss"""
+    canonical = upload_index.resolve(image_id)
+    embedding = embedding_cache.get(canonical)
+    if embedding is None:
+        image = await load_image(image_id)
+        embedding = await run_stage("segment", segmentation_backend.encode, image)
+        embedding_cache.put(canonical, embedding)
+    return embedding
+
+def forget_image(image_id: str) -> None:
+    """Drop cached state for an image whose masks or upload have expired"""
+    image_cache.discard(image_id)
+    embedding_cache.discard(image_id)
+    image_sizes.pop(image_id, None)
+    latest_renders.pop(image_id, None)
+    upload_paths.pop(image_id, None)
+    videos.pop(image_id, None)
+    refinement_sessions.discard(image_id)
+
+async def clean_up_expired() -> None:
+    """Expire idle mask records, then remove stale uploads and rendered outputs"""
+    refinement_sessions.expire()
+    if shared_state is not None:
+        shared_state.purge_values()
+    expired = image_store.expire()
+    live = set(image_store)
+    live |= upload_index.referring(live)
+    removed = await worker_pool.run(sweep_uploads, UPLOADS_DIR, UPLOAD_TTL_SECONDS, live)
+    if MMAP_STORAGE:
+        # Mapped files outlive the process that wrote them
+        for directory in (UPLOADS_DIR / "images", UPLOADS_DIR / "masks"):
+            await worker_pool.run(sweep_uploads, directory, UPLOAD_TTL_SECONDS, live)
+    for image_id in set(expired) | set(removed):
+        forget_image(image_id)
+    # State shared by deduplicated uploads goes with the last of them
+    for image_id in removed:
+        for canonical in upload_index.release(image_id):
+            forget_image(canonical)
+    if expired or removed:
+        logger.info("Janitor expired %d mask records and %d uploads", len(expired), len(removed))
+
+async def run_janitor() -> None:
+    """Run clean_up_expired every JANITOR_INTERVAL_SECONDS"""
+    while True:
+        await asyncio.sleep(JANITOR_INTERVAL_SECONDS)
+        try:
+            await clean_up_expired()
+        except PoolOverloaded:
+            # Busy; try again next round
+            pass
+        except Exception:
+            logger.exception("Janitor failed")
+
+async def warm_image(image_id: str) -> None:
+    """Decode and encode an uploaded image ahead of its first use"""
+    try:
+        await load_embedding(image_id)
+    except PoolOverloaded:
+        # Leave it to the first request that needs it
+        pass
+
+async def save_upload(file: UploadFile, path: Path, max_size: int, digest=None) -> int:
+    """Stream an upload to disk in chunks, enforcing the size limit as we go, feeding ``digest`` if given"""
+    size = 0
+    with stage("read"):
+        async with aiofiles.open(path, "wb") as f:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_size:
+                    break
+                if digest is not None:
+                    digest.update(chunk)
+                await f.write(chunk)
+    if size > max_size:
+        path.unlink(missing_ok=True)
+        raise HTTPException(status_code=413, detail=f"{file.filename or 'File'} exceeds the {max_size} byte limit")
+    return size
+
+def finalize_upload(image_id: str, path: Path) -> Path:
+    """Rename a saved upload to ``{image_id}.{extension}`` of the container its bytes start with"""
+    with open(path, "rb") as f:
+        header = f.read(SNIFF_BYTES)
+    final_path = UPLOADS_DIR / f"{image_id}.{extension_for(header)}"
+    os.replace(path, final_path)
+    upload_paths[image_id] = final_path
+    return final_path
+
+def link_upload(source: Path, path: Path) -> None:
+    """Replace a byte-identical upload with a hard link to ``source``, keeping the copy if links fail"""
+    temporary = path.with_name(f"{path.name}.link")
+    try:
+        os.link(source, temporary)
+        os.replace(temporary, path)
+    except OSError:
+        temporary.unlink(missing_ok=True)
+
+async def deduplicate_upload(image_id: str, path: Path, digest: str) -> Optional[str]:
+    """Map a new upload onto a known canonical image, or register it as one; returns the canonical id if found"""
+    canonical, phash = upload_index.find_exact(digest), None
+    if canonical is None and UPLOAD_DEDUPE == "perceptual":
+        phash = await run_stage("decode", perceptual_hash, path)
+        canonical = upload_index.find_similar(phash)
+    source = upload_path(canonical) if canonical is not None else None
+    if source is None:
+        upload_index.register(image_id, digest, phash)
+        return None
+    if phash is None:
+        # Byte-identical: share the file too
+        link_upload(source, path)
+    # Fresh uploads keep the shared upload from expiring
+    os.utime(source)
+    upload_index.alias(image_id, canonical)
+    return canonical
+
+def routing_headers(image_id: str) -> Dict[str, str]:
+    """``X-Route-Hint`` naming the replica that owns an image, when replicas are configured"""
+    node = route_ring.node_for(image_id)
+    return {"X-Route-Hint": node} if node else {}
 
 @app.post("/upload-image")
-async def upload_image(file: UploadFile = File(...)):
+async def upload_image(
+    request: Request,
+    response: Response,
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    return_image: bool = True
+):
     """Upload an image and return image ID"""
-    print(f"Uploading file: {file.filename}, size: {file.size}, type: {file.content_type}")
+    logger.debug("Uploading file: %s, size: %s, type: %s", file.filename, file.size, file.content_type)
     
     if not file.content_type.startswith("image/"):
         raise HTTPException(status_code=400, detail="File must be an image")
     
+    # Reject obviously oversized bodies before copying anything
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > MAX_FILE_SIZE + 64 * 1024:
+        raise HTTPException(status_code=413, detail=f"File exceeds the {MAX_FILE_SIZE} byte limit")
+    
     # Generate unique ID
     image_id = str(uuid.uuid4())
-    print(f"Generated image ID: {image_id}")
-    
-    # Save image
-    image_path = UPLOADS_DIR / f"{image_id}.jpg"
-    async with aiofiles.open(image_path, "wb") as f:
-        content = await file.read()
-        await f.write(content)
+    digest = hashlib.sha256() if UPLOAD_DEDUPE != "off" else None
+    # Stored in the container it really is, whatever the client called it
+    size = await save_upload(file, UPLOADS_DIR / f"{image_id}.upload", MAX_FILE_SIZE, digest)
+    image_path = finalize_upload(image_id, UPLOADS_DIR / f"{image_id}.upload")
     
-    print(f"Saved image to: {image_path}, size: {len(content)} bytes")
-    
-    # Convert to base64 for frontend
-    image_base64 = base64.b64encode(content).decode("utf-8")
+    logger.debug("Saved image %s to: %s, size: %d bytes", image_id, image_path, size)
     
     response_data = {
         "image_id": image_id,
-        "message": "Image uploaded successfully",
-        "image_data": f"data:image/jpeg;base64,{image_base64}"
+        "message": "Image uploaded successfully"
     }
+    if digest is not None:
+        canonical = await deduplicate_upload(image_id, image_path, digest.hexdigest())
+        if canonical is not None:
+            logger.debug("Upload %s is a duplicate of %s", image_id, canonical)
+            response_data["duplicate"] = True
+    
+    if return_image:
+        # Echo the upload back as a data URI for clients that need it
+        async with aiofiles.open(image_path, "rb") as f:
+            image_base64 = base64.b64encode(await f.read()).decode("utf-8")
+        response_data["image_data"] = f"data:{file.content_type};base64,{image_base64}"
+    
+    # Decode and encode after responding so the first request doesn't pay for it
+    background_tasks.add_task(warm_image, image_id)
+    response.headers.update(routing_headers(image_id))
     
-    print(f"Upload response: {response_data['image_id']}")
     return response_data
 
 @app.post("/generate-masks")
-async def generate_masks(request: GenerateMasksRequest):
-    """Generate masks for the uploaded image"""
+async def generate_masks(
+    request: GenerateMasksRequest,
+    response: Response,
+    background_tasks: BackgroundTasks,
+    mask_format: str = Depends(get_mask_format),
+    encoding: str = Depends(get_response_encoding),
+    mask_resolution: str = Depends(get_mask_resolution),
+    async_job: bool = Query(False, alias="async")
+):
+    """Generate masks for the uploaded image, or start a job with ?async=true"""
     image_id = request.image_id
     
-    image_path = UPLOADS_DIR / f"{image_id}.jpg"
-    
-    if not image_path.exists():
+    if upload_path(image_id) is None:
         raise HTTPException(status_code=404, detail="Image not found")
     
-    # Read image data
-    async with aiofiles.open(image_path, "rb") as f:
-        image_data = await f.read()
+    if async_job:
+        # Answer immediately; masks are published to the job as they are produced
+        if not worker_pool.has_capacity():
+            raise PoolOverloaded()
+        job = job_manager.create(image_id, mask_format)
+        job.task = asyncio.create_task(run_generation_job(job))
+        return JSONResponse(status_code=202, content={
+            "job_id": job.id,
+            "image_id": image_id,
+            "status": job.status,
+            "status_url": f"/jobs/{job.id}",
+            "events_url": f"/jobs/{job.id}/events"
+        })
+    
+    # Another upload of the same image was already segmented: reuse its masks
+    canonical = upload_index.resolve(image_id)
+    record = image_store.get(canonical) if canonical != image_id else None
+    if record is None:
+        # Generate masks with the configured backend
+        image = await load_image(image_id)
+        record, embedding = await run_stage(
+            "segment", segment_image, canonical, image, image_sizes[canonical], canonical not in embedding_cache
+        )
+        store_segmentation(record, embedding)
+        background_tasks.add_task(warm_hit_index, record)
+    
+    return await respond(response, {
+        "image_id": image_id,
+        "masks": await run_stage("serialize", serialize_masks, record, mask_format, mask_resolution),
+        "message": f"Generated {len(record.masks)} masks"
+    }, encoding)
+
+def store_segmentation(record: ImageRecord, embedding: Optional[np.ndarray]) -> None:
+    """Keep a finished segmentation and its encoding for later requests"""
+    if embedding is not None:
+        embedding_cache.put(record.image_id, embedding)
+    
+    logger.debug("Total masks generated for %s: %d", record.image_id, len(record.masks))
     
-    # Generate masks using Modal
+    # Store in memory
+    image_store.add(record)
+
+async def run_generation_job(job: Job) -> None:
+    """Run a mask-generation job on the worker pool"""
+    image_id = upload_index.resolve(job.image_id)
     try:
-        with stub.run():
-            masks = generate_masks_modal(image_data)
+        image = await load_image(job.image_id)
+        original_size = image_sizes[image_id]
+        with_embedding = image_id not in embedding_cache
+        if worker_pool.kind == "process":
+            # Worker processes can't publish to the job, so masks arrive together
+            record, embedding = await run_stage("segment", segment_image, image_id, image, original_size, with_embedding)
+            job.start(total=len(record.masks))
+            for mask in await run_stage("serialize", serialize_masks, record, job.mask_format):
+                job.add_mask(mask)
+        else:
+            record, embedding = await run_stage(
+                "segment", stream_segment_image, job, image_id, image, original_size, with_embedding
+            )
+        store_segmentation(record, embedding)
+        job.complete()
     except Exception as e:
-        # For testing without Modal credentials, return mock masks
-        print(f"Modal error: {e}")
-        print("Falling back to mock mask generation...")
-        
-        # Create a simple mock mask for testing
-        image = Image.open(image_path)
-        width, height = image.size
-        print(f"Image dimensions: {width}x{height}")
-        
-        # Create multiple smaller masks instead of one large mask
-        masks = []
-        mask_size = min(width, height) // 8  # Smaller masks
-        
-        # Create 4 masks in different quadrants
-        quadrants = [
-            (width // 4, height // 4),      # Top-left
-            (3 * width // 4, height // 4),  # Top-right
-            (width // 4, 3 * height // 4),  # Bottom-left
-            (3 * width // 4, 3 * height // 4)  # Bottom-right
-        ]
-        
-        for i, (center_x, center_y) in enumerate(quadrants):
-            mock_mask = [[False for _ in range(width)] for _ in range(height)]
-            
-            print(f"Creating mock mask {i} at center ({center_x}, {center_y}) with size {mask_size}")
-            
-            for y in range(max(0, center_y - mask_size), min(height, center_y + mask_size)):
-                for x in range(max(0, center_x - mask_size), min(width, center_x + mask_size)):
-                    mock_mask[y][x] = True
-            
-            # Calculate proper bbox
-            bbox_x = center_x - mask_size
-            bbox_y = center_y - mask_size
-            bbox_width = mask_size * 2
-            bbox_height = mask_size * 2
-            
-            masks.append({
-                "id": str(i),
-                "segmentation": mock_mask,
-                "area": bbox_width * bbox_height,
-                "bbox": [bbox_x, bbox_y, bbox_width, bbox_height],
-                "predicted_iou": 0.9,
-                "point_coords": [[center_x, center_y]],
-                "stability_score": 0.9
-            })
-            
-            print(f"Generated mock mask {i} with area: {bbox_width * bbox_height}, bbox: {[bbox_x, bbox_y, bbox_width, bbox_height]}")
-    
-    print(f"Total masks generated: {len(masks)}")
+        logger.exception("Job %s failed", job.id)
+        job.fail(str(e))
+
+@app.get("/jobs/{job_id}")
+async def get_job(
+    response: Response,
+    job_id: str,
+    since: int = Query(0, ge=0),
+    encoding: str = Depends(get_response_encoding)
+):
+    """Job status, progress and the masks produced after index `since`"""
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return await respond(response, job.summary(since), encoding)
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(
+    job_id: str,
+    since: int = Query(0, ge=0),
+    last_event_id: Optional[str] = Header(None)
+):
+    """Stream a job's masks as Server-Sent Events as soon as each one is produced"""
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
     
-    # Store in memory
-    image_store[image_id] = ImageData(
-        image_id=image_id,
-        masks=masks,
-        original_image=base64.b64encode(image_data).decode("utf-8")
-    )
+    # Resume after the last mask a reconnecting EventSource received
+    if last_event_id is not None and last_event_id.isdigit():
+        since = int(last_event_id) + 1
     
-    return {
-        "image_id": image_id,
-        "masks": masks,
-        "message": f"Generated {len(masks)} masks"
-    }
+    return StreamingResponse(
+        job.events(since),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @app.post("/get-mask")
-async def get_mask(request: MaskRequest):
-    """Get mask for specific points"""
-    if request.image_id not in image_store:
+async def get_mask(
+    request: MaskRequest,
+    response: Response,
+    mask_format: str = Depends(get_mask_format),
+    mask_resolution: str = Depends(get_mask_resolution),
+    encoding: str = Depends(get_response_encoding)
+):
+    """Get mask for specific points, or refine a session's mask when session_id is given"""
+    record = get_record(request.image_id)
+    if record is None:
         raise HTTPException(status_code=404, detail="Image not found")
+    if len(request.points) != len(request.labels):
+        raise HTTPException(status_code=400, detail="points and labels must have the same length")
     
-    image_path = UPLOADS_DIR / f"{request.image_id}.jpg"
+    # Reuse the encoded image instead of re-reading and re-encoding it
+    embedding = await load_embedding(request.image_id)
     
-    # Read image data
-    async with aiofiles.open(image_path, "rb") as f:
-        image_data = await f.read()
+    # Convert points from original image pixels to working pixels
+    points = to_working_points([[p.x, p.y] for p in request.points], *record.scale,
+                               record.working_width, record.working_height)
     
-    # Convert points to list format
-    points = [[p.x, p.y] for p in request.points]
+    if request.session_id is not None:
+        return await respond(response, await refine_mask(request, record, embedding, points, mask_format,
+                                                         mask_resolution), encoding)
     
-    # Get mask using Modal
-    try:
-        with stub.run():
-            mask_result = get_mask_for_points_modal(image_data, points, request.labels)
-    except Exception as e:
-        # For testing without Modal credentials, return mock mask
-        print(f"Modal error in get-mask: {e}")
-        # Create a simple mock mask for the requested point
-        image = Image.open(image_path)
-        width, height = image.size
-        mock_mask = [[False for _ in range(width)] for _ in range(height)]
+    # Get mask from the backend, batched with concurrent prompts
+    with stage("segment"):
+        mask_result = await predict_batcher.submit((embedding, points, request.labels))
+    mask_result.pop("low_res_logits", None)
+    
+    mask_result["segmentation"] = await run_stage(
+        "serialize", upsample_prompt_mask, mask_result["segmentation"], record, mask_format, mask_resolution
+    )
+    return await respond(response, mask_result, encoding)
+
+async def refine_mask(request: MaskRequest, record: ImageRecord, embedding: np.ndarray,
+                      points: List[List[int]], mask_format: str, resolution: str = "working") -> Dict[str, Any]:
+    """Add clicks to a refinement session and return only the changed part of its mask.
+    
+    The diff is at the working resolution unless ``resolution`` is
+    ``"original"``: XOR `diff.segmentation` into the previous mask at
+    `diff.bbox` to get the new one.
+    """
+    session = refinement_sessions.get_or_create(request.image_id, request.session_id)
+    async with session.lock:
+        # Earlier clicks may have been handled by another worker
+        refinement_sessions.load(session)
+        if request.reset:
+            session.reset()
+        all_points = session.points + points
+        all_labels = session.labels + request.labels
         
-        # Create a mask around the first point
-        if points:
-            point_x, point_y = points[0]
-            mask_size = min(width, height) // 8  # Make mask 1/8 of image size
-            for y in range(max(0, point_y - mask_size), min(height, point_y + mask_size)):
-                for x in range(max(0, point_x - mask_size), min(width, point_x + mask_size)):
-                    mock_mask[y][x] = True
+        # The previous logits let model backends refine instead of starting over
+        with stage("segment"):
+            mask_result = await predict_batcher.submit((embedding, all_points, all_labels, session.logits))
+        stored, diff = await run_stage("serialize", refine_diff, session.mask, mask_result["segmentation"], record,
+                                       mask_format, resolution)
         
-        mask_result = {
-            "segmentation": mock_mask,
-            "score": 0.8
-        }
+        session.points, session.labels = all_points, all_labels
+        session.logits = mask_result.get("low_res_logits")
+        session.mask = stored
+        refinement_sessions.save(session)
     
-    return mask_result
+    metadata = record.mask_metadata(stored)
+    return {
+        "session_id": session.session_id,
+        "clicks": len(all_points),
+        "score": mask_result.get("score"),
+        "area": metadata["area"],
+        "bbox": metadata["bbox"],
+        "diff": diff
+    }
 
-@app.post("/apply-colors")
-async def apply_colors(request: ColorRequest):
-    """Apply colors to selected masks"""
-    if request.image_id not in image_store:
+@app.post("/hit-test")
+async def hit_test(request: HitTestRequest):
+    """Masks under a point, or visible inside a rectangle or lasso, topmost first.
+    
+    Coordinates are original image pixels. Answered from a per-image index
+    (topmost-mask label map plus bbox grid) without unpacking any mask.
+    """
+    if sum(shape is not None for shape in (request.point, request.rect, request.lasso)) != 1:
+        raise HTTPException(status_code=400, detail="Give exactly one of point, rect or lasso")
+    record = get_record(request.image_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    hit_index = await get_hit_index(record)
+    scale_x, scale_y = record.scale
+    
+    top = None
+    if request.point is not None:
+        if not (0 <= request.point.x < record.width and 0 <= request.point.y < record.height):
+            raise HTTPException(status_code=400, detail="point is outside the image")
+        [[x, y]] = to_working_points([[request.point.x, request.point.y]], scale_x, scale_y,
+                                     record.working_width, record.working_height)
+        hits = hit_index.masks_at(record.masks, x, y)
+        top = hit_index.top_at(x, y)
+    elif request.rect is not None:
+        x, y, width, height = request.rect
+        if width <= 0 or height <= 0:
+            raise HTTPException(status_code=400, detail="rect width and height must be positive")
+        hits = hit_index.masks_in_rect(int(x // scale_x), int(y // scale_y),
+                                       -int(-(x + width) // scale_x), -int(-(y + height) // scale_y))
+    else:
+        hits = hit_index.masks_in_polygon([(p.x / scale_x, p.y / scale_y) for p in request.lasso])
+    
+    return {
+        "image_id": request.image_id,
+        "top": record.masks[top].id if top is not None else None,
+        "mask_ids": [record.masks[index].id for index in hits]
+    }
+
+@app.get("/masks/{image_id}")
+async def mask_index(
+    image_id: str,
+    response: Response,
+    bbox: Optional[str] = None,
+    encoding: str = Depends(get_response_encoding)
+):
+    """Metadata of an image's masks without pixels, optionally only those overlapping `bbox`"""
+    record = get_record(image_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    masks = [record.mask_metadata(mask) for mask in record.masks]
+    if bbox is not None:
+        try:
+            region = parse_region(bbox, record.width, record.height)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        masks = [mask for mask in masks if intersects(mask["bbox"], region)]
+    return await respond(response, {
+        "image_id": image_id,
+        "width": record.width,
+        "height": record.height,
+        "mask_count": len(masks),
+        "masks": masks
+    }, encoding)
+
+@app.get("/masks/{image_id}/{mask_id}")
+async def mask_tile_endpoint(
+    image_id: str,
+    mask_id: str,
+    response: Response,
+    bbox: Optional[str] = None,
+    scale: float = Query(1.0, gt=0, le=1),
+    mask_format: str = Depends(get_mask_format),
+    encoding: str = Depends(get_response_encoding)
+):
+    """One mask's pixels inside `bbox` (x,y,width,height in original pixels) at `scale` output pixels per pixel"""
+    record = get_record(image_id)
+    if record is None:
         raise HTTPException(status_code=404, detail="Image not found")
+    mask = record.get(mask_id)
+    if mask is None:
+        raise HTTPException(status_code=404, detail="Mask not found")
+    try:
+        region = parse_region(bbox, record.width, record.height)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    return await respond(response, {
+        "image_id": image_id,
+        "mask_id": mask_id,
+        "bbox": list(region),
+        "scale": scale,
+        "size": list(tile_size(region, scale)[::-1]),
+        "segmentation": await run_stage("serialize", serialize_tile, mask, record.scale, region, scale, mask_format)
+    }, encoding)
+
+@app.post("/apply-colors")
+async def apply_colors(request: ColorRequest, direct: bool = False):
+    """Apply colors to selected masks.
     
-    image_data = image_store[request.image_id]
-    image_path = UPLOADS_DIR / f"{request.image_id}.jpg"
+    With ?direct=true the response is the image itself, sent from memory
+    without writing a file unless the render cache already holds it.
+    """
+    record = get_record(request.image_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Image not found")
     
-    # Load original image
-    image = Image.open(image_path)
-    image_array = np.array(image)
+    # Parse every color once, up front
+    try:
+        default_color = parse_color(request.color, request.alpha)
+        mask_colors = {mask_id: parse_color(color, request.alpha) for mask_id, color in (request.colors or {}).items()}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
-    # Create colored image
-    colored_image = image_array.copy()
+    layers = [(mask, mask_colors.get(mask.id, default_color)) for mask in map(record.get, request.mask_ids) if mask]
+    if len(layers) > MAX_LAYERS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_LAYERS} masks can be colored at once")
     
-    # Apply colors to selected masks
-    for mask_id in request.mask_ids:
-        mask = next((m for m in image_data.masks if m["id"] == mask_id), None)
-        if mask:
-            mask_array = np.array(mask["segmentation"], dtype=bool)
-            color_rgb = tuple(int(request.color[i:i+2], 16) for i in (1, 3, 5))  # Convert hex to RGB
-            
-            # Apply color to masked areas
-            colored_image[mask_array] = color_rgb
+    output_format = request.format or RENDER_FORMAT
+    quality = request.quality or RENDER_QUALITY
+    if direct:
+        return await render_direct(request.image_id, record, layers, output_format, quality)
     
-    # Save colored image
-    colored_image_path = UPLOADS_DIR / f"{request.image_id}_colored.jpg"
-    colored_pil = Image.fromarray(colored_image)
-    colored_pil.save(colored_image_path)
+    colored_image_path, key, cached = await render_colors(request.image_id, record, layers, output_format, quality)
     
     return {
         "message": "Colors applied successfully",
-        "colored_image_path": str(colored_image_path)
+        "colored_image_path": str(colored_image_path),
+        "render_id": key,
+        "format": output_format,
+        "download_url": f"/download/{request.image_id}?render={key}",
+        "cached": cached
     }
 
+async def render_direct(image_id: str, record: ImageRecord, layers: List[tuple], output_format: str,
+                        quality: int) -> Response:
+    """Respond with a render's bytes: the cached file if there is one, else encoded in memory and not stored"""
+    key = render_key(record, layers, output_format, quality)
+    extension, content_type = CONTAINERS[output_format]
+    headers = {"ETag": f'"{key}"', "X-Render-Id": key}
+    colored_image_path = render_cache.get(key, extension)
+    if colored_image_path is not None:
+        return FileResponse(colored_image_path, media_type=content_type, headers=headers)
+    image = await load_full_image(image_id)
+    content = await run_stage(None, render_colored_image, image, record, layers, output_format, quality)
+    return Response(content, media_type=content_type, headers=headers)
+
+async def render_colors(image_id: str, record: ImageRecord, layers: List[tuple], output_format: str,
+                        quality: int) -> Tuple[Path, str, bool]:
+    """Return (path, render key, cached) for a render of ``image_id``, producing it only on a cache miss.
+
+    Renders are keyed by the record, so deduplicated uploads share them.
+    """
+    # Identical requests are served from the render cache without compositing or encoding
+    key = render_key(record, layers, output_format, quality)
+    colored_image_path = render_cache.get(key, CONTAINERS[output_format][0])
+    cached = colored_image_path is not None
+    if not cached:
+        render = pending_renders.get(key)
+        if render is None:
+            render = asyncio.ensure_future(render_to_cache(key, image_id, record, layers, output_format, quality))
+            pending_renders[key] = render
+            render.add_done_callback(lambda _: pending_renders.pop(key, None))
+        colored_image_path = await asyncio.shield(render)
+    latest_renders[image_id] = key
+    return colored_image_path, key, cached
+
+async def render_to_cache(key: str, image_id: str, record: ImageRecord, layers: List[tuple], output_format: str,
+                          quality: int) -> Path:
+    """Render colored masks into a temp file and move it into the render cache"""
+    image = await load_full_image(image_id)
+    content = await run_stage(None, render_colored_image, image, record, layers, output_format, quality)
+    extension = CONTAINERS[output_format][0]
+    temp_path = render_cache.temp_path(extension)
+    try:
+        await run_stage("write", write_file, temp_path, content)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+    return render_cache.put(key, extension, temp_path)
+
 @app.get("/download/{image_id}")
-async def download_image(image_id: str):
-    """Download the colored image"""
-    colored_image_path = UPLOADS_DIR / f"{image_id}_colored.jpg"
+async def download_image(
+    image_id: str,
+    render: Optional[str] = Query(None, pattern="^[0-9a-f]{32}$"),
+    format: Optional[str] = Query(None, pattern="^(jpeg|png|webp)$"),
+    quality: Optional[int] = Query(None, ge=1, le=100),
+    if_none_match: Optional[str] = Header(None)
+):
+    """Download a colored image: a specific render, the latest one, or the upload if none yet.
     
-    if not colored_image_path.exists():
+    Files are sent as stored unless `format` or `quality` asks for another
+    encoding, which is made in memory and not stored.
+    """
+    key = render or latest_renders.get(image_id)
+    if key is not None and not key.startswith(image_tag(upload_index.resolve(image_id))):
+        # Rendered from another image
         raise HTTPException(status_code=404, detail="Colored image not found")
+    if key is None:
+        # Nothing colored yet, so the image as uploaded is the current result
+        path = upload_path(image_id)
+        if path is None:
+            raise HTTPException(status_code=404, detail="Colored image not found")
+        headers = {"Cache-Control": "no-cache"}
+    else:
+        path = render_cache.find(key, RENDER_EXTENSIONS)
+        if path is None:
+            raise HTTPException(status_code=404, detail="Colored image not found")
+        # Renders never change under their key; the latest-render alias must be revalidated
+        headers = {"Cache-Control": "public, max-age=31536000, immutable" if render else "no-cache"}
+    
+    stored_format = container_of(path.suffix)
+    transcode = (format is not None and format != stored_format) or quality is not None
+    output_format = (format or stored_format) if transcode else None
+    if transcode and output_format not in OUTPUT_FORMATS:
+        # Uploads may be in a container we only decode
+        output_format = RENDER_FORMAT
+    
+    if key is not None:
+        etag = f'"{key}-{output_format}-{quality or RENDER_QUALITY}"' if transcode else f'"{key}"'
+        headers["ETag"] = etag
+        if if_none_match and (if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]):
+            return Response(status_code=304, headers=headers)
+    
+    if transcode:
+        extension, content_type = CONTAINERS[output_format]
+        content = await run_stage(None, transcode_file, path, output_format, quality or RENDER_QUALITY)
+        headers["Content-Disposition"] = f'attachment; filename="colored_building_{image_id}.{extension}"'
+        return Response(content, media_type=content_type, headers=headers)
     
     return FileResponse(
-        colored_image_path,
-        media_type="image/jpeg",
-        filename=f"colored_building_{image_id}.jpg"
+        path,
+        media_type=media_type(path.suffix),
+        filename=f"colored_building_{image_id}{path.suffix}",
+        headers=headers
     )
 
+@app.post("/batch")
+async def batch_process(
+    files: List[UploadFile] = File(default=[]),
+    archive: Optional[UploadFile] = File(None),
+    spec: str = Form("{}"),
+    output: str = Query("zip", pattern="^(zip|ndjson)$"),
+    mask_format: str = Depends(get_mask_format)
+):
+    """Upload, segment and color many images in one request.
+    
+    Images come as repeated `files` parts and/or a zip `archive`; `spec` is a
+    JSON BatchSpec. Results stream back as each image finishes: a zip of
+    colored images plus results.json, or NDJSON lines with ?output=ndjson.
+    """
+    try:
+        batch_spec = BatchSpec.model_validate_json(spec)
+        default_color = parse_color(batch_spec.color, batch_spec.alpha)
+        mask_colors = {mask_id: parse_color(color, batch_spec.alpha) for mask_id, color in (batch_spec.colors or {}).items()}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid batch spec: {e}")
+    
+    for file in files:
+        if not (file.content_type or "").startswith("image/"):
+            raise HTTPException(status_code=400, detail=f"{file.filename} is not an image")
+    if len(files) > BATCH_MAX_IMAGES:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_IMAGES} images per batch")
+    
+    # (filename, image_id, archive member or None) for every image in the batch
+    sources = []
+    for file in files:
+        image_id = str(uuid.uuid4())
+        await save_upload(file, UPLOADS_DIR / f"{image_id}.upload", MAX_FILE_SIZE)
+        finalize_upload(image_id, UPLOADS_DIR / f"{image_id}.upload")
+        sources.append((file.filename or image_id, image_id, None))
+    
+    archive_path = None
+    if archive is not None:
+        # Keep the archive on disk; members are extracted as the pipeline reaches them
+        archive_path = UPLOADS_DIR / f"batch-{uuid.uuid4()}.zip"
+        await save_upload(archive, archive_path, BATCH_MAX_ARCHIVE_SIZE)
+        try:
+            members = await worker_pool.run(
+                list_archive_images, archive_path, BATCH_MAX_IMAGES - len(sources), MAX_FILE_SIZE
+            )
+        except (zipfile.BadZipFile, ValueError) as e:
+            archive_path.unlink(missing_ok=True)
+            raise HTTPException(status_code=400, detail=f"Invalid archive: {e}")
+        sources.extend((member, str(uuid.uuid4()), member) for member in members)
+    
+    if not sources:
+        if archive_path is not None:
+            archive_path.unlink(missing_ok=True)
+        raise HTTPException(status_code=400, detail="No images in batch")
+    
+    results = stream_batch(sources, archive_path, batch_spec, default_color, mask_colors, output, mask_format)
+    if output == "ndjson":
+        return StreamingResponse(results, media_type="application/x-ndjson")
+    return StreamingResponse(
+        results,
+        media_type="application/zip",
+        headers={"Content-Disposition": 'attachment; filename="batch.zip"'}
+    )
+
+async def stream_batch(sources: List[tuple], archive_path: Optional[Path], batch_spec: BatchSpec,
+                       default_color: tuple, mask_colors: Dict[str, tuple], output: str, mask_format: str):
+    """Run every image through extract, decode, segment and render, yielding results as they finish"""
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    
+    async def process(index: int, filename: str, image_id: str, member: Optional[str]) -> tuple:
+        result = {"index": index, "filename": filename, "image_id": image_id}
+        async with semaphore:
+            for attempt in range(BATCH_OVERLOAD_RETRIES + 1):
+                try:
+                    return await run_pipeline(result, image_id, member)
+                except PoolOverloaded as e:
+                    # Ride out bursts from other clients instead of failing the image
+                    if attempt == BATCH_OVERLOAD_RETRIES:
+                        result.update({"status": "error", "error": str(e)})
+                        return result, None
+                    await asyncio.sleep(e.retry_after)
+                except Exception as e:
+                    logger.exception("Batch image %s failed", filename)
+                    result.update({"status": "error", "error": str(e) or type(e).__name__})
+                    return result, None
+    
+    async def run_pipeline(result: dict, image_id: str, member: Optional[str]) -> tuple:
+        if member is not None:
+            await run_stage("read", extract_archive_member, archive_path, member, UPLOADS_DIR / f"{image_id}.upload")
+            finalize_upload(image_id, UPLOADS_DIR / f"{image_id}.upload")
+        image = await load_image(image_id)
+        # Concurrent images are segmented together in one backend call
+        with stage("segment"):
+            record, embedding = await segment_batcher.submit(
+                (image_id, image, image_sizes[image_id], image_id not in embedding_cache)
+            )
+        store_segmentation(record, embedding)
+        
+        if batch_spec.mask_ids is None:
+            selected = record.masks
+        else:
+            selected = [mask for mask in map(record.get, batch_spec.mask_ids) if mask]
+        layers = [(mask, mask_colors.get(mask.id, default_color)) for mask in selected[:MAX_LAYERS]]
+        colored_image_path, key, _ = await render_colors(
+            image_id, record, layers, batch_spec.format or RENDER_FORMAT, batch_spec.quality or RENDER_QUALITY
+        )
+        
+        result.update({
+            "status": "ok",
+            "mask_count": len(record.masks),
+            "colored_mask_count": len(layers),
+            "render_id": key,
+            "download_url": f"/download/{image_id}?render={key}"
+        })
+        if batch_spec.include_masks and output == "ndjson":
+            result["masks"] = await run_stage("serialize", serialize_masks, record, mask_format)
+        return result, colored_image_path
+    
+    tasks = [asyncio.ensure_future(process(index, *source)) for index, source in enumerate(sources)]
+    zip_stream = ZipStream() if output == "zip" else None
+    manifest = []
+    try:
+        for next_result in asyncio.as_completed(tasks):
+            result, colored_image_path = await next_result
+            if zip_stream is None:
+                yield encode_body(result)[0] + b"\n"
+                continue
+            if colored_image_path is not None:
+                result["entry"] = f"{result['index']:04d}_{Path(result['filename']).stem}{colored_image_path.suffix}"
+                async with aiofiles.open(colored_image_path, "rb") as f:
+                    yield zip_stream.add(result["entry"], await f.read())
+            manifest.append(result)
+        if zip_stream is not None:
+            manifest.sort(key=lambda result: result["index"])
+            yield zip_stream.add("results.json", json.dumps({"results": manifest}, indent=2))
+            yield zip_stream.close()
+    finally:
+        # Stop outstanding work if the client went away
+        for task in tasks:
+            task.cancel()
+        if archive_path is not None:
+            archive_path.unlink(missing_ok=True)
+
+@app.post("/upload-video")
+async def upload_video(request: Request, file: UploadFile = File(...)):
+    """Upload a video, a zip of frame images or an animated image and return its video ID"""
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > VIDEO_MAX_FILE_SIZE + 64 * 1024:
+        raise HTTPException(status_code=413, detail=f"File exceeds the {VIDEO_MAX_FILE_SIZE} byte limit")
+    
+    video_id = str(uuid.uuid4())
+    temp_path = UPLOADS_DIR / f"{video_id}.upload"
+    await save_upload(file, temp_path, VIDEO_MAX_FILE_SIZE)
+    with open(temp_path, "rb") as f:
+        extension = sniff_video(f.read(SNIFF_BYTES))
+    if extension is None:
+        temp_path.unlink(missing_ok=True)
+        raise HTTPException(status_code=400, detail="File must be a video, a zip of frames or an animated image")
+    video_path = UPLOADS_DIR / f"{video_id}.{extension}"
+    os.replace(temp_path, video_path)
+    
+    try:
+        video = await load_video(video_id, video_path)
+    except (ValueError, RuntimeError, OSError, zipfile.BadZipFile) as e:
+        video_path.unlink(missing_ok=True)
+        raise HTTPException(status_code=400, detail=f"Invalid video: {e}")
+    
+    return {
+        "video_id": video_id,
+        "frame_count": video["frames"],
+        "width": video["width"],
+        "height": video["height"],
+        "fps": video["fps"],
+        "working_width": video["working_width"],
+        "working_height": video["working_height"],
+        "message": "Video uploaded successfully"
+    }
+
+async def load_video(video_id: str, path: Optional[Path] = None) -> Optional[Dict[str, Any]]:
+    """Probe a video once; videos uploaded to another worker are found by extension"""
+    video = videos.get(video_id)
+    if video is not None and video["path"].exists():
+        return video
+    if path is None:
+        path = next((candidate for candidate in (UPLOADS_DIR / f"{video_id}.{extension}"
+                                                 for extension in VIDEO_EXTENSIONS) if candidate.exists()), None)
+        if path is None:
+            return None
+    video = await run_stage("decode", probe_video, path, MAX_FILE_SIZE)
+    video["path"] = path
+    video["working_width"], video["working_height"] = working_size(video["width"], video["height"], WORKING_MAX_SIDE)
+    videos[video_id] = video
+    return video
+
+@app.post("/videos/{video_id}/propagate")
+async def propagate_video(
+    video_id: str,
+    request: VideoPromptRequest,
+    mask_format: str = Depends(get_mask_format),
+    mask_resolution: str = Depends(get_mask_resolution)
+):
+    """Prompt one frame of a video and start a job propagating the mask through the frames after it.
+    
+    Each frame's mask is published to the job as it is tracked and appended
+    to `masks_url` as one NDJSON line of COCO RLE, at the working resolution
+    unless ?mask_resolution=original.
+    """
+    video = await load_video(video_id)
+    if video is None:
+        raise HTTPException(status_code=404, detail="Video not found")
+    if len(request.points) != len(request.labels):
+        raise HTTPException(status_code=400, detail="points and labels must have the same length")
+    if video["frames"] and request.frame_index >= video["frames"]:
+        raise HTTPException(status_code=400, detail=f"frame_index must be less than {video['frames']}")
+    if not video_pool.has_capacity():
+        raise PoolOverloaded()
+    
+    job = job_manager.create(video_id, mask_format)
+    job.task = asyncio.create_task(run_video_job(job, video, request, mask_resolution))
+    return JSONResponse(status_code=202, content={
+        "job_id": job.id,
+        "video_id": video_id,
+        "status": job.status,
+        "status_url": f"/jobs/{job.id}",
+        "events_url": f"/jobs/{job.id}/events",
+        "masks_url": f"/videos/{video_id}/masks/{job.id}"
+    })
+
+def video_masks_path(video_id: str, job_id: str) -> Path:
+    # An underscore in the name makes it a rendered output to the janitor
+    return UPLOADS_DIR / f"{video_id}_{job_id}.ndjson"
+
+def track_video_job(job: Job, video: Dict[str, Any], record: ImageRecord, frame_index: int, points: List[List[int]],
+                    labels: List[int], max_frames: Optional[int], resolution: str, masks_path: Path) -> None:
+    """Track a prompted mask through a video, publishing and writing each frame as soon as it is done"""
+    remaining = video["frames"] - frame_index if video["frames"] else None
+    job.start(total=min(filter(None, (max_frames, remaining)), default=None))
+    tracked = track_video(segmentation_backend, video["path"], frame_index, points, labels, WORKING_MAX_SIDE,
+                          max_frames, VIDEO_PREFETCH_FRAMES)
+    with MaskWriter(masks_path) as writer:
+        for index, mask in tracked:
+            with stage("serialize"):
+                stored = StoredMask.from_array(str(index), mask)
+                entry = {"frame": index, **serialize_mask(stored, "rle", record, resolution)}
+                writer.write(entry)
+                if job.mask_format != "rle":
+                    entry = {"frame": index, **serialize_mask(stored, job.mask_format, record, resolution)}
+            job.add_mask(entry)
+
+async def run_video_job(job: Job, video: Dict[str, Any], request: VideoPromptRequest, resolution: str) -> None:
+    """Run a video propagation job on the video pool, whose threads publish frames to the job as they are tracked"""
+    record = ImageRecord(job.image_id, video["width"], video["height"], [],
+                         video["working_width"], video["working_height"])
+    points = to_working_points([[p.x, p.y] for p in request.points], *record.scale,
+                               record.working_width, record.working_height)
+    max_frames = request.max_frames or VIDEO_MAX_FRAMES or None
+    if VIDEO_MAX_FRAMES:
+        max_frames = min(max_frames, VIDEO_MAX_FRAMES)
+    args = (job, video, record, request.frame_index, points, request.labels, max_frames, resolution,
+            video_masks_path(job.image_id, job.id))
+    try:
+        timings, _ = await video_pool.run(timed_call, None, track_video_job, *args)
+        record_stages(timings)
+        job.complete()
+    except Exception as e:
+        logger.exception("Video job %s failed", job.id)
+        job.fail(str(e))
+
+@app.get("/videos/{video_id}/masks/{job_id}")
+async def video_masks(video_id: str, job_id: str):
+    """Per-frame masks of a propagation job as NDJSON, growing while the job runs"""
+    try:
+        uuid.UUID(job_id)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Video masks not found")
+    path = video_masks_path(video_id, job_id)
+    if not path.exists():
+        raise HTTPException(status_code=404, detail="Video masks not found")
+    return FileResponse(path, media_type="application/x-ndjson", headers={"Cache-Control": "no-cache"})
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
     return {
         "status": "healthy",
         "message": "SAM2 Building Segmentation API is running",
-        "stored_images": len(image_store)
+        "stored_images": len(image_store),
+        "stored_mask_bytes": image_store.nbytes,
+        "mask_store": image_store.stats(),
+        "backend": segmentation_backend.name,
+        "state_backend": STATE_BACKEND,
+        "batching": predict_batcher.stats(),
+        "segment_batching": segment_batcher.stats(),
+        "embedding_cache": embedding_cache.stats(),
+        "upload_dedupe": upload_index.stats(),
+        "image_cache": image_cache.stats(),
+        "render_cache": render_cache.stats(),
+        "workers": worker_pool.stats(),
+        "video_workers": video_pool.stats(),
+        "jobs": job_manager.stats(),
+        "videos": len(videos),
+        "refinement_sessions": refinement_sessions.stats()
     }
 
+def collect_state_metrics() -> list:
+    """Store, cache and pool counters, read from their stats at scrape time"""
+    store = image_store.stats()
+    caches = {
+        "embedding": embedding_cache.stats(),
+        "image": image_cache.stats(),
+        "render": render_cache.stats()
+    }
+    workers = worker_pool.stats()
+    return [
+        gauge("sam2_mask_store_bytes", "Bytes of masks held in memory", [({}, store["bytes"])]),
+        gauge("sam2_mask_store_records", "Mask records by location", [
+            ({"location": "memory"}, store["records"]),
+            ({"location": "spilled"}, store["spilled_records"])
+        ]),
+        counter("sam2_mask_store_events", "Mask store evictions, spills, reloads and expiries", [
+            ({"event": event}, store[event]) for event in ("evictions", "spills", "reloads", "expired")
+        ]),
+        gauge("sam2_cache_bytes", "Bytes held by each cache", [
+            ({"cache": name}, stats["bytes"]) for name, stats in caches.items()
+        ]),
+        counter("sam2_cache_hits", "Cache hits", [({"cache": name}, stats["hits"]) for name, stats in caches.items()]),
+        counter("sam2_cache_misses", "Cache misses", [({"cache": name}, stats["misses"]) for name, stats in caches.items()]),
+        gauge("sam2_cache_hit_ratio", "Hits over lookups since startup", [
+            ({"cache": name}, stats["hits"] / max(1, stats["hits"] + stats["misses"])) for name, stats in caches.items()
+        ]),
+        gauge("sam2_worker_pending", "Stages running or queued on the worker pool", [({}, workers["pending"])]),
+        counter("sam2_worker_rejected", "Stages shed because the worker pool was full", [({}, workers["rejected"])]),
+        gauge("sam2_refinement_sessions", "Active refinement sessions", [({}, refinement_sessions.stats()["active"])]),
+        gauge("sam2_jobs", "Mask-generation jobs by status", [
+            ({"status": status}, count) for status, count in job_manager.stats().items()
+        ])
+    ]
+
+registry.register(collect_state_metrics)
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus metrics"""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.get("/debug/masks/{image_id}")
-async def debug_masks(image_id: str):
+async def debug_masks(
+    image_id: str,
+    response: Response,
+    mask_format: str = Depends(get_mask_format),
+    mask_resolution: str = Depends(get_mask_resolution),
+    encoding: str = Depends(get_response_encoding)
+):
     """Debug endpoint to check stored masks"""
-    if image_id not in image_store:
+    record = get_record(image_id)
+    if record is None:
         raise HTTPException(status_code=404, detail="Image not found")
     
-    image_data = image_store[image_id]
-    return {
+    return await respond(response, {
         "image_id": image_id,
-        "mask_count": len(image_data.masks),
-        "masks": image_data.masks
-    }
+        "mask_count": len(record.masks),
+        "masks": await run_stage("serialize", serialize_masks, record, mask_format, mask_resolution)
+    }, encoding)
 
 @app.get("/test/mock-mask")
-async def test_mock_mask():
+async def test_mock_mask(mask_format: str = Depends(get_mask_format)):
     """Test endpoint to generate a simple mock mask"""
     # Create a simple 100x100 mock mask
     width, height = 100, 100
-    mock_mask = [[False for _ in range(width)] for _ in range(height)]
     
     # Create a rectangular mask in the center
     center_x, center_y = width // 2, height // 2
     mask_size = 20
+    mock_mask = box_mask(width, height, center_x, center_y, mask_size)
     
-    for y in range(max(0, center_y - mask_size), min(height, center_y + mask_size)):
-        for x in range(max(0, center_x - mask_size), min(width, center_x + mask_size)):
-            mock_mask[y][x] = True
-    
-    bbox_x = center_x - mask_size
-    bbox_y = center_y - mask_size
-    bbox_width = mask_size * 2
-    bbox_height = mask_size * 2
-    
-    mock_mask_data = {
-        "id": "test-0",
-        "segmentation": mock_mask,
-        "area": bbox_width * bbox_height,
-        "bbox": [bbox_x, bbox_y, bbox_width, bbox_height],
-        "predicted_iou": 0.9,
-        "point_coords": [[center_x, center_y]],
-        "stability_score": 0.9
-    }
+    mock_mask_data = StoredMask.from_array(
+        "test-0",
+        mock_mask,
+        predicted_iou=0.9,
+        point_coords=[[center_x, center_y]],
+        stability_score=0.9
+    )
     
     return {
         "message": "Test mock mask generated",
-        "mask": mock_mask_data,
+        "mask": serialize_mask(mock_mask_data, mask_format),
         "mask_size": f"{width}x{height}",
-        "bbox": [bbox_x, bbox_y, bbox_width, bbox_height]
+        "bbox": mock_mask_data.bbox
     }
 
 if __name__ == "__main__":
@@ -0,0 +1,153 @@
+"""Mask wire formats.
+
+Masks are encoded straight from NumPy boolean arrays. Four formats are
+supported:
+
+- ``rle``: COCO-style uncompressed run-length encoding. Runs are taken in
+  column-major (Fortran) order and always start with a run of ``False``,
+  exactly like ``pycocotools`` expects for ``{"size": [h, w], "counts": [...]}``.
+- ``bitmask``: the row-major mask packed with ``np.packbits`` and base64 encoded.
+- ``dense``: the legacy nested ``List[List[bool]]`` representation.
+- ``polygon``: simplified outer contours as flat ``[x0, y0, x1, y1, ...]``
+  vertex lists, lossy but tiny for building outlines.
+"""
+import base64
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+from postprocess import mask_polygons
+
+MASK_FORMATS = ("rle", "bitmask", "dense", "polygon")
+DEFAULT_MASK_FORMAT = "rle"
+
+# Accept-header media types that select a mask format
+MASK_MEDIA_TYPES = {
+    "application/vnd.sam2.mask-rle+json": "rle",
+    "application/vnd.sam2.mask-bitmask+json": "bitmask",
+    "application/vnd.sam2.mask-dense+json": "dense",
+    "application/vnd.sam2.mask-polygon+json": "polygon",
+}
+
+# Douglas-Peucker tolerance of polygon output, in mask pixels
+POLYGON_EPSILON = 1.0
+
+
+def _rle_counts(flat: np.ndarray) -> np.ndarray:
+    """Run lengths of a non-empty flat boolean array, starting with a False run"""
+    # Positions where the value flips, framed by the start and end of the array
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    bounds = np.concatenate(([0], changes, [flat.size]))
+    counts = np.diff(bounds)
+    if flat[0]:
+        # COCO RLE always starts with the length of the leading False run
+        counts = np.concatenate(([0], counts))
+    return counts
+
+
+def encode_rle(mask: np.ndarray) -> Dict[str, Any]:
+    """Encode a 2D boolean mask as COCO uncompressed RLE"""
+    height, width = mask.shape
+    flat = np.asarray(mask, dtype=bool).ravel(order="F")
+    if flat.size == 0:
+        return {"size": [height, width], "counts": []}
+    return {"size": [height, width], "counts": _rle_counts(flat).tolist()}
+
+
+def encode_rle_crop(crop: np.ndarray, x: int, y: int, height: int, width: int) -> Dict[str, Any]:
+    """COCO RLE of a ``height`` x ``width`` mask that is False outside ``crop`` placed at ``(x, y)``.
+
+    Only the columns the crop spans are scanned; the all-False columns to
+    either side just lengthen the first and last runs.
+    """
+    crop_height, crop_width = crop.shape
+    if height * width == 0:
+        return {"size": [height, width], "counts": []}
+    if crop.size == 0:
+        return {"size": [height, width], "counts": [height * width]}
+
+    columns = np.zeros((height, crop_width), dtype=bool)
+    columns[y:y + crop_height] = crop
+    counts = _rle_counts(columns.ravel(order="F")).tolist()
+    counts[0] += x * height
+    after = (width - x - crop_width) * height
+    if after:
+        if len(counts) % 2:
+            # Runs alternate from False, so an odd count means the last run is False
+            counts[-1] += after
+        else:
+            counts.append(after)
+    return {"size": [height, width], "counts": counts}
+
+
+def decode_rle(rle: Dict[str, Any]) -> np.ndarray:
+    """Decode COCO uncompressed RLE back into a 2D boolean mask"""
+    height, width = rle["size"]
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    values = np.zeros(len(counts), dtype=bool)
+    values[1::2] = True
+    return np.repeat(values, counts).reshape((height, width), order="F")
+
+
+def encode_bitmask(mask: np.ndarray) -> Dict[str, Any]:
+    """Encode a 2D boolean mask as base64 of its row-major packed bits"""
+    height, width = mask.shape
+    packed = np.packbits(np.asarray(mask, dtype=bool), axis=None)
+    return {
+        "size": [height, width],
+        "bits": base64.b64encode(packed.tobytes()).decode("ascii"),
+    }
+
+
+def decode_bitmask(bitmask: Dict[str, Any]) -> np.ndarray:
+    """Decode a base64 packed bitmask back into a 2D boolean mask"""
+    height, width = bitmask["size"]
+    packed = np.frombuffer(base64.b64decode(bitmask["bits"]), dtype=np.uint8)
+    return np.unpackbits(packed, count=height * width).astype(bool).reshape(height, width)
+
+
+def encode_mask(mask: np.ndarray, mask_format: str = DEFAULT_MASK_FORMAT) -> Any:
+    """Encode a boolean mask in the requested wire format"""
+    if mask_format == "rle":
+        return encode_rle(mask)
+    if mask_format == "bitmask":
+        return encode_bitmask(mask)
+    if mask_format == "dense":
+        return np.asarray(mask, dtype=bool).tolist()
+    if mask_format == "polygon":
+        return {"size": list(mask.shape), "polygons": mask_polygons(mask, POLYGON_EPSILON)}
+    raise ValueError(f"Unknown mask format: {mask_format}")
+
+
+def encode_mask_crop(crop: np.ndarray, x: int, y: int, height: int, width: int,
+                     mask_format: str = DEFAULT_MASK_FORMAT) -> Any:
+    """Encode a full-frame mask given only its bbox crop at ``(x, y)``"""
+    if mask_format == "rle":
+        return encode_rle_crop(crop, x, y, height, width)
+    if mask_format == "polygon":
+        return {"size": [height, width], "polygons": mask_polygons(crop, POLYGON_EPSILON, x, y)}
+    full = np.zeros((height, width), dtype=bool)
+    full[y:y + crop.shape[0], x:x + crop.shape[1]] = crop
+    return encode_mask(full, mask_format)
+
+
+def negotiate_mask_format(query_format: Optional[str] = None, accept: Optional[str] = None) -> str:
+    """Pick a mask format from the query parameter, then the Accept header.
+
+    The query parameter wins when present. Otherwise the first Accept media
+    type that names a mask format is used, falling back to RLE.
+    """
+    if query_format:
+        if query_format not in MASK_FORMATS:
+            raise ValueError(
+                f"Unsupported mask_format '{query_format}', expected one of: {', '.join(MASK_FORMATS)}"
+            )
+        return query_format
+
+    if accept:
+        for media_range in accept.split(","):
+            media_type = media_range.split(";", 1)[0].strip().lower()
+            if media_type in MASK_MEDIA_TYPES:
+                return MASK_MEDIA_TYPES[media_type]
+
+    return DEFAULT_MASK_FORMAT
@@ -0,0 +1,453 @@
+"""Mask storage.
+
+Each mask is kept as the bit-packed crop of its bounding box plus the offset
+of that box in the image, so a mask costs roughly ``bbox_area / 8`` bytes
+instead of one Python object per pixel. Area, bbox and centroid are computed
+once when the mask is stored.
+
+:class:`MaskStore` keeps records in memory under a byte budget and an idle
+TTL, in front of an optional :mod:`state` backend. Evicted records can spill
+to the backend, from which they are reloaded on access and which survives
+restarts; a shared backend is written through so every worker process or
+replica sees every record. With an ``mmap_dir`` the packed bits of each
+record live in an ``.npy`` file there instead of on the heap, and masks hold
+read-only memory-mapped slices of it.
+"""
+import json
+import math
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from state import SQLiteState, StateBackend, new_stamp
+
+# Shared records accessed more recently than this are not re-touched in the backend
+TOUCH_INTERVAL = 60.0
+
+
+class StoredMask:
+    """A single mask stored as a packed bbox crop with precomputed statistics"""
+
+    __slots__ = ("id", "height", "width", "bbox", "area", "centroid", "bits", "meta")
+
+    def __init__(self, mask_id: str, height: int, width: int, bbox: List[int], area: int,
+                 centroid: List[float], bits: np.ndarray, meta: Optional[Dict[str, Any]] = None):
+        self.id = mask_id
+        self.height = height
+        self.width = width
+        self.bbox = bbox  # [x, y, width, height]
+        self.area = area
+        self.centroid = centroid  # [x, y]
+        self.bits = bits
+        self.meta = meta or {}
+
+    @classmethod
+    def from_array(cls, mask_id: str, mask: np.ndarray, **meta: Any) -> "StoredMask":
+        """Build a stored mask from a full-frame boolean array"""
+        mask = np.asarray(mask, dtype=bool)
+        height, width = mask.shape
+        rows = np.flatnonzero(mask.any(axis=1))
+        cols = np.flatnonzero(mask.any(axis=0))
+
+        if rows.size == 0:
+            return cls(mask_id, height, width, [0, 0, 0, 0], 0, [0.0, 0.0],
+                       np.zeros(0, dtype=np.uint8), meta)
+
+        y0, y1 = int(rows[0]), int(rows[-1]) + 1
+        x0, x1 = int(cols[0]), int(cols[-1]) + 1
+        crop = mask[y0:y1, x0:x1]
+
+        area = int(np.count_nonzero(crop))
+        col_counts = crop.sum(axis=0)
+        row_counts = crop.sum(axis=1)
+        centroid = [
+            float(x0 + col_counts @ np.arange(crop.shape[1]) / area),
+            float(y0 + row_counts @ np.arange(crop.shape[0]) / area),
+        ]
+
+        return cls(mask_id, height, width, [x0, y0, x1 - x0, y1 - y0], area, centroid,
+                   np.packbits(crop, axis=None), meta)
+
+    @property
+    def shape(self) -> tuple:
+        return (self.height, self.width)
+
+    @property
+    def nbytes(self) -> int:
+        return self.bits.nbytes
+
+    def crop(self) -> np.ndarray:
+        """Return the boolean mask restricted to its bounding box"""
+        _, _, bbox_width, bbox_height = self.bbox
+        count = bbox_width * bbox_height
+        return np.unpackbits(self.bits, count=count).view(bool).reshape(bbox_height, bbox_width)
+
+    def to_array(self) -> np.ndarray:
+        """Return the full-frame boolean mask"""
+        full = np.zeros((self.height, self.width), dtype=bool)
+        x, y, bbox_width, bbox_height = self.bbox
+        if self.area:
+            full[y:y + bbox_height, x:x + bbox_width] = self.crop()
+        return full
+
+    def metadata(self) -> Dict[str, Any]:
+        """Return the JSON-serializable mask fields without pixel data"""
+        return {
+            "id": self.id,
+            "area": self.area,
+            "bbox": list(self.bbox),
+            "centroid": list(self.centroid),
+            **self.meta,
+        }
+
+
+class ImageRecord:
+    """Masks generated for one image, with an id index for O(1) lookup.
+
+    ``width``/``height`` are the original image size. Masks are stored at the
+    working resolution ``working_width``/``working_height``, which defaults to
+    the original size. ``hit_index`` holds the selection index once built;
+    it lives and dies with the record and is not spilled.
+    """
+
+    __slots__ = ("image_id", "width", "height", "working_width", "working_height", "masks", "index", "hit_index")
+
+    def __init__(self, image_id: str, width: int, height: int, masks: List[StoredMask],
+                 working_width: Optional[int] = None, working_height: Optional[int] = None):
+        self.image_id = image_id
+        self.width = width
+        self.height = height
+        self.working_width = working_width or width
+        self.working_height = working_height or height
+        self.masks = masks
+        self.index = {mask.id: mask for mask in masks}
+        self.hit_index = None
+
+    def get(self, mask_id: str) -> Optional[StoredMask]:
+        return self.index.get(mask_id)
+
+    def add_mask(self, mask: StoredMask) -> None:
+        self.masks.append(mask)
+        self.index[mask.id] = mask
+
+    @property
+    def scale(self) -> Tuple[float, float]:
+        """Original pixels per working pixel along x and y"""
+        return self.width / self.working_width, self.height / self.working_height
+
+    def mask_metadata(self, mask: StoredMask) -> Dict[str, Any]:
+        """Mask metadata with pixel fields mapped to original image coordinates"""
+        meta = mask.metadata()
+        scale_x, scale_y = self.scale
+        if scale_x == 1 and scale_y == 1:
+            return meta
+
+        x, y, bbox_width, bbox_height = mask.bbox
+        x0, y0 = math.floor(x * scale_x), math.floor(y * scale_y)
+        meta["bbox"] = [x0, y0, math.ceil((x + bbox_width) * scale_x) - x0,
+                        math.ceil((y + bbox_height) * scale_y) - y0]
+        meta["area"] = round(mask.area * scale_x * scale_y)
+        meta["centroid"] = [(mask.centroid[0] + 0.5) * scale_x - 0.5, (mask.centroid[1] + 0.5) * scale_y - 0.5]
+        if "point_coords" in meta:
+            meta["point_coords"] = [[int((px + 0.5) * scale_x), int((py + 0.5) * scale_y)]
+                                    for px, py in meta["point_coords"]]
+        return meta
+
+    @property
+    def nbytes(self) -> int:
+        return sum(mask.nbytes for mask in self.masks)
+
+
+def pack_masks(masks: List[Dict[str, Any]]) -> List[StoredMask]:
+    """Pack backend mask dicts, keeping every field except the raw arrays and derived stats"""
+    stored = []
+    for i, mask in enumerate(masks):
+        meta = {k: v for k, v in mask.items() if k not in ("id", "segmentation", "area", "bbox")}
+        stored.append(StoredMask.from_array(str(mask.get("id", i)), mask["segmentation"], **meta))
+    return stored
+
+
+def encode_record(record: ImageRecord) -> bytes:
+    """One blob per record: a length-prefixed JSON header, then every mask's packed bits"""
+    entries = [[mask.id, mask.height, mask.width, mask.bbox, mask.area, mask.centroid, mask.meta, mask.bits.size]
+               for mask in record.masks]
+    header = json.dumps([record.width, record.height, record.working_width, record.working_height, entries],
+                        separators=(",", ":")).encode()
+    return b"".join([struct.pack("<I", len(header)), header] + [mask.bits.tobytes() for mask in record.masks])
+
+
+def decode_record(image_id: str, blob: bytes) -> ImageRecord:
+    """Inverse of :func:`encode_record`; mask bits are read-only views into ``blob``"""
+    (length,) = struct.unpack_from("<I", blob)
+    width, height, working_width, working_height, entries = json.loads(blob[4:4 + length])
+    bits = np.frombuffer(blob, dtype=np.uint8, offset=4 + length)
+    masks, offset = [], 0
+    for mask_id, mask_height, mask_width, bbox, area, centroid, meta, size in entries:
+        masks.append(StoredMask(mask_id, mask_height, mask_width, bbox, area, centroid,
+                                bits[offset:offset + size], meta))
+        offset += size
+    return ImageRecord(image_id, width, height, masks, working_width, working_height)
+
+
+def map_record(record: ImageRecord, path: Path) -> None:
+    """Move a record's mask bits into an ``.npy`` file and point every mask at its mapped slice"""
+    if not any(mask.bits.size for mask in record.masks):
+        return  # nothing to map, and empty files can't be
+    temporary = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(temporary, "wb") as f:
+        np.save(f, np.concatenate([mask.bits for mask in record.masks]))
+    os.replace(temporary, path)
+    mapped = np.load(path, mmap_mode="r")
+    offset = 0
+    for mask in record.masks:
+        mask.bits = mapped[offset:offset + mask.bits.size]
+        offset += mask.bits.size
+
+
+def heap_bytes(record: ImageRecord) -> int:
+    """Packed bytes of a record held on the heap rather than mapped from disk"""
+    return sum(mask.nbytes for mask in record.masks if not isinstance(mask.bits, np.memmap))
+
+
+class MaskStore:
+    """Mask records keyed by image_id, bounded by bytes and idle time.
+
+
+    Records are kept in LRU order. When packed mask bytes exceed
+    ``max_bytes`` the least recently used records are evicted; memory-mapped
+    bits don't count, as the page cache decides what stays resident. With a
+    ``spill_dir`` (a local :class:`state.SQLiteState`) they are first written
+    there and reloaded transparently on the next access. With a shared
+    ``state`` backend every record is written through as soon as it is added;
+    a record found in memory is checked against the backend's stamp, so one
+    replaced or removed by another process is never served stale. A
+    ``recheck`` window skips that read for records checked within the last
+    ``recheck`` seconds, at the price of serving a record another process has
+    just replaced for up to that long. Records not
+    accessed for ``ttl`` seconds are removed by :meth:`expire`, from memory
+    and the backend alike.
+    """
+
+    def __init__(self, max_bytes: Optional[int] = None, ttl: Optional[float] = None,
+                 spill_dir: Optional[Path] = None, state: Optional[StateBackend] = None,
+                 mmap_dir: Optional[Path] = None, recheck: float = 0.0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.recheck = recheck
+        self.mmap_dir = Path(mmap_dir) if mmap_dir else None
+        if self.mmap_dir:
+            self.mmap_dir.mkdir(parents=True, exist_ok=True)
+        self.shared = state is not None
+        self.state = state if state is not None else SQLiteState(spill_dir) if spill_dir else None
+        self._records: "OrderedDict[str, ImageRecord]" = OrderedDict()
+        self._accessed: Dict[str, float] = {}
+        self._stamps: Dict[str, bytes] = {}  # backend stamp of each in-memory record
+        self._checked: Dict[str, float] = {}  # when each stamp was last confirmed
+        self._touched: Dict[str, float] = {}  # last access written to the backend
+        self._spilled = set()  # ids with an up-to-date copy in the backend
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self.evictions = 0
+        self.spills = 0
+        self.reloads = 0
+        self.expired = 0
+        if self.state is not None and not self.shared:
+            self._spilled = set(self.state.keys())
+
+    def put(self, image_id: str, width: int, height: int, masks: List[Dict[str, Any]]) -> ImageRecord:
+        """Store backend mask dicts, packing each ``segmentation`` array"""
+        return self.add(ImageRecord(image_id, width, height, pack_masks(masks)))
+
+    def add(self, record: ImageRecord) -> ImageRecord:
+        """Store an already packed record, replacing any earlier one for the image"""
+        with self._lock:
+            self._delete(record.image_id)
+            self._insert(record)
+            if self.shared:
+                self._spill(record)
+        return record
+
+    def get(self, image_id: str) -> Optional[ImageRecord]:
+        """Return a record, reloading it from the backend if it was evicted or replaced"""
+        with self._lock:
+            record = self._records.get(image_id)
+            now = time.time()
+            if record is not None and self.shared and now - self._checked.get(image_id, 0) >= self.recheck:
+                if self.state.stamp(image_id) != self._stamps.get(image_id):
+                    # Replaced or removed by another process
+                    self._forget(image_id)
+                    record = None
+                else:
+                    self._checked[image_id] = now
+            if record is not None:
+                self._records.move_to_end(image_id)
+                self._accessed[image_id] = now
+                if self.shared and now - self._touched.get(image_id, 0) > TOUCH_INTERVAL:
+                    self.state.touch(image_id, now)
+                    self._touched[image_id] = now
+                return record
+            # Other processes sharing the backend may have written it
+            loaded = self.state.load(image_id) if self.state is not None else None
+            if loaded is None:
+                self._spilled.discard(image_id)
+                return None
+            blob, stamp = loaded
+            record = decode_record(image_id, blob)
+            self._spilled.add(image_id)
+            self.reloads += 1
+            self._insert(record)
+            self._stamps[image_id] = stamp
+            self._checked[image_id] = now
+            return record
+
+    def __getitem__(self, image_id: str) -> ImageRecord:
+        record = self.get(image_id)
+        if record is None:
+            raise KeyError(image_id)
+        return record
+
+    def __contains__(self, image_id: object) -> bool:
+        if self.shared:
+            # Load it now, so the lookup that usually follows hits memory
+            return self.get(image_id) is not None
+        if image_id in self._records or image_id in self._spilled:
+            return True
+        if self.state is None:
+            return False
+        with self._lock:
+            return self.state.stamp(image_id) is not None
+
+    def __len__(self) -> int:
+        return len(self._ids())
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self._ids()))
+
+    def pop(self, image_id: str) -> Optional[ImageRecord]:
+        """Remove a record from memory and the backend, returning the in-memory copy if any"""
+        with self._lock:
+            return self._delete(image_id)
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes held on the heap by packed mask data across all images"""
+        return self._bytes
+
+    @property
+    def mapped_bytes(self) -> int:
+        """Bytes of packed mask data mapped from ``mmap_dir``"""
+        return sum(record.nbytes for record in list(self._records.values())) - self._bytes
+
+    def expire(self, now: Optional[float] = None) -> List[str]:
+        """Remove records idle for longer than ``ttl``; returns their ids"""
+        if not self.ttl:
+            return []
+        cutoff = (now if now is not None else time.time()) - self.ttl
+        with self._lock:
+            expired = [image_id for image_id, accessed in self._accessed.items() if accessed < cutoff]
+            if self.shared:
+                # Another process may still be using it; go by the backend's access time
+                for image_id in expired:
+                    self._forget(image_id)
+                expired = self.state.expired(cutoff)
+            elif self.state is not None:
+                expired.extend(image_id for image_id in self.state.expired(cutoff) if image_id not in self._records)
+            for image_id in expired:
+                self._delete(image_id)
+            self.expired += len(expired)
+        return expired
+
+    def spill_all(self) -> None:
+        """Write every in-memory record to the backend, e.g. before shutdown"""
+        with self._lock:
+            for record in self._records.values():
+                self._spill(record)
+
+    def close(self) -> None:
+        if self.state is not None:
+            self.state.close()
+            self.state = None
+            self.shared = False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "records": len(self._records),
+            "spilled_records": len(self._spilled),
+            "bytes": self._bytes,
+            "mapped_bytes": self.mapped_bytes if self.mmap_dir else 0,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "shared": self.shared,
+            "evictions": self.evictions,
+            "spills": self.spills,
+            "reloads": self.reloads,
+            "expired": self.expired,
+        }
+
+    def _ids(self) -> set:
+        if self.shared:
+            return set(self.state.keys())
+        return self._spilled.union(self._records)
+
+    def _insert(self, record: ImageRecord) -> None:
+        if self.mmap_dir is not None:
+            map_record(record, self._mmap_path(record.image_id))
+        self._records[record.image_id] = record
+        self._accessed[record.image_id] = time.time()
+        self._bytes += heap_bytes(record)
+        # Never evict the record just inserted, even if it alone exceeds the budget
+        while self.max_bytes is not None and self._bytes > self.max_bytes and len(self._records) > 1:
+            image_id, evicted = self._records.popitem(last=False)
+            self.evictions += 1
+            self._spill(evicted)
+            self._forget(image_id, evicted)
+
+    def _forget(self, image_id: str, record: Optional[ImageRecord] = None) -> Optional[ImageRecord]:
+        """Drop the in-memory copy only"""
+        record = record or self._records.pop(image_id, None)
+        self._accessed.pop(image_id, None)
+        self._stamps.pop(image_id, None)
+        self._checked.pop(image_id, None)
+        self._touched.pop(image_id, None)
+        if record is not None:
+            self._bytes -= heap_bytes(record)
+        return record
+
+    def _mmap_path(self, image_id: str) -> Path:
+        return self.mmap_dir / f"{image_id}.npy"
+
+    def _delete(self, image_id: str) -> Optional[ImageRecord]:
+        record = self._forget(image_id)
+        self._spilled.discard(image_id)
+        if self.state is not None:
+            self.state.delete(image_id)
+        if self.mmap_dir is not None:
+            # Views still in use keep the unlinked file's pages alive
+            self._mmap_path(image_id).unlink(missing_ok=True)
+        return record
+
+    def _spill(self, record: ImageRecord) -> None:
+        """Write a record's blob to the backend"""
+        if self.state is None:
+            return
+        image_id = record.image_id
+        accessed = self._accessed.get(image_id, time.time())
+        if image_id in self._spilled:
+            # Records don't change once stored, so only the access time is stale
+            if accessed > self._touched.get(image_id, 0):
+                self.state.touch(image_id, accessed)
+                self._touched[image_id] = accessed
+            return
+        stamp = new_stamp()
+        self.state.save(image_id, encode_record(record), stamp, accessed)
+        self._stamps[image_id] = stamp
+        self._checked[image_id] = time.time()
+        self._touched[image_id] = accessed
+        self._spilled.add(image_id)
+        self.spills += 1
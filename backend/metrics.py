@@ -0,0 +1,247 @@
+"""Prometheus metrics and per-stage timing.
+
+Pipeline stages (read, decode, segment, serialize, composite, encode,
+write) are timed with :func:`stage`. Stages that run on the worker pool go
+through :func:`timed_call`, which collects their timings inside the worker
+and hands them back with the result, so process pools are measured too; the
+event loop then records them with :func:`record_stages`. Timings feed the
+stage histograms and, when a request is being traced, its ``Server-Timing``
+header.
+
+Metrics are rendered in the Prometheus text exposition format without
+depending on ``prometheus_client``.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+STAGES = ("read", "decode", "segment", "serialize", "composite", "encode", "write")
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BYTES_BUCKETS = tuple(1024 * 4 ** power for power in range(10))  # 1 KiB .. 256 MiB
+
+# (name, type, help, [(suffix, labels, value)]) as produced by a collector
+Family = Tuple[str, str, str, List[Tuple[str, Dict[str, str], float]]]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(str(value))}"' for key, value in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Histogram:
+    """Cumulative-bucket histogram with optional labels"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = SECONDS_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple[str, ...], List[float]] = {}  # labels -> bucket counts + [sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def count(self, **labels: str) -> int:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            return int(series[-1]) if series else 0
+
+    def collect(self) -> Family:
+        samples = []
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        for key, values in sorted(series.items()):
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, values):
+                cumulative += bucket_count
+                samples.append(("_bucket", {**labels, "le": _format_value(bound)}, cumulative))
+            samples.append(("_bucket", {**labels, "le": "+Inf"}, values[-1]))
+            samples.append(("_sum", labels, values[-2]))
+            samples.append(("_count", labels, values[-1]))
+        return self.name, "histogram", self.documentation, samples
+
+
+class Registry:
+    """Histograms plus callbacks that read counters and gauges at scrape time"""
+
+    def __init__(self):
+        self._histograms: List[Histogram] = []
+        self._collectors: List[Callable[[], Iterable[Family]]] = []
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        histogram = Histogram(*args, **kwargs)
+        self._histograms.append(histogram)
+        return histogram
+
+    def register(self, collector: Callable[[], Iterable[Family]]) -> None:
+        """Add a callable returning metric families, called on every scrape"""
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format (version 0.0.4)"""
+        families = [histogram.collect() for histogram in self._histograms]
+        for collector in self._collectors:
+            families.extend(collector())
+        lines = []
+        for name, kind, documentation, samples in families:
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {kind}")
+            for suffix, labels, value in samples:
+                lines.append(f"{name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def gauge(name: str, documentation: str, samples: Iterable[Tuple[Dict[str, str], float]]) -> Family:
+    return name, "gauge", documentation, [("", labels, value) for labels, value in samples]
+
+
+def counter(name: str, documentation: str, samples: Iterable[Tuple[Dict[str, str], float]]) -> Family:
+    return name, "counter", documentation, [("_total", labels, value) for labels, value in samples]
+
+
+registry = Registry()
+
+stage_seconds = registry.histogram(
+    "sam2_stage_seconds", "Time spent in each pipeline stage", ["stage"]
+)
+request_seconds = registry.histogram(
+    "sam2_request_seconds", "HTTP request latency", ["method", "handler", "status"]
+)
+payload_bytes = registry.histogram(
+    "sam2_payload_bytes", "Request and response body sizes", ["handler", "direction"], BYTES_BUCKETS
+)
+
+# Timings collected inside a worker call, and those of the request being traced
+_worker_timings: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar("worker_timings", default=None)
+_request_timings: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar("request_timings", default=None)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Time the enclosed block as pipeline stage ``name``"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        timings = _worker_timings.get()
+        if timings is not None:
+            timings.append((name, elapsed))
+        else:
+            record_stages([(name, elapsed)])
+
+
+def timed_call(name: Optional[str], func: Callable, *args) -> Tuple[List[Tuple[str, float]], object]:
+    """Run ``func(*args)`` and return ``(timings, result)``.
+
+    The whole call is timed as stage ``name``; with ``name=None`` only the
+    stages ``func`` marks itself are collected. Module-level so it can be
+    sent to a process pool.
+    """
+    token = _worker_timings.set([])
+    try:
+        if name is None:
+            result = func(*args)
+        else:
+            with stage(name):
+                result = func(*args)
+        return _worker_timings.get(), result
+    finally:
+        _worker_timings.reset(token)
+
+
+def record_stages(timings: Iterable[Tuple[str, float]]) -> None:
+    """Add stage timings to the histograms and to the traced request, if any"""
+    traced = _request_timings.get()
+    for name, seconds in timings:
+        stage_seconds.observe(seconds, stage=name)
+        if traced is not None:
+            traced.append((name, seconds))
+
+
+def server_timing(timings: Iterable[Tuple[str, float]]) -> str:
+    """``Server-Timing`` header value, summing repeated stages in first-seen order"""
+    totals: Dict[str, float] = {}
+    for name, seconds in timings:
+        totals[name] = totals.get(name, 0.0) + seconds
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in totals.items())
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording request latency and body sizes.
+
+    With ``server_timing`` enabled, the stages a request ran are reported
+    back in a ``Server-Timing`` header (stages that finish after the
+    response has started, as in streamed responses, are not included).
+    """
+
+    def __init__(self, app, server_timing: bool = False):
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        timings: List[Tuple[str, float]] = []
+        token = _request_timings.set(timings)
+        sizes = {"request": 0, "response": 0}
+        status = [500]
+
+        async def counting_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                sizes["request"] += len(message.get("body", b""))
+            return message
+
+        async def timing_send(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                if self.server_timing:
+                    header = server_timing(timings + [("total", time.perf_counter() - start)])
+                    message = {**message, "headers": [*message.get("headers", []),
+                                                      (b"server-timing", header.encode("latin-1"))]}
+            elif message["type"] == "http.response.body":
+                sizes["response"] += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, timing_send)
+        finally:
+            _request_timings.reset(token)
+            route = scope.get("route")
+            handler = getattr(route, "path", None) or "unmatched"
+            request_seconds.observe(time.perf_counter() - start, method=scope["method"],
+                                    handler=handler, status=str(status[0]))
+            for direction, size in sizes.items():
+                payload_bytes.observe(size, handler=handler, direction=direction)
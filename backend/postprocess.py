@@ -0,0 +1,260 @@
+"""Post-processing of generated masks and polygon export.
+
+Automatic mask generation returns noisy, overlapping masks. The optional
+clean-up stage works on each stored mask's bbox crop at the working
+resolution:
+
+- small connected components are dropped (:func:`remove_small_components`),
+- enclosed holes are filled (:func:`fill_holes`),
+- near-duplicates are suppressed by mask IoU, highest score first, with a
+  bbox bound ruling out most pairs before any pixels are compared (:func:`nms`).
+
+:func:`mask_polygons` exports simplified outer contours, a compact output
+format for building outlines. Components and contours use OpenCV when
+available and NumPy otherwise, like :func:`backends.connected_components`.
+"""
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from backends import CV2_AVAILABLE, connected_components, cv2
+from mask_store import StoredMask
+
+# Moore neighbourhood, clockwise from west (x right, y down)
+_NEIGHBOURS = ((-1, 0), (-1, -1), (0, -1), (1, -1), (1, 0), (1, 1), (0, 1), (-1, 1))
+_DIRECTION = {offset: index for index, offset in enumerate(_NEIGHBOURS)}
+
+
+def remove_small_components(mask: np.ndarray, min_area: int) -> np.ndarray:
+    """Drop 4-connected components smaller than ``min_area`` pixels"""
+    count, labels = connected_components(mask)
+    if count == 0:
+        return mask
+    sizes = np.bincount(labels.ravel(), minlength=count + 1)
+    keep = sizes >= min_area
+    keep[0] = False
+    return keep[labels]
+
+
+def fill_holes(mask: np.ndarray, max_area: Optional[int] = None) -> np.ndarray:
+    """Fill background regions enclosed by the mask, only those up to ``max_area`` pixels if given"""
+    # Pad so all outside background is one component touching the border
+    padded = np.zeros((mask.shape[0] + 2, mask.shape[1] + 2), dtype=bool)
+    padded[1:-1, 1:-1] = mask
+    count, labels = connected_components(~padded)
+    if count <= 1:
+        return mask
+    fill = np.ones(count + 1, dtype=bool)
+    fill[0] = False  # the mask itself
+    fill[labels[0, 0]] = False  # the outside
+    if max_area is not None:
+        fill &= np.bincount(labels.ravel(), minlength=count + 1) <= max_area
+    return mask | fill[labels[1:-1, 1:-1]]
+
+
+def _from_crop(mask: StoredMask, crop: np.ndarray) -> StoredMask:
+    """Repack a cleaned crop of ``mask``, keeping its id, frame and metadata"""
+    x, y = mask.bbox[:2]
+    cleaned = StoredMask.from_array(mask.id, crop, **mask.meta)
+    cleaned.height, cleaned.width = mask.height, mask.width
+    if cleaned.area:
+        cleaned.bbox = [cleaned.bbox[0] + x, cleaned.bbox[1] + y, cleaned.bbox[2], cleaned.bbox[3]]
+        cleaned.centroid = [cleaned.centroid[0] + x, cleaned.centroid[1] + y]
+    return cleaned
+
+
+def _score(mask: StoredMask) -> Tuple[float, float, int]:
+    return (mask.meta.get("predicted_iou", mask.meta.get("score", 0.0)),
+            mask.meta.get("stability_score", 0.0), mask.area)
+
+
+def _bbox_intersection(a: List[int], b: List[int]) -> Tuple[int, int, int, int]:
+    x0, y0 = max(a[0], b[0]), max(a[1], b[1])
+    x1, y1 = min(a[0] + a[2], b[0] + b[2]), min(a[1] + a[3], b[1] + b[3])
+    return x0, y0, x1, y1
+
+
+def mask_iou(a: StoredMask, b: StoredMask, crops: Optional[Dict[str, np.ndarray]] = None) -> float:
+    """Exact IoU of two stored masks, comparing pixels only inside their bbox intersection"""
+    x0, y0, x1, y1 = _bbox_intersection(a.bbox, b.bbox)
+    if x1 <= x0 or y1 <= y0:
+        return 0.0
+    crops = {} if crops is None else crops
+    crop_a = crops.get(a.id)
+    if crop_a is None:
+        crop_a = crops[a.id] = a.crop()
+    crop_b = crops.get(b.id)
+    if crop_b is None:
+        crop_b = crops[b.id] = b.crop()
+    inter = np.count_nonzero(
+        crop_a[y0 - a.bbox[1]:y1 - a.bbox[1], x0 - a.bbox[0]:x1 - a.bbox[0]]
+        & crop_b[y0 - b.bbox[1]:y1 - b.bbox[1], x0 - b.bbox[0]:x1 - b.bbox[0]]
+    )
+    return inter / (a.area + b.area - inter)
+
+
+def is_duplicate(mask: StoredMask, kept: Sequence[StoredMask], iou_threshold: float,
+                 crops: Optional[Dict[str, np.ndarray]] = None) -> bool:
+    """Whether ``mask`` overlaps any of ``kept`` by at least ``iou_threshold`` IoU"""
+    for other in kept:
+        # IoU <= min(intersection bound, smaller area) / union, so most pairs stop here
+        x0, y0, x1, y1 = _bbox_intersection(mask.bbox, other.bbox)
+        if x1 <= x0 or y1 <= y0:
+            continue
+        bound = min((x1 - x0) * (y1 - y0), mask.area, other.area)
+        if bound / (mask.area + other.area - bound) < iou_threshold:
+            continue
+        if mask_iou(mask, other, crops) >= iou_threshold:
+            return True
+    return False
+
+
+def nms(masks: Sequence[StoredMask], iou_threshold: float) -> List[StoredMask]:
+    """Suppress masks overlapping a higher-scoring one by at least ``iou_threshold`` IoU.
+
+    Scores are ``predicted_iou`` (or ``score``), then ``stability_score``,
+    then area. Survivors keep their original order.
+    """
+    kept: List[StoredMask] = []
+    crops: Dict[str, np.ndarray] = {}
+    for mask in sorted(masks, key=_score, reverse=True):
+        if not is_duplicate(mask, kept, iou_threshold, crops):
+            kept.append(mask)
+    order = {id(mask): index for index, mask in enumerate(masks)}
+    return sorted(kept, key=lambda mask: order[id(mask)])
+
+
+def clean_mask(mask: StoredMask, min_component_area: int = 0, max_hole_area: int = 0) -> StoredMask:
+    """Component filtering and hole filling on one mask's crop; unchanged when both are off"""
+    if not mask.area or (min_component_area <= 0 and max_hole_area <= 0):
+        return mask
+    crop = mask.crop()
+    if min_component_area > 0:
+        crop = remove_small_components(crop, min_component_area)
+    if max_hole_area > 0:
+        crop = fill_holes(crop, max_hole_area)
+    return _from_crop(mask, crop)
+
+
+def postprocess_masks(masks: Sequence[StoredMask], min_component_area: int = 0, max_hole_area: int = 0,
+                      nms_iou: float = 0.0) -> List[StoredMask]:
+    """Clean every mask, drop the ones left empty, then suppress duplicates when ``nms_iou`` is set"""
+    cleaned = [clean_mask(mask, min_component_area, max_hole_area) for mask in masks]
+    cleaned = [mask for mask in cleaned if mask.area]
+    if nms_iou > 0:
+        cleaned = nms(cleaned, nms_iou)
+    return cleaned
+
+
+def _components_8(mask: np.ndarray) -> Tuple[int, np.ndarray]:
+    """8-connected components: 4-connected ones merged where they touch diagonally"""
+    count, labels = connected_components(mask)
+    if count < 2:
+        return count, labels
+    parent = np.arange(count + 1)
+
+    def find(label: int) -> int:
+        while parent[label] != label:
+            parent[label] = parent[parent[label]]
+            label = parent[label]
+        return label
+
+    for a, b in ((labels[:-1, :-1], labels[1:, 1:]), (labels[:-1, 1:], labels[1:, :-1])):
+        touching = (a > 0) & (b > 0) & (a != b)
+        for first, second in set(zip(a[touching].tolist(), b[touching].tolist())):
+            root_first, root_second = find(first), find(second)
+            if root_first != root_second:
+                parent[max(root_first, root_second)] = min(root_first, root_second)
+    roots = np.array([find(label) for label in range(count + 1)])
+    _, merged = np.unique(roots, return_inverse=True)
+    return int(merged.max()), merged[labels]
+
+
+def _trace_boundary(component: np.ndarray, start: Tuple[int, int]) -> List[Tuple[int, int]]:
+    """Outer boundary of one 8-connected component by Moore-neighbour tracing"""
+    height, width = component.shape
+    contour = [start]
+    current, backtrack = start, 0  # entered the topmost-leftmost pixel from the west
+    seen = set()
+    while True:
+        x, y = current
+        for step in range(1, 9):
+            direction = (backtrack + step) % 8
+            dx, dy = _NEIGHBOURS[direction]
+            nx, ny = x + dx, y + dy
+            if 0 <= nx < width and 0 <= ny < height and component[ny, nx]:
+                px, py = _NEIGHBOURS[(direction - 1) % 8]
+                backtrack = _DIRECTION[(x + px - nx, y + py - ny)]
+                current = (nx, ny)
+                break
+        else:
+            return contour  # a single pixel
+        if (current, backtrack) in seen:
+            break
+        seen.add((current, backtrack))
+        contour.append(current)
+    # The walk ends after retracing the start
+    while len(contour) > 1 and contour[-1] == contour[0]:
+        contour.pop()
+    return contour
+
+
+def _simplify(points: np.ndarray, epsilon: float) -> np.ndarray:
+    """Douglas-Peucker simplification of an open polyline"""
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        segment = points[last] - points[first]
+        offsets = points[first + 1:last] - points[first]
+        length = np.hypot(*segment)
+        if length == 0:
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            distances = np.abs(segment[0] * offsets[:, 1] - segment[1] * offsets[:, 0]) / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > epsilon:
+            split = first + 1 + farthest
+            keep[split] = True
+            stack.extend(((first, split), (split, last)))
+    return points[keep]
+
+
+def _approximate_closed(contour: np.ndarray, epsilon: float) -> np.ndarray:
+    """Simplify a closed contour by splitting it at the point farthest from its start"""
+    if len(contour) < 3:
+        return contour
+    split = int(np.argmax(np.hypot(*(contour - contour[0]).T)))
+    first = _simplify(contour[:split + 1], epsilon)
+    second = _simplify(np.vstack((contour[split:], contour[:1])), epsilon)
+    return np.vstack((first, second[1:-1]))
+
+
+def mask_polygons(mask: np.ndarray, epsilon: float = 1.0, x: int = 0, y: int = 0) -> List[List[int]]:
+    """Simplified outer contours as flat ``[x0, y0, x1, y1, ...]`` lists, offset by ``(x, y)``.
+
+    Contours run through boundary pixel centres; those with fewer than three
+    vertices after simplification are dropped.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    if CV2_AVAILABLE:
+        contours, _ = cv2.findContours(mask.view(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        polygons = [cv2.approxPolyDP(contour, epsilon, True).reshape(-1, 2) for contour in contours]
+    else:
+        # Outer contours of 8-connected components, as with RETR_EXTERNAL
+        polygons = []
+        count, labels = _components_8(mask)
+        for label in range(1, count + 1):
+            component = mask & (labels == label)
+            rows, cols = np.nonzero(component)
+            if rows.size == 0:
+                continue
+            start = (int(cols[0]), int(rows[0]))
+            contour = _trace_boundary(component, start)
+            # Moore tracing runs clockwise; OpenCV lists outer contours the other way round
+            contour = np.array(contour[:1] + contour[:0:-1], dtype=np.float64)
+            polygons.append(_approximate_closed(contour, epsilon).astype(np.int64))
+    return [(polygon + (x, y)).ravel().tolist() for polygon in polygons if len(polygon) >= 3]
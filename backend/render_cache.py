@@ -0,0 +1,108 @@
+"""Content-addressed disk cache of rendered outputs.
+
+Each rendered image is stored once under a key derived from everything that
+determines its bytes, so repeated requests are answered without compositing
+or encoding again and clients can cache responses forever by key. Files are
+written to a temporary name and moved into place atomically, so concurrent
+renders never expose a partially written file. Total size is capped by
+evicting the least recently used files.
+"""
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+
+class RenderCache:
+    """LRU cache of rendered files bounded by total bytes"""
+
+    def __init__(self, directory: Path, max_bytes: int = 512 * 1024 * 1024):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, int]" = OrderedDict()  # file name -> size
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # Pick up renders from a previous run, oldest first
+        existing = [path for path in self.directory.iterdir() if path.is_file() and not path.name.startswith(".")]
+        for path in sorted(existing, key=lambda path: path.stat().st_mtime):
+            self._entries[path.name] = path.stat().st_size
+            self._bytes += path.stat().st_size
+        self._evict()
+
+    def path(self, key: str, extension: str) -> Path:
+        return self.directory / f"{key}.{extension}"
+
+    def temp_path(self, extension: str) -> Path:
+        """A unique path to render into before :meth:`put`"""
+        return self.directory / f".{uuid.uuid4().hex}.{extension}"
+
+    def get(self, key: str, extension: str) -> Optional[Path]:
+        """Return the cached file for ``key``, or None on a miss"""
+        return self.find(key, (extension,))
+
+    def find(self, key: str, extensions: Iterable[str]) -> Optional[Path]:
+        """Return the cached file for ``key`` in whichever of ``extensions`` it was rendered, or None.
+
+        Files another process rendered into the same directory are adopted.
+        """
+        with self._lock:
+            for extension in extensions:
+                name = f"{key}.{extension}"
+                try:
+                    size = (self.directory / name).stat().st_size
+                except FileNotFoundError:
+                    self._forget(name)
+                    continue
+                if name in self._entries:
+                    self._entries.move_to_end(name)
+                else:
+                    self._entries[name] = size
+                    self._bytes += size
+                    self._evict(keep=name)
+                self.hits += 1
+                return self.directory / name
+            self.misses += 1
+            return None
+
+    def put(self, key: str, extension: str, rendered: Path) -> Path:
+        """Atomically move a rendered temp file into the cache under ``key``"""
+        path = self.path(key, extension)
+        size = rendered.stat().st_size
+        os.replace(rendered, path)
+        with self._lock:
+            self._forget(path.name)
+            self._entries[path.name] = size
+            self._bytes += size
+            self._evict(keep=path.name)
+        return path
+
+    def _forget(self, name: str) -> None:
+        size = self._entries.pop(name, None)
+        if size is not None:
+            self._bytes -= size
+
+    def _evict(self, keep: Optional[str] = None) -> None:
+        while self._bytes > self.max_bytes and self._entries:
+            name = next(iter(self._entries))
+            if name == keep:
+                break
+            self._forget(name)
+            (self.directory / name).unlink(missing_ok=True)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,88 @@
+"""Working-resolution helpers.
+
+Segmentation runs on a downscaled copy of each image whose longest side is
+at most ``max_side``. Masks stay at that size in the store; these helpers
+map prompt points into working coordinates and upsample mask regions back
+to the original resolution when an output needs it.
+"""
+from typing import List, Tuple
+
+import numpy as np
+
+UPSAMPLING_METHODS = ("nearest", "bilinear")
+
+
+def working_size(width: int, height: int, max_side: int) -> Tuple[int, int]:
+    """Size of the working copy; unchanged when ``max_side`` is 0 or already satisfied"""
+    longest = max(width, height)
+    if max_side <= 0 or longest <= max_side:
+        return width, height
+    scale = max_side / longest
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def to_working_points(points: List[List[int]], scale_x: float, scale_y: float,
+                      working_width: int, working_height: int) -> List[List[int]]:
+    """Map original-resolution points to working pixels (``scale`` is original / working)"""
+    return [
+        [min(working_width - 1, max(0, int(x / scale_x))), min(working_height - 1, max(0, int(y / scale_y)))]
+        for x, y in points
+    ]
+
+
+def _source_coords(start: int, stop: int, scale: float) -> np.ndarray:
+    """Pixel-centre mapping from output pixels back to fractional source pixels"""
+    return (np.arange(start, stop) + 0.5) / scale - 0.5
+
+
+def upsample_region(crop: np.ndarray, bbox: List[int], scale_x: float, scale_y: float,
+                    full_width: int, full_height: int, method: str = "nearest") -> Tuple[int, int, np.ndarray]:
+    """Upsample a working-resolution bbox crop into original-resolution pixels.
+
+    Returns ``(x0, y0, region)`` where ``region`` is the boolean mask for the
+    original-resolution pixels starting at ``(x0, y0)``. Only the area under
+    the mask's bbox is computed.
+    """
+    x, y, width, height = bbox
+    x0 = max(0, int(np.floor(x * scale_x)))
+    y0 = max(0, int(np.floor(y * scale_y)))
+    x1 = min(full_width, int(np.ceil((x + width) * scale_x)))
+    y1 = min(full_height, int(np.ceil((y + height) * scale_y)))
+    if x1 <= x0 or y1 <= y0 or width == 0 or height == 0:
+        return x0, y0, np.zeros((max(0, y1 - y0), max(0, x1 - x0)), dtype=bool)
+
+    src_x = _source_coords(x0, x1, scale_x) - x
+    src_y = _source_coords(y0, y1, scale_y) - y
+
+    if method == "nearest":
+        cols = np.floor(src_x + 0.5).astype(np.int64)
+        rows = np.floor(src_y + 0.5).astype(np.int64)
+        valid_cols = (cols >= 0) & (cols < width)
+        valid_rows = (rows >= 0) & (rows < height)
+        region = crop[np.clip(rows, 0, height - 1)][:, np.clip(cols, 0, width - 1)]
+        return x0, y0, region & valid_rows[:, None] & valid_cols[None, :]
+
+    if method != "bilinear":
+        raise ValueError(f"Unknown upsampling method '{method}', expected one of: {', '.join(UPSAMPLING_METHODS)}")
+
+    # Separable bilinear interpolation over the zero-padded crop, thresholded at 0.5
+    padded = np.zeros((height + 2, width + 2), dtype=np.float32)
+    padded[1:-1, 1:-1] = crop
+    src_x = np.clip(src_x + 1, 0, width + 1)
+    src_y = np.clip(src_y + 1, 0, height + 1)
+    cx0 = np.minimum(np.floor(src_x).astype(np.int64), width)
+    cy0 = np.minimum(np.floor(src_y).astype(np.int64), height)
+    wx = (src_x - cx0).astype(np.float32)
+    wy = (src_y - cy0).astype(np.float32)
+    rows = padded[cy0] * (1 - wy)[:, None] + padded[cy0 + 1] * wy[:, None]
+    values = rows[:, cx0] * (1 - wx)[None, :] + rows[:, cx0 + 1] * wx[None, :]
+    return x0, y0, values >= 0.5
+
+
+def upsample_mask(crop: np.ndarray, bbox: List[int], scale_x: float, scale_y: float,
+                  full_width: int, full_height: int, method: str = "nearest") -> np.ndarray:
+    """Full-frame original-resolution mask from a working-resolution bbox crop"""
+    full = np.zeros((full_height, full_width), dtype=bool)
+    x0, y0, region = upsample_region(crop, bbox, scale_x, scale_y, full_width, full_height, method)
+    full[y0:y0 + region.shape[0], x0:x0 + region.shape[1]] = region
+    return full
@@ -0,0 +1,57 @@
+"""Pre-serialized responses for mask-heavy endpoints.
+
+Mask payloads are plain dicts and lists built from NumPy arrays, so they
+are turned into bytes directly instead of going through FastAPI's
+``jsonable_encoder``: with ``orjson`` when it is installed, the stdlib
+``json`` otherwise. Clients that send ``Accept: application/msgpack`` get
+MessagePack when ``msgpack`` is installed. Encoding is a plain function so
+it can run on the worker pool.
+"""
+import json
+from typing import Any, Optional, Tuple
+
+from fastapi import Response
+
+# Try to import orjson, fallback to the stdlib json if not available
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+# Try to import msgpack; MessagePack is only offered when it is installed
+try:
+    import msgpack
+    MSGPACK_AVAILABLE = True
+except ImportError:
+    MSGPACK_AVAILABLE = False
+
+JSON_MEDIA_TYPE = "application/json"
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+MSGPACK_MEDIA_TYPES = (MSGPACK_MEDIA_TYPE, "application/x-msgpack", "application/vnd.msgpack")
+
+
+def negotiate_encoding(accept: Optional[str]) -> str:
+    """``"msgpack"`` when the Accept header asks for it and it is available, else ``"json"``"""
+    if accept and MSGPACK_AVAILABLE:
+        for media_range in accept.split(","):
+            if media_range.split(";", 1)[0].strip().lower() in MSGPACK_MEDIA_TYPES:
+                return "msgpack"
+    return "json"
+
+
+def encode_body(content: Any, encoding: str = "json") -> Tuple[bytes, str]:
+    """Serialize a response payload, returning ``(body, media_type)``"""
+    if encoding == "msgpack":
+        return msgpack.packb(content, use_bin_type=True), MSGPACK_MEDIA_TYPE
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY), JSON_MEDIA_TYPE
+    return json.dumps(content, separators=(",", ":")).encode("utf-8"), JSON_MEDIA_TYPE
+
+
+class EncodedResponse(Response):
+    """Response whose body was already produced by :func:`encode_body`"""
+
+    def __init__(self, body: Tuple[bytes, str], status_code: int = 200, headers: Optional[dict] = None):
+        content, media_type = body
+        super().__init__(content=content, status_code=status_code, headers=headers, media_type=media_type)
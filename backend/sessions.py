@@ -0,0 +1,184 @@
+"""Interactive refinement sessions for point prompts.
+
+A session remembers every click made on one image together with the last
+predicted mask and its low-resolution logits. Each new click only carries
+the added points; the session supplies the rest, feeds the previous logits
+back to the backend as ``mask_input``, and reports only what changed.
+
+With a shared :mod:`state` backend each session is saved there after every
+click and reloaded before the next, so consecutive clicks may land on
+different worker processes. Clicks on one session are serialized within a
+process; concurrent clicks on the same session in two processes are not,
+and the later one wins.
+"""
+import asyncio
+import io
+import json
+import struct
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from mask_codec import encode_mask
+from mask_store import StoredMask
+from state import StateBackend
+
+
+class RefinementSession:
+    """Prompt history and last mask for one (image_id, session_id)"""
+
+    def __init__(self, image_id: str, session_id: str):
+        self.image_id = image_id
+        self.session_id = session_id
+        self.points: List[List[int]] = []
+        self.labels: List[int] = []
+        self.logits: Optional[np.ndarray] = None
+        self.mask: Optional[StoredMask] = None
+        self.updated_at = time.time()
+        self.lock = asyncio.Lock()
+
+    def reset(self) -> None:
+        """Forget earlier clicks; the last mask stays as the base for the next diff"""
+        self.points, self.labels = [], []
+        self.logits = None
+
+
+def encode_session(session: RefinementSession) -> bytes:
+    """A length-prefixed JSON header with the clicks, then the last mask's packed bits and the logits as .npy"""
+    mask = session.mask
+    logits = b""
+    if session.logits is not None:
+        buffer = io.BytesIO()
+        np.save(buffer, np.asarray(session.logits), allow_pickle=False)
+        logits = buffer.getvalue()
+    header = json.dumps({
+        "points": session.points,
+        "labels": session.labels,
+        "mask": [mask.height, mask.width, mask.bbox, mask.area, mask.centroid, mask.bits.size] if mask else None,
+    }, separators=(",", ":")).encode()
+    bits = mask.bits.tobytes() if mask else b""
+    return b"".join([struct.pack("<I", len(header)), header, bits, logits])
+
+
+def decode_session(session: RefinementSession, blob: bytes) -> None:
+    """Restore the clicks, mask and logits saved by :func:`encode_session` into ``session``"""
+    (length,) = struct.unpack_from("<I", blob)
+    header = json.loads(blob[4:4 + length])
+    offset = 4 + length
+    session.points, session.labels = header["points"], header["labels"]
+    session.mask = None
+    if header["mask"] is not None:
+        height, width, bbox, area, centroid, size = header["mask"]
+        bits = np.frombuffer(blob, dtype=np.uint8, count=size, offset=offset)
+        session.mask = StoredMask("refined", height, width, bbox, area, centroid, bits)
+        offset += size
+    session.logits = np.load(io.BytesIO(blob[offset:]), allow_pickle=False) if offset < len(blob) else None
+
+
+def mask_diff(previous: Optional[StoredMask], mask: np.ndarray, mask_format: str) -> Tuple[StoredMask, Dict[str, Any]]:
+    """Pack the new mask and describe how it differs from the previous one.
+
+    The diff is the bbox ``[x, y, w, h]`` of the changed pixels and the XOR of
+    the old and new masks inside it, in the requested wire format. Applying it
+    to the previous mask with XOR gives the new one.
+    """
+    stored = StoredMask.from_array("refined", mask)
+    height, width = mask.shape
+    if previous is None or not previous.area:
+        changed = StoredMask.from_array("diff", mask)
+    else:
+        # Only the union of the two bboxes can have changed
+        boxes = [box for box in (previous.bbox, stored.bbox) if box[2] and box[3]]
+        x0, y0 = min(box[0] for box in boxes), min(box[1] for box in boxes)
+        x1, y1 = max(box[0] + box[2] for box in boxes), max(box[1] + box[3] for box in boxes)
+        window = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+        px, py, pw, ph = previous.bbox
+        window[py - y0:py - y0 + ph, px - x0:px - x0 + pw] = previous.crop()
+        window ^= mask[y0:y1, x0:x1]
+        changed = StoredMask.from_array("diff", window)
+        if changed.area:
+            changed.bbox = [changed.bbox[0] + x0, changed.bbox[1] + y0, changed.bbox[2], changed.bbox[3]]
+
+    x, y, w, h = changed.bbox
+    diff = {
+        "size": [height, width],
+        "bbox": [x, y, w, h],
+        "changed_pixels": changed.area,
+        "segmentation": encode_mask(changed.crop() if changed.area else np.zeros((0, 0), dtype=bool), mask_format),
+    }
+    return stored, diff
+
+
+class SessionManager:
+    """Refinement sessions keyed by (image_id, session_id), bounded by count and idle time.
+
+    With a shared ``state`` backend, :meth:`load` and :meth:`save` read and
+    write a session's clicks there; saved sessions expire from it ``ttl``
+    seconds after their last click.
+    """
+
+    def __init__(self, max_sessions: int = 1024, ttl: Optional[float] = 1800, state: Optional[StateBackend] = None):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.state = state
+        self._sessions: "OrderedDict[Tuple[str, str], RefinementSession]" = OrderedDict()
+        self.created = 0
+        self.expired = 0
+
+    def get_or_create(self, image_id: str, session_id: str) -> RefinementSession:
+        key = (image_id, session_id)
+        session = self._sessions.get(key)
+        if session is None:
+            session = RefinementSession(image_id, session_id)
+            self._sessions[key] = session
+            self.created += 1
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                self.expired += 1
+        self._sessions.move_to_end(key)
+        session.updated_at = time.time()
+        return session
+
+    def get(self, image_id: str, session_id: str) -> Optional[RefinementSession]:
+        return self._sessions.get((image_id, session_id))
+
+    def load(self, session: RefinementSession) -> None:
+        """Replace a session's clicks with the copy last saved by any process; a no-op without a backend"""
+        if self.state is None:
+            return
+        blob = self.state.get_value(f"session:{session.image_id}:{session.session_id}")
+        if blob is None:
+            # New, or expired from the backend
+            session.points, session.labels, session.logits, session.mask = [], [], None, None
+        else:
+            decode_session(session, blob)
+
+    def save(self, session: RefinementSession) -> None:
+        if self.state is not None:
+            self.state.set_value(f"session:{session.image_id}:{session.session_id}", encode_session(session), self.ttl)
+
+    def discard(self, image_id: str, session_id: Optional[str] = None) -> None:
+        """Drop one session, or every session of an image; saved sessions this process never saw expire instead"""
+        keys = [(image_id, session_id)] if session_id is not None else [key for key in self._sessions if key[0] == image_id]
+        for key in keys:
+            self._sessions.pop(key, None)
+            if self.state is not None:
+                self.state.delete_value(f"session:{key[0]}:{key[1]}")
+
+    def expire(self, now: Optional[float] = None) -> int:
+        if not self.ttl:
+            return 0
+        cutoff = (now if now is not None else time.time()) - self.ttl
+        stale = [key for key, session in self._sessions.items() if session.updated_at < cutoff]
+        for key in stale:
+            del self._sessions[key]
+        self.expired += len(stale)
+        return len(stale)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def stats(self) -> Dict[str, int]:
+        return {"active": len(self._sessions), "created": self.created, "expired": self.expired}
@@ -0,0 +1,363 @@
+"""Shared state backends for stored mask records.
+
+:class:`mask_store.MaskStore` keeps decoded records in memory. A state
+backend is the tier behind it, holding each record as one compact blob (the
+packed mask bits plus a small JSON header) keyed by image id:
+
+- ``memory``: no backend; records live only in the process that made them.
+- ``sqlite``: a SQLite database in a directory, shared by worker processes
+  on one host, or by replicas on a shared volume.
+- ``redis``: any Redis-protocol server at ``REDIS_URL``, shared by replicas
+  on any host. Idle records expire through Redis key TTLs.
+
+Every write carries a random stamp, so a process holding a record in memory
+checks that it is still current with a 16-byte read instead of refetching
+the blob.
+
+Backends also hold small values and append-only lists by key, each with an
+optional TTL, for state that other processes must see as soon as it is
+written: jobs and their results, refinement sessions, the latest render of
+each image and upload aliases. :class:`SharedValues` wraps one namespace of
+them, falling back to a local dict when there is no backend.
+
+:class:`HashRing` maps image ids onto named replicas for consistent-hash
+routing hints: with shared state any replica can serve any image, but
+sending an image to the same replica keeps its decoded image and embedding
+caches warm.
+"""
+import bisect
+import hashlib
+import math
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Protocol, Sequence, Tuple
+
+# Try to import redis; the Redis state backend is only offered when it is installed
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    redis = None
+    REDIS_AVAILABLE = False
+
+STATE_BACKENDS = ("memory", "sqlite", "redis")
+STAMP_SIZE = 16
+
+
+def new_stamp() -> bytes:
+    return os.urandom(STAMP_SIZE)
+
+
+class StateBackend(Protocol):
+    """Blob store for mask records, shared between processes"""
+
+    def save(self, image_id: str, blob: bytes, stamp: bytes, accessed: float) -> None:
+        """Store or replace a record blob"""
+
+    def load(self, image_id: str) -> Optional[Tuple[bytes, bytes]]:
+        """``(blob, stamp)`` of a record, or None"""
+
+    def stamp(self, image_id: str) -> Optional[bytes]:
+        """Stamp of the current blob without reading it, or None"""
+
+    def touch(self, image_id: str, accessed: float) -> None:
+        """Record an access, postponing expiry"""
+
+    def delete(self, image_id: str) -> None:
+        ...
+
+    def keys(self) -> List[str]:
+        ...
+
+    def expired(self, cutoff: float) -> List[str]:
+        """Ids last accessed before ``cutoff``"""
+
+    def set_value(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        """Store or replace a value, removed after ``ttl`` seconds if given"""
+
+    def get_value(self, key: str) -> Optional[bytes]:
+        ...
+
+    def delete_value(self, key: str) -> None:
+        """Remove a value or list"""
+
+    def append_value(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        """Append to the list at ``key``, restarting its ``ttl``"""
+
+    def list_values(self, key: str, start: int = 0) -> List[bytes]:
+        """Items of the list at ``key`` from index ``start`` on"""
+
+    def purge_values(self, now: Optional[float] = None) -> int:
+        """Remove expired values and lists; returns how many"""
+
+    def close(self) -> None:
+        ...
+
+
+class SQLiteState:
+    """Record blobs in one SQLite table, safe to share between processes"""
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        # Writers in other processes hold the lock briefly; wait rather than fail
+        self._db = sqlite3.connect(str(self.directory / "state.sqlite3"), timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # Commits skip the fsync; WAL keeps the file consistent, losing at most the last writes on power loss
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS records ("
+            "image_id TEXT PRIMARY KEY, stamp BLOB, blob BLOB, accessed_at REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS records_accessed ON records (accessed_at)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS vals (key TEXT PRIMARY KEY, value BLOB, expires_at REAL)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS items ("
+            "key TEXT, position INTEGER, value BLOB, PRIMARY KEY (key, position))"
+        )
+        self._db.commit()
+
+    def save(self, image_id: str, blob: bytes, stamp: bytes, accessed: float) -> None:
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)", (image_id, stamp, blob, accessed))
+            self._db.commit()
+
+    def load(self, image_id: str) -> Optional[Tuple[bytes, bytes]]:
+        with self._lock:
+            row = self._db.execute("SELECT blob, stamp FROM records WHERE image_id = ?", (image_id,)).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def stamp(self, image_id: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._db.execute("SELECT stamp FROM records WHERE image_id = ?", (image_id,)).fetchone()
+        return row[0] if row else None
+
+    def touch(self, image_id: str, accessed: float) -> None:
+        with self._lock:
+            self._db.execute("UPDATE records SET accessed_at = ? WHERE image_id = ?", (accessed, image_id))
+            self._db.commit()
+
+    def delete(self, image_id: str) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM records WHERE image_id = ?", (image_id,))
+            self._db.commit()
+
+    def keys(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._db.execute("SELECT image_id FROM records")]
+
+    def expired(self, cutoff: float) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._db.execute("SELECT image_id FROM records WHERE accessed_at < ?", (cutoff,))]
+
+    def set_value(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO vals VALUES (?, ?, ?)", (key, value, _expiry(ttl)))
+            self._db.commit()
+
+    def get_value(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM vals WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)", (key, time.time())
+            ).fetchone()
+        return row[0] if row else None
+
+    def delete_value(self, key: str) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM vals WHERE key = ?", (key,))
+            self._db.execute("DELETE FROM items WHERE key = ?", (key,))
+            self._db.commit()
+
+    def append_value(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        # A list's expiry lives in vals, so it restarts on every append like a Redis EXPIRE
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO items SELECT ?, COUNT(*), ? FROM items WHERE key = ?", (key, value, key)
+            )
+            self._db.execute("INSERT OR REPLACE INTO vals VALUES (?, NULL, ?)", (key, _expiry(ttl)))
+            self._db.commit()
+
+    def list_values(self, key: str, start: int = 0) -> List[bytes]:
+        with self._lock:
+            return [row[0] for row in self._db.execute(
+                "SELECT value FROM items WHERE key = ? AND position >= ? ORDER BY position", (key, start)
+            )]
+
+    def purge_values(self, now: Optional[float] = None) -> int:
+        with self._lock:
+            now = now if now is not None else time.time()
+            expired = [row[0] for row in self._db.execute(
+                "SELECT key FROM vals WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,)
+            )]
+            self._db.executemany("DELETE FROM vals WHERE key = ?", [(key,) for key in expired])
+            self._db.executemany("DELETE FROM items WHERE key = ?", [(key,) for key in expired])
+            self._db.commit()
+        return len(expired)
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+def _expiry(ttl: Optional[float]) -> Optional[float]:
+    return time.time() + ttl if ttl else None
+
+
+class RedisState:
+    """Record blobs as Redis strings: the stamp followed by the blob.
+
+    ``client`` is anything with the redis-py ``get``/``set``/``getrange``/
+    ``expire``/``delete``/``scan_iter``/``rpush``/``lrange`` methods; by
+    default one is created from ``url``. With a ``ttl`` every write and touch
+    sets the key's expiry, so Redis removes idle records itself. Values and
+    lists are plain strings and lists under ``value_prefix``.
+    """
+
+    def __init__(self, url: Optional[str] = None, ttl: Optional[float] = None, client=None,
+                 prefix: str = "sam2:record:", value_prefix: str = "sam2:value:"):
+        if client is None:
+            if not REDIS_AVAILABLE:
+                raise RuntimeError("STATE_BACKEND=redis requires the redis package")
+            client = redis.Redis.from_url(url or "redis://localhost:6379")
+        self.client = client
+        self.ttl = int(ttl) if ttl else None
+        self.prefix = prefix
+        self.value_prefix = value_prefix
+
+    def save(self, image_id: str, blob: bytes, stamp: bytes, accessed: float) -> None:
+        self.client.set(self.prefix + image_id, stamp + blob, ex=self.ttl)
+
+    def load(self, image_id: str) -> Optional[Tuple[bytes, bytes]]:
+        value = self.client.get(self.prefix + image_id)
+        return (value[STAMP_SIZE:], value[:STAMP_SIZE]) if value else None
+
+    def stamp(self, image_id: str) -> Optional[bytes]:
+        return self.client.getrange(self.prefix + image_id, 0, STAMP_SIZE - 1) or None
+
+    def touch(self, image_id: str, accessed: float) -> None:
+        if self.ttl:
+            self.client.expire(self.prefix + image_id, self.ttl)
+
+    def delete(self, image_id: str) -> None:
+        self.client.delete(self.prefix + image_id)
+
+    def keys(self) -> List[str]:
+        start = len(self.prefix)
+        return [key.decode()[start:] if isinstance(key, bytes) else key[start:]
+                for key in self.client.scan_iter(match=self.prefix + "*")]
+
+    def expired(self, cutoff: float) -> List[str]:
+        return []  # key TTLs already removed them
+
+    def set_value(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        self.client.set(self.value_prefix + key, value, ex=_seconds(ttl))
+
+    def get_value(self, key: str) -> Optional[bytes]:
+        return self.client.get(self.value_prefix + key)
+
+    def delete_value(self, key: str) -> None:
+        self.client.delete(self.value_prefix + key)
+
+    def append_value(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        self.client.rpush(self.value_prefix + key, value)
+        if ttl:
+            self.client.expire(self.value_prefix + key, _seconds(ttl))
+
+    def list_values(self, key: str, start: int = 0) -> List[bytes]:
+        return self.client.lrange(self.value_prefix + key, start, -1)
+
+    def purge_values(self, now: Optional[float] = None) -> int:
+        return 0  # key TTLs already removed them
+
+    def close(self) -> None:
+        close = getattr(self.client, "close", None)
+        if close is not None:
+            close()
+
+
+def _seconds(ttl: Optional[float]) -> Optional[int]:
+    return max(1, math.ceil(ttl)) if ttl else None
+
+
+class SharedValues:
+    """String values by key in one namespace of a state backend, or in a local dict without one.
+
+    Shared values are read from the backend on every access, so a value
+    written by one process is seen by the next request to any other.
+    """
+
+    def __init__(self, state: Optional[StateBackend] = None, namespace: str = "", ttl: Optional[float] = None):
+        self.state = state
+        self.namespace = namespace
+        self.ttl = ttl
+        self._local: Dict[str, str] = {}
+
+    def get(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        if self.state is None:
+            return self._local.get(key, default)
+        value = self.state.get_value(self.namespace + key)
+        return value.decode() if value is not None else default
+
+    def __getitem__(self, key: str) -> str:
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value: str) -> None:
+        if self.state is None:
+            self._local[key] = value
+        else:
+            self.state.set_value(self.namespace + key, value.encode(), self.ttl)
+
+    def __contains__(self, key: object) -> bool:
+        return isinstance(key, str) and self.get(key) is not None
+
+    def pop(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        if self.state is None:
+            return self._local.pop(key, default)
+        value = self.get(key, default)
+        self.state.delete_value(self.namespace + key)
+        return value
+
+
+def create_state(name: Optional[str], directory: Path, url: Optional[str] = None,
+                 ttl: Optional[float] = None) -> Optional[StateBackend]:
+    """Create the state backend registered under ``name``; None for ``memory``"""
+    name = (name or "memory").lower()
+    if name == "memory":
+        return None
+    if name == "sqlite":
+        return SQLiteState(directory)
+    if name == "redis":
+        return RedisState(url, ttl)
+    raise ValueError(f"Unknown state backend '{name}', expected one of: {', '.join(STATE_BACKENDS)}")
+
+
+class HashRing:
+    """Consistent hashing of keys onto named nodes.
+
+    Each node owns ``vnodes`` points on the ring, so adding or removing a
+    node only moves the keys it owned, about ``1 / len(nodes)`` of them.
+    """
+
+    def __init__(self, nodes: Sequence[str], vnodes: int = 64):
+        self.nodes = list(nodes)
+        points = sorted((self._hash(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+    def node_for(self, key: str) -> Optional[str]:
+        """Node owning ``key``, or None for an empty ring"""
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._owners[index]
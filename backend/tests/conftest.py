@@ -0,0 +1,11 @@
+import os
+import shutil
+import tempfile
+
+# Uploads, spill stores and renders go to a scratch directory instead of
+# backend/uploads; set before any test module imports main
+UPLOADS_DIR = tempfile.mkdtemp(prefix="sam2-test-uploads-")
+os.environ["UPLOADS_DIR"] = UPLOADS_DIR
+
+def pytest_unconfigure(config):
+    shutil.rmtree(UPLOADS_DIR, ignore_errors=True)
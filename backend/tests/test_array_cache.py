@@ -0,0 +1,61 @@
+import numpy as np
+from array_cache import ArrayCache
+
+class TestArrayCache:
+    def test_hits_and_misses(self):
+        """Lookups are counted and computed values are reused"""
+        cache = ArrayCache()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return np.ones(10)
+
+        cache.get_or_compute("a", compute)
+        cache.get_or_compute("a", compute)
+        assert len(calls) == 1
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["misses"] == 1
+
+    def test_lru_byte_budget(self):
+        """The least recently used entry is evicted when over budget"""
+        cache = ArrayCache(max_bytes=200)
+        cache.put("a", np.zeros(10))  # 80 bytes
+        cache.put("b", np.zeros(10))
+        cache.get("a")
+        cache.put("c", np.zeros(10))
+        assert "a" in cache and "c" in cache
+        assert "b" not in cache
+        assert cache.stats()["bytes"] == 160
+        assert cache.stats()["evictions"] == 1
+
+    def test_spill_to_disk(self, tmp_path):
+        """Evicted entries are spilled and reloaded as memory maps"""
+        cache = ArrayCache(max_bytes=100, spill_dir=tmp_path)
+        cache.put("a", np.arange(10.0))
+        cache.put("b", np.arange(10.0) + 1)
+        reloaded = cache.get("a")
+        assert isinstance(reloaded, np.memmap)
+        assert np.array_equal(reloaded, np.arange(10.0))
+        assert cache.stats()["spill_hits"] == 1
+
+        cache.discard("a")
+        assert "a" not in cache
+
+    def test_mmap_mode(self, tmp_path):
+        """Every entry is written to disk and served as a read-only map costing no heap"""
+        cache = ArrayCache(max_bytes=100, spill_dir=tmp_path, mmap=True)
+        image = np.arange(300, dtype=np.uint8).reshape(10, 10, 3)
+        cache.put("a", image)
+        cached = cache.get("a")
+        assert isinstance(cached, np.memmap) and not cached.flags.writeable
+        assert np.array_equal(cached, image)
+        assert (tmp_path / "a.npy").exists()
+        assert cache.stats()["bytes"] == 0
+        assert cache.stats()["evictions"] == 0
+
+        # Replacing rewrites the file
+        cache.put("a", image + 1)
+        assert np.array_equal(cache.get("a"), image + 1)
+        cache.discard("a")
+        assert not (tmp_path / "a.npy").exists()
@@ -0,0 +1,155 @@
+import asyncio
+import pytest
+import numpy as np
+from PIL import Image
+from backends import MockBackend, LocalCPUBackend, connected_components, create_backend, disk_mask
+import backends
+from batching import MicroBatcher
+
+def make_blocks_image():
+    """Create an image with two red blocks and a blue block on white"""
+    image = np.full((60, 90, 3), 255, dtype=np.uint8)
+    image[5:25, 5:30] = [200, 20, 20]
+    image[35:55, 5:30] = [200, 20, 20]
+    image[10:50, 50:85] = [20, 20, 200]
+    return image
+
+class TestMockBackend:
+    def test_disk_mask_matches_reference(self):
+        """The vectorized disk matches a per-pixel reference rasterization"""
+        width, height, cx, cy, r = 37, 29, 5, 20, 9
+        expected = [[(x - cx) ** 2 + (y - cy) ** 2 <= r ** 2 and cx - r <= x < cx + r and cy - r <= y < cy + r
+                     for x in range(width)] for y in range(height)]
+        assert disk_mask(width, height, cx, cy, r).tolist() == expected
+
+    def test_generate_all_arrays(self):
+        """Mock masks are full-frame boolean arrays, one per quadrant"""
+        masks = MockBackend().generate_all(np.zeros((80, 160, 3), dtype=np.uint8))
+        assert len(masks) == 4
+        assert masks[0]["segmentation"].shape == (80, 160)
+        assert masks[0]["segmentation"][20, 40]
+
+    def test_predict_uses_embedding_shape(self):
+        """The mock embedding carries the frame shape without pixel data"""
+        backend = MockBackend()
+        embedding = backend.encode(np.zeros((64, 32, 3), dtype=np.uint8))
+        assert embedding.nbytes == 0
+        assert backend.predict(embedding, [[16, 32]], [1])["segmentation"].shape == (64, 32)
+
+    def test_create_backend(self):
+        """Backends are selected by name"""
+        assert create_backend("cpu").name == "cpu"
+        assert create_backend(None).name == "mock"
+        with pytest.raises(ValueError):
+            create_backend("gpu")
+
+class TestConnectedComponents:
+    @pytest.mark.parametrize("use_cv2", [False, True])
+    def test_components(self, use_cv2, monkeypatch):
+        """Separate blobs get distinct labels and touching pixels share one"""
+        if use_cv2 and not backends.CV2_AVAILABLE:
+            pytest.skip("OpenCV not installed")
+        monkeypatch.setattr(backends, "CV2_AVAILABLE", use_cv2)
+        mask = np.zeros((8, 10), dtype=bool)
+        mask[1:3, 1:4] = True
+        mask[2:6, 3] = True  # joins the first blob from below
+        mask[1:7, 7:9] = True
+        mask[6, 0] = True
+        count, labels = connected_components(mask)
+        assert count == 3
+        assert labels[1, 1] == labels[5, 3]
+        assert len({labels[1, 1], labels[1, 7], labels[6, 0]}) == 3
+        assert np.array_equal(labels > 0, mask)
+
+    def test_u_shape_merges(self):
+        """Branches that only meet at the bottom are merged"""
+        mask = np.zeros((5, 5), dtype=bool)
+        mask[0:4, 0] = True
+        mask[0:4, 4] = True
+        mask[4, :] = True
+        count, _ = connected_components(mask)
+        assert count == 1
+
+def textured(width=240, height=180, seed=0):
+    """Smooth random texture optical flow can lock on to"""
+    rng = np.random.default_rng(seed)
+    noise = Image.fromarray((rng.random((height // 10, width // 10)) * 255).astype(np.uint8))
+    return np.asarray(noise.resize((width, height), Image.BICUBIC))
+
+class TestPropagation:
+    @pytest.mark.parametrize("use_cv2", [False, True])
+    def test_mask_follows_motion(self, use_cv2, monkeypatch):
+        """A mask moves with the content between frames"""
+        if use_cv2 and not backends.CV2_AVAILABLE:
+            pytest.skip("OpenCV not installed")
+        monkeypatch.setattr(backends, "CV2_AVAILABLE", use_cv2)
+        scene = textured(300, 220)
+        previous, current = scene[20:180, 30:270], scene[25:185, 24:264]  # moved 6 right, 5 up
+        mask = np.zeros(previous.shape, dtype=bool)
+        mask[40:100, 60:140] = True
+        moved = backends.flow_mask(mask, previous, current)
+        expected = backends.shift_mask(mask, 6, -5)
+        assert (moved & expected).sum() / (moved | expected).sum() > 0.9
+
+    def test_estimate_shift(self):
+        scene = textured(300, 220)
+        assert backends.estimate_shift(scene[20:180, 30:270], scene[12:172, 33:273]) == (-3, 8)
+
+    def test_shift_mask_clips(self):
+        mask = np.ones((4, 5), dtype=bool)
+        assert backends.shift_mask(mask, 2, -1).sum() == 3 * 3
+        assert not backends.shift_mask(mask, 5, 0).any()
+
+    def test_backend_propagates_through_frames(self):
+        """The default propagation yields one mask per frame after the first"""
+        scene = textured(300, 220)
+        frames = [np.dstack([scene[20:180, 30 - 4 * i:270 - 4 * i]] * 3) for i in range(4)]
+        mask = np.zeros((160, 240), dtype=bool)
+        mask[40:100, 60:140] = True
+        masks = list(MockBackend().propagate(frames, mask))
+        assert len(masks) == 3
+        centroid = [np.nonzero(m)[1].mean() for m in [mask] + masks]
+        assert np.allclose(np.diff(centroid), 4, atol=1)
+
+class TestLocalCPUBackend:
+    def test_generate_all_finds_regions(self):
+        """Each coloured block becomes its own mask"""
+        masks = LocalCPUBackend(clusters=3).generate_all(make_blocks_image())
+        blocks = [m["segmentation"] for m in masks if m["segmentation"].sum() in (500, 1400)]
+        assert len(blocks) == 3
+
+    def test_predict_prompts(self):
+        """Foreground points select regions and background points remove them"""
+        backend = LocalCPUBackend(clusters=3)
+        image = make_blocks_image()
+        embedding = backend.encode(image)
+        result = backend.predict(embedding, [[10, 10], [60, 20]], [1, 1])
+        assert result["segmentation"].sum() == 500 + 1400
+        result = backend.predict(embedding, [[10, 10], [60, 20]], [1, 0])
+        assert result["segmentation"].sum() == 500
+
+class TestMicroBatcher:
+    def test_groups_concurrent_requests(self):
+        """Concurrent submissions are dispatched as one batch, in order"""
+        calls = []
+
+        def handler(items):
+            calls.append(list(items))
+            return [item * 2 for item in items]
+
+        batcher = MicroBatcher(handler, max_batch_size=4, max_wait_ms=20)
+
+        async def run():
+            return await asyncio.gather(*(batcher.submit(i) for i in range(6)))
+
+        assert asyncio.run(run()) == [0, 2, 4, 6, 8, 10]
+        assert calls == [[0, 1, 2, 3], [4, 5]]
+
+    def test_errors_propagate(self):
+        """A failing handler fails every item in the batch"""
+        def handler(items):
+            raise RuntimeError("boom")
+
+        batcher = MicroBatcher(handler)
+        with pytest.raises(RuntimeError):
+            asyncio.run(batcher.submit(1))
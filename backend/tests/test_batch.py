@@ -0,0 +1,106 @@
+import io
+import json
+import zipfile
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+import main
+from main import app
+from batch import ZipStream, list_archive_images
+
+client = TestClient(app)
+
+def image_bytes(color="red", size=(64, 48)):
+    img_bytes = io.BytesIO()
+    Image.new('RGB', size, color=color).save(img_bytes, format='PNG')
+    return img_bytes.getvalue()
+
+def make_zip(members):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for name, data in members.items():
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+class TestHelpers:
+    def test_zip_stream_round_trip(self):
+        stream = ZipStream()
+        data = stream.add("a.jpg", b"x" * 100) + stream.add("b.json", b"{}") + stream.close()
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            assert archive.namelist() == ["a.jpg", "b.json"]
+            assert archive.read("a.jpg") == b"x" * 100
+
+    def test_list_archive_images(self, tmp_path):
+        path = tmp_path / "in.zip"
+        path.write_bytes(make_zip({"a.png": b"1", "dir/b.JPG": b"2", "notes.txt": b"", "__MACOSX/._a.png": b""}))
+        assert list_archive_images(path, 10, 100) == ["a.png", "dir/b.JPG"]
+        with pytest.raises(ValueError):
+            list_archive_images(path, 1, 100)
+
+class TestBatchEndpoint:
+    def test_multipart_ndjson(self):
+        """Each image yields one NDJSON result with a downloadable render"""
+        files = [("files", (f"img{i}.png", image_bytes(color), "image/png")) for i, color in enumerate(["red", "blue", "green"])]
+        response = client.post("/batch", files=files, data={"spec": json.dumps({"color": "#00ff00", "mask_ids": ["0"]})},
+                               params={"output": "ndjson"})
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+
+        results = [json.loads(line) for line in response.text.splitlines()]
+        assert sorted(result["index"] for result in results) == [0, 1, 2]
+        for result in results:
+            assert result["status"] == "ok"
+            assert result["colored_mask_count"] == 1
+            assert result["image_id"] in main.image_store
+            assert client.get(result["download_url"]).status_code == 200
+
+    def test_zip_archive_to_zip(self):
+        """A zip of images comes back as a zip of colored images and a manifest"""
+        archive = make_zip({"a.png": image_bytes("red"), "nested/b.png": image_bytes("blue")})
+        response = client.post("/batch", files={"archive": ("in.zip", archive, "application/zip")})
+        assert response.status_code == 200
+
+        with zipfile.ZipFile(io.BytesIO(response.content)) as result:
+            manifest = json.loads(result.read("results.json"))["results"]
+            assert [entry["filename"] for entry in manifest] == ["a.png", "nested/b.png"]
+            assert all(entry["status"] == "ok" for entry in manifest)
+            colored = Image.open(io.BytesIO(result.read(manifest[0]["entry"])))
+            assert colored.size == (64, 48)
+
+    def test_bad_image_reported_not_fatal(self):
+        files = [("files", ("good.png", image_bytes(), "image/png")),
+                 ("files", ("bad.png", b"not an image", "image/png"))]
+        response = client.post("/batch", files=files, params={"output": "ndjson"})
+        results = {result["filename"]: result for result in map(json.loads, response.text.splitlines())}
+        assert results["good.png"]["status"] == "ok"
+        assert results["bad.png"]["status"] == "error"
+
+    def test_masks_included_on_request(self):
+        files = [("files", ("a.png", image_bytes(), "image/png"))]
+        response = client.post("/batch", files=files, data={"spec": json.dumps({"include_masks": True})},
+                               params={"output": "ndjson"})
+        result = json.loads(response.text.splitlines()[0])
+        assert len(result["masks"]) == result["mask_count"] == result["colored_mask_count"]
+        assert "counts" in result["masks"][0]["segmentation"]
+
+    def test_segmentation_batched_across_images(self, monkeypatch):
+        """Concurrent images share backend calls"""
+        calls = []
+        generate_batch = main.segmentation_backend.generate_batch
+        monkeypatch.setattr(main.segmentation_backend, "generate_batch",
+                            lambda images: calls.append(len(images)) or generate_batch(images))
+        monkeypatch.setattr(main.segment_batcher, "max_wait", 0.05)
+        files = [("files", (f"img{i}.png", image_bytes(), "image/png")) for i in range(6)]
+        client.post("/batch", files=files, params={"output": "ndjson"})
+        assert sum(calls) == 6
+        assert len(calls) < 6
+
+    @pytest.mark.parametrize("kwargs", [
+        {"files": [("files", ("a.png", b"1", "image/png"))], "data": {"spec": "{not json"}},
+        {"files": [("files", ("a.png", b"1", "image/png"))], "data": {"spec": json.dumps({"color": "red"})}},
+        {"files": [("files", ("a.txt", b"1", "text/plain"))]},
+        {"files": {"archive": ("in.zip", b"not a zip", "application/zip")}},
+        {"data": {"spec": "{}"}},
+    ])
+    def test_invalid_requests(self, kwargs):
+        assert client.post("/batch", **kwargs).status_code == 400
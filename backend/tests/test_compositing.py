@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+from backends import disk_mask
+from compositing import composite_masks, parse_color
+from mask_store import StoredMask
+
+def make_image(height=60, width=80):
+    return np.full((height, width, 3), 100, dtype=np.uint8)
+
+class TestParseColor:
+    def test_rgb_and_rgba(self):
+        assert parse_color("#ff8000") == (255, 128, 0, 255)
+        assert parse_color("#ff800080") == (255, 128, 0, 128)
+        assert parse_color("#ff0000", alpha=0.5) == (255, 0, 0, 128)
+
+    @pytest.mark.parametrize("color", ["ff0000", "#ff00", "#gg0000", ""])
+    def test_invalid(self, color):
+        with pytest.raises(ValueError):
+            parse_color(color)
+
+class TestComposite:
+    def test_opaque_matches_boolean_write(self):
+        """Opaque layers reproduce the old per-mask boolean assignment"""
+        image = make_image()
+        first, second = disk_mask(80, 60, 30, 30, 15), disk_mask(80, 60, 45, 30, 15)
+        layers = [(StoredMask.from_array("a", first), parse_color("#ff0000")),
+                  (StoredMask.from_array("b", second), parse_color("#00ff00"))]
+
+        expected = image.copy()
+        expected[first] = (255, 0, 0)
+        expected[second] = (0, 255, 0)
+        np.testing.assert_array_equal(composite_masks(image, layers), expected)
+
+    def test_alpha_blend(self):
+        image = make_image()
+        mask = disk_mask(80, 60, 40, 30, 10)
+        output = composite_masks(image, [(StoredMask.from_array("a", mask), parse_color("#c8c8c8", 0.5))])
+        assert tuple(output[30, 40]) == (150, 150, 150)
+        np.testing.assert_array_equal(output[~mask], image[~mask])
+
+    def test_input_untouched_and_empty_layers(self):
+        image = make_image()
+        image.flags.writeable = False
+        empty = StoredMask.from_array("a", np.zeros((60, 80), dtype=bool))
+        np.testing.assert_array_equal(composite_masks(image, [(empty, parse_color("#ffffff"))]), image)
+
+    def test_upsampled_layers(self):
+        """Working-resolution masks are painted onto the full-size image"""
+        image = make_image(120, 160)
+        mask = StoredMask.from_array("a", disk_mask(80, 60, 40, 30, 10))
+        output = composite_masks(image, [(mask, parse_color("#0000ff"))], scale=(2.0, 2.0))
+        assert tuple(output[60, 80]) == (0, 0, 255)
+        assert np.count_nonzero(output[..., 2] == 255) == pytest.approx(4 * mask.area, rel=0.1)
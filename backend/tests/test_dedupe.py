@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from dedupe import UploadIndex, perceptual_hash
+from state import SQLiteState
+
+def facade(path, quality=90, size=(160, 120), seed=0):
+    """Save a synthetic photo with structure at several scales"""
+    rng = np.random.default_rng(seed)
+    blocks = rng.integers(0, 255, (6, 8, 3), dtype=np.uint8)
+    image = Image.fromarray(blocks).resize(size, Image.BILINEAR)
+    image.save(path, format="JPEG", quality=quality)
+    return path
+
+class TestPerceptualHash:
+    def test_survives_reencoding(self, tmp_path):
+        original = perceptual_hash(facade(tmp_path / "a.jpg", quality=95))
+        reencoded = perceptual_hash(facade(tmp_path / "b.jpg", quality=40))
+        assert original[1:] == reencoded[1:] == (160, 120)
+        assert bin(original[0] ^ reencoded[0]).count("1") <= 4
+
+    def test_different_images_differ(self, tmp_path):
+        first = perceptual_hash(facade(tmp_path / "a.jpg", seed=0))
+        second = perceptual_hash(facade(tmp_path / "b.jpg", seed=1))
+        assert bin(first[0] ^ second[0]).count("1") > 10
+
+class TestUploadIndex:
+    def test_exact_match_and_resolution(self):
+        index = UploadIndex()
+        index.register("a", "digest")
+        assert index.find_exact("digest") == "a"
+        assert index.find_exact("other") is None
+        index.alias("b", "a")
+        assert index.resolve("b") == "a"
+        assert index.resolve("unknown") == "unknown"
+        assert index.references("a") == 2
+        assert index.referring(["a"]) == {"a", "b"}
+
+    def test_similar_match_within_distance_and_same_size(self):
+        index = UploadIndex(max_distance=3)
+        index.register("a", "d1", (0b1011 << 40, 100, 80))
+        assert index.find_similar(((0b1011 << 40) ^ 0b111, 100, 80)) == "a"
+        assert index.find_similar(((0b1011 << 40) ^ 0b1111, 100, 80)) is None
+        assert index.find_similar((0b1011 << 40, 200, 160)) is None
+        assert index.stats()["perceptual_hits"] == 1
+
+    def test_closest_hash_wins(self):
+        index = UploadIndex(max_distance=4)
+        index.register("far", "d1", (0b1111, 10, 10))
+        index.register("near", "d2", (0b0001, 10, 10))
+        assert index.find_similar((0b0000, 10, 10)) == "near"
+
+    def test_release_counts_references(self):
+        """Shared state goes only when the last image id referring to it does"""
+        index = UploadIndex()
+        index.register("a", "digest", (42, 10, 10))
+        index.alias("b", "a")
+        assert index.release("a") == []
+        assert index.resolve("b") == "a"
+        assert index.release("b") == ["a"]
+        assert index.find_exact("digest") is None
+        assert index.find_similar((42, 10, 10)) is None
+        assert index.release("b") == []
+
+    def test_shared_aliases(self, tmp_path):
+        """Aliases and exact digests registered by one worker are seen by another"""
+        index = UploadIndex(state=SQLiteState(tmp_path))
+        other = UploadIndex(state=SQLiteState(tmp_path))
+        index.register("a", "digest")
+        index.alias("b", "a")
+        assert other.find_exact("digest") == "a"
+        assert other.resolve("b") == "a"
+        index.release("b")
+        index.release("a")
+        assert other.resolve("b") == "b"
+        assert other.find_exact("digest") is None
+
+    def test_max_distance_limited_by_bands(self):
+        with pytest.raises(ValueError):
+            UploadIndex(max_distance=8)
@@ -0,0 +1,51 @@
+import numpy as np
+
+from hit_index import HitIndex
+from mask_store import StoredMask
+
+def box(x0, y0, x1, y1, mask_id, height=100, width=150):
+    mask = np.zeros((height, width), dtype=bool)
+    mask[y0:y1, x0:x1] = True
+    return StoredMask.from_array(mask_id, mask)
+
+def make_index(cell_size=16):
+    # A wall with a window on it, and a separate door
+    masks = [box(10, 10, 110, 90, "wall"), box(30, 30, 50, 50, "window"), box(120, 40, 140, 100, "door")]
+    return masks, HitIndex.build(masks, 150, 100, cell_size)
+
+class TestPointQueries:
+    def test_smallest_mask_is_on_top(self):
+        masks, index = make_index()
+        assert masks[index.top_at(40, 40)].id == "window"
+        assert masks[index.top_at(20, 20)].id == "wall"
+        assert index.top_at(5, 5) is None
+        assert index.top_at(500, 5) is None
+
+    def test_all_masks_under_point_topmost_first(self):
+        masks, index = make_index()
+        assert [masks[i].id for i in index.masks_at(masks, 40, 40)] == ["window", "wall"]
+        assert [masks[i].id for i in index.masks_at(masks, 130, 95)] == ["door"]
+        assert index.masks_at(masks, 115, 5) == []
+
+    def test_bit_lookup_respects_holes(self):
+        """Pixels inside a bbox but outside the mask are not hits"""
+        ring = np.zeros((100, 150), dtype=bool)
+        ring[20:60, 20:60] = True
+        ring[30:50, 30:50] = False
+        masks = [StoredMask.from_array("ring", ring)]
+        index = HitIndex.build(masks, 150, 100)
+        assert index.masks_at(masks, 40, 40) == []
+        assert index.masks_at(masks, 25, 40) == [0]
+
+class TestRegionQueries:
+    def test_rect_reports_visible_masks(self):
+        masks, index = make_index()
+        assert [masks[i].id for i in index.masks_in_rect(35, 35, 45, 45)] == ["window"]
+        assert [masks[i].id for i in index.masks_in_rect(0, 0, 150, 100)] == ["window", "door", "wall"]
+        assert index.masks_in_rect(0, 0, 5, 5) == []
+
+    def test_lasso(self):
+        masks, index = make_index()
+        triangle = [(100, 45), (145, 45), (130, 80)]
+        assert {masks[i].id for i in index.masks_in_polygon(triangle)} == {"wall", "door"}
+        assert index.masks_in_polygon([(0, 0), (5, 0), (0, 5)]) == []
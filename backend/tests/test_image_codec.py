@@ -0,0 +1,80 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import image_codec
+from image_codec import OUTPUT_FORMATS, decode_image, encode_image, extension_for, media_type, sniff_container
+
+def encoded(image, image_format, **options):
+    data = io.BytesIO()
+    image.save(data, format=image_format, **options)
+    return data.getvalue()
+
+def gradient(size=(800, 600)):
+    x = np.linspace(0, 255, size[0], dtype=np.uint8)
+    y = np.linspace(0, 255, size[1], dtype=np.uint8)
+    return Image.fromarray(np.dstack(np.broadcast_arrays(x[None, :], y[:, None], np.uint8(128))))
+
+class TestContainers:
+    @pytest.mark.parametrize("image_format,container,extension", [
+        ("JPEG", "jpeg", "jpg"), ("PNG", "png", "png"), ("WEBP", "webp", "webp"),
+        ("GIF", "gif", "gif"), ("BMP", "bmp", "bmp"), ("TIFF", "tiff", "tif")
+    ])
+    def test_sniffed_from_magic_bytes(self, image_format, container, extension):
+        header = encoded(Image.new("RGB", (8, 8)), image_format)[:16]
+        assert sniff_container(header) == container
+        assert extension_for(header) == extension
+
+    def test_unknown_bytes(self):
+        assert sniff_container(b"not an image") is None
+        assert extension_for(b"not an image") == "img"
+        assert media_type(".img") == "application/octet-stream"
+        assert media_type(".png") == "image/png"
+
+class TestDecode:
+    @pytest.mark.parametrize("cv2_available", [False, True])
+    def test_reduced_jpeg_decode_matches_full_decode(self, monkeypatch, cv2_available):
+        if cv2_available and not image_codec.CV2_AVAILABLE:
+            pytest.skip("OpenCV not installed")
+        monkeypatch.setattr(image_codec, "CV2_AVAILABLE", cv2_available)
+        data = encoded(gradient((1600, 1200)), "JPEG", quality=95)
+        reduced, original_size = decode_image(data, 400)
+        assert original_size == (1600, 1200)
+        assert reduced.shape == (300, 400, 3)
+
+        full = np.asarray(Image.open(io.BytesIO(data)).convert("RGB").resize((400, 300), Image.BILINEAR))
+        assert np.abs(reduced.astype(int) - full).mean() < 3
+
+    def test_transparency_composited_over_white(self):
+        image = Image.new("RGBA", (10, 10), (255, 0, 0, 0))
+        image.putpixel((0, 0), (0, 0, 255, 255))
+        decoded, _ = decode_image(encoded(image, "PNG"))
+        assert decoded.shape == (10, 10, 3)
+        assert tuple(decoded[0, 0]) == (0, 0, 255)
+        assert tuple(decoded[5, 5]) == (255, 255, 255)
+
+    @pytest.mark.parametrize("mode", ["L", "P", "CMYK", "LA"])
+    def test_modes_normalized_to_rgb(self, mode):
+        image_format = "JPEG" if mode == "CMYK" else "PNG"
+        decoded, _ = decode_image(encoded(gradient((40, 30)).convert(mode), image_format))
+        assert decoded.shape == (30, 40, 3) and decoded.dtype == np.uint8
+
+class TestEncode:
+    @pytest.mark.parametrize("output_format", OUTPUT_FORMATS)
+    def test_round_trip(self, output_format):
+        image = np.asarray(gradient((64, 48)))
+        data = encode_image(image, output_format, 90)
+        assert sniff_container(data[:16]) == output_format
+        decoded, size = decode_image(data)
+        assert size == (64, 48)
+        assert np.abs(decoded.astype(int) - image).mean() < 3
+
+    def test_quality_changes_size(self):
+        image = np.asarray(gradient())
+        assert len(encode_image(image, "webp", 30)) < len(encode_image(image, "webp", 95))
+
+    def test_unknown_format(self):
+        with pytest.raises(ValueError):
+            encode_image(np.zeros((4, 4, 3), dtype=np.uint8), "gif", 90)
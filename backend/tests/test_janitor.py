@@ -0,0 +1,41 @@
+import asyncio
+import os
+import time
+import main
+from janitor import sweep_uploads
+
+def touch(path, age):
+    path.write_bytes(b"x")
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+
+class TestSweepUploads:
+    def test_removes_only_expired_files(self, tmp_path):
+        touch(tmp_path / "old.jpg", 120)
+        touch(tmp_path / "old_colored.jpg", 120)
+        touch(tmp_path / "new.jpg", 10)
+        (tmp_path / "store").mkdir()
+        touch(tmp_path / "store" / "old.masks", 120)
+
+        assert sweep_uploads(tmp_path, 60) == ["old"]
+        assert sorted(p.name for p in tmp_path.iterdir()) == ["new.jpg", "store"]
+        assert (tmp_path / "store" / "old.masks").exists()
+
+    def test_keeps_uploads_with_live_masks(self, tmp_path):
+        """Originals in use are kept, but their rendered outputs still expire"""
+        touch(tmp_path / "live.jpg", 120)
+        touch(tmp_path / "live_colored.jpg", 120)
+        assert sweep_uploads(tmp_path, 60, keep={"live"}) == []
+        assert [p.name for p in tmp_path.iterdir()] == ["live.jpg"]
+
+class TestJanitor:
+    def test_expired_images_are_forgotten(self, monkeypatch, tmp_path):
+        """Expired uploads are deleted and their cached state dropped"""
+        monkeypatch.setattr(main, "UPLOADS_DIR", tmp_path)
+        monkeypatch.setattr(main, "UPLOAD_TTL_SECONDS", 60)
+        touch(tmp_path / "stale.jpg", 120)
+        main.image_sizes["stale"] = (10, 10)
+
+        asyncio.run(main.clean_up_expired())
+        assert not (tmp_path / "stale.jpg").exists()
+        assert "stale" not in main.image_sizes
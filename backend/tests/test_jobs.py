@@ -0,0 +1,138 @@
+import asyncio
+import io
+import json
+import threading
+import httpx
+from PIL import Image
+from main import app
+import jobs
+from jobs import Job, JobManager, COMPLETED, FAILED
+from state import SQLiteState
+
+def parse_sse(text):
+    """Split a Server-Sent Events body into (event, data) pairs"""
+    events = []
+    for block in text.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines() if not line.startswith(":"))
+        if "event" in fields:
+            events.append((fields["event"], json.loads(fields["data"])))
+    return events
+
+class TestJob:
+    def test_streams_masks_before_completion(self):
+        """Each mask is delivered as soon as a worker thread publishes it"""
+        job = Job("img", "rle")
+        proceed = threading.Event()
+
+        def produce():
+            job.start()
+            job.add_mask({"id": "0"})
+            proceed.wait(5)
+            job.add_mask({"id": "1"})
+            job.complete()
+
+        async def consume():
+            received = []
+            threading.Thread(target=produce).start()
+            async for event in job.events():
+                received.append(event)
+                if "event: mask" in event and len(received) == 2:
+                    # The first mask arrived while the job is still running
+                    assert not job.finished
+                    proceed.set()
+            return received
+
+        events = parse_sse("".join(asyncio.run(consume())))
+        assert [name for name, _ in events] == ["status", "mask", "mask", "done"]
+        assert job.status == COMPLETED
+        assert job.summary(since=1)["masks"] == [{"id": "1"}]
+
+    def test_failure_event(self):
+        """Failed jobs end the stream with an error event"""
+        job = Job("img", "rle")
+        job.fail("boom")
+
+        async def consume():
+            return [event async for event in job.events()]
+
+        events = parse_sse("".join(asyncio.run(consume())))
+        assert events[-1] == ("error", {"status": FAILED, "error": "boom"})
+
+    def test_manager_prunes_finished_jobs(self):
+        """Only finished jobs are dropped when over the limit"""
+        manager = JobManager(max_jobs=2)
+        running = manager.create("a", "rle")
+        done = manager.create("b", "rle")
+        done.complete()
+        manager.create("c", "rle")
+        assert manager.get(running.id) is running
+        assert manager.get(done.id) is None
+
+    def test_job_seen_by_other_workers(self, tmp_path):
+        """A job written through to shared state can be read by another process's manager"""
+        worker, other = JobManager(state=SQLiteState(tmp_path)), JobManager(state=SQLiteState(tmp_path))
+        job = worker.create("img", "rle")
+        job.start()
+        job.add_mask({"id": "0"})
+        remote = other.get(job.id)
+        assert remote.remote and remote.status == "running"
+        assert remote.summary()["masks"] == [{"id": "0"}]
+        job.add_mask({"id": "1"})
+        job.complete()
+        remote.refresh()
+        assert remote.status == COMPLETED and remote.summary(since=1)["masks"] == [{"id": "1"}]
+        assert other.get("unknown") is None
+
+    def test_remote_events_poll_shared_state(self, tmp_path, monkeypatch):
+        """Events of a job run elsewhere arrive by polling"""
+        monkeypatch.setattr(jobs, "POLL_INTERVAL", 0.01)
+        job = JobManager(state=SQLiteState(tmp_path)).create("img", "rle")
+        remote = JobManager(state=SQLiteState(tmp_path)).get(job.id)
+
+        def produce():
+            job.start()
+            job.add_mask({"id": "0"})
+            job.complete()
+
+        async def consume():
+            threading.Timer(0.05, produce).start()
+            return [event async for event in remote.events(keepalive=5)]
+
+        events = parse_sse("".join(asyncio.run(consume())))
+        assert [name for name, _ in events] == ["status", "mask", "done"]
+
+class TestJobEndpoints:
+    def test_async_generate_masks(self):
+        """?async=true returns a job whose masks can be streamed and polled"""
+        img = Image.new('RGB', (100, 100), color='blue')
+        img_bytes = io.BytesIO()
+        img.save(img_bytes, format='JPEG')
+
+        async def run():
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+                files = {"file": ("test_image.jpg", img_bytes.getvalue(), "image/jpeg")}
+                image_id = (await client.post("/upload-image", files=files)).json()["image_id"]
+
+                started = await client.post("/generate-masks", params={"async": "true"}, json={"image_id": image_id})
+                job_id = started.json()["job_id"]
+                events = await client.get(f"/jobs/{job_id}/events")
+                status = await client.get(f"/jobs/{job_id}", params={"since": 3})
+                debug = await client.get(f"/debug/masks/{image_id}")
+                missing = await client.get("/jobs/nonexistent")
+                return started, events, status, debug, missing
+
+        started, events, status, debug, missing = asyncio.run(run())
+        assert started.status_code == 202
+        assert events.headers["content-type"].startswith("text/event-stream")
+        names = [name for name, _ in parse_sse(events.text)]
+        assert names == ["status", "mask", "mask", "mask", "mask", "done"]
+
+        data = status.json()
+        assert data["status"] == "completed"
+        assert data["progress"] == {"masks_ready": 4, "total": 4}
+        assert [mask["id"] for mask in data["masks"]] == ["3"]
+        assert "counts" in data["masks"][0]["segmentation"]
+
+        # The finished job is stored like a synchronous generation
+        assert debug.json()["mask_count"] == 4
+        assert missing.status_code == 404
@@ -1,7 +1,14 @@
 import pytest
 import asyncio
 from fastapi.testclient import TestClient
+import main
+import responses
 from main import app
+from array_cache import ArrayCache
+from dedupe import UploadIndex
+from mask_store import MaskStore
+from render_cache import RenderCache
+from state import HashRing, SharedValues, SQLiteState
 import tempfile
 import os
 from PIL import Image
@@ -9,6 +16,12 @@ import io
 
 client = TestClient(app)
 
+def make_jpeg(size=(100, 100)):
+    img_bytes = io.BytesIO()
+    Image.new('RGB', size, color='red').save(img_bytes, format='JPEG')
+    img_bytes.seek(0)
+    return img_bytes
+
 class TestHealthEndpoint:
     def test_health_check(self):
         """Test the health check endpoint"""
@@ -18,6 +31,7 @@ class TestHealthEndpoint:
         assert data["status"] == "healthy"
         assert "message" in data
         assert "stored_images" in data
+        assert "embedding_cache" in data
 
 class TestUploadEndpoint:
     def test_upload_image_success(self):
@@ -47,6 +61,52 @@ class TestUploadEndpoint:
         assert response.status_code == 400
         assert "File must be an image" in response.json()["detail"]
 
+    def test_upload_without_image_echo(self):
+        """Clients can opt out of receiving their own image back"""
+        img = Image.new('RGB', (100, 100), color='red')
+        img_bytes = io.BytesIO()
+        img.save(img_bytes, format='JPEG')
+        img_bytes.seek(0)
+
+        files = {"file": ("test_image.jpg", img_bytes, "image/jpeg")}
+        response = client.post("/upload-image", files=files, params={"return_image": "false"})
+        assert response.status_code == 200
+        assert "image_id" in response.json()
+        assert "image_data" not in response.json()
+
+    def test_upload_too_large(self, monkeypatch):
+        """Uploads over MAX_FILE_SIZE are rejected and not kept on disk"""
+        monkeypatch.setattr(main, "MAX_FILE_SIZE", 1000)
+        monkeypatch.setattr(main, "UPLOAD_CHUNK_SIZE", 256)
+        before = set(main.UPLOADS_DIR.iterdir())
+
+        files = {"file": ("big.jpg", b"\xff" * 5000, "image/jpeg")}
+        response = client.post("/upload-image", files=files)
+        assert response.status_code == 413
+        assert set(main.UPLOADS_DIR.iterdir()) == before
+
+    def test_routing_hint(self, monkeypatch):
+        """With replicas configured, uploads name the replica owning the image"""
+        monkeypatch.setattr(main, "route_ring", HashRing(["api-0", "api-1"]))
+        files = {"file": ("test_image.jpg", make_jpeg(), "image/jpeg")}
+        response = client.post("/upload-image", files=files, params={"return_image": "false"})
+        assert response.headers["x-route-hint"] == main.route_ring.node_for(response.json()["image_id"])
+
+    def test_image_decoded_once(self):
+        """Generation, prompts and coloring share one decoded copy"""
+        img = Image.new('RGB', (100, 100), color='red')
+        img_bytes = io.BytesIO()
+        img.save(img_bytes, format='JPEG')
+        img_bytes.seek(0)
+
+        before = main.image_cache.stats()["misses"]
+        files = {"file": ("test_image.jpg", img_bytes, "image/jpeg")}
+        image_id = client.post("/upload-image", files=files).json()["image_id"]
+        client.post("/generate-masks", json={"image_id": image_id})
+        client.post("/get-mask", json={"image_id": image_id, "points": [{"x": 5, "y": 5}], "labels": [1]})
+        client.post("/apply-colors", json={"image_id": image_id, "mask_ids": ["0"], "color": "#00ff00"})
+        assert main.image_cache.stats()["misses"] - before == 1
+
     def test_upload_no_file(self):
         """Test upload without file"""
         response = client.post("/upload-image")
@@ -115,6 +175,29 @@ class TestGetMaskEndpoint:
         data = response.json()
         assert "segmentation" in data or "score" in data
 
+    def test_get_mask_reuses_embedding(self):
+        """Repeated clicks hit the embedding cache instead of re-encoding"""
+        img = Image.new('RGB', (100, 100), color='green')
+        img_bytes = io.BytesIO()
+        img.save(img_bytes, format='JPEG')
+        img_bytes.seek(0)
+
+        files = {"file": ("test_image.jpg", img_bytes, "image/jpeg")}
+        image_id = client.post("/upload-image", files=files).json()["image_id"]
+        client.post("/generate-masks", json={"image_id": image_id})
+
+        before = client.get("/health").json()["embedding_cache"]
+        for x in (20, 40, 60):
+            response = client.post("/get-mask", json={
+                "image_id": image_id,
+                "points": [{"x": x, "y": 50}],
+                "labels": [1]
+            })
+            assert response.status_code == 200
+        after = client.get("/health").json()["embedding_cache"]
+        assert after["hits"] - before["hits"] == 3
+        assert after["misses"] == before["misses"]
+
 class TestApplyColorsEndpoint:
     def test_apply_colors_no_image(self):
         """Test applying colors to non-existent image"""
@@ -152,6 +235,42 @@ class TestApplyColorsEndpoint:
         data = response.json()
         assert "message" in data
 
+    def test_apply_colors_per_mask(self):
+        """Each mask can get its own color in one request"""
+        img = Image.new('RGB', (100, 100), color='black')
+        img_bytes = io.BytesIO()
+        img.save(img_bytes, format='PNG')
+        img_bytes.seek(0)
+
+        files = {"file": ("test_image.png", img_bytes, "image/png")}
+        image_id = client.post("/upload-image", files=files).json()["image_id"]
+        masks = client.post("/generate-masks", json={"image_id": image_id}).json()["masks"]
+        response = client.post("/apply-colors", json={
+            "image_id": image_id,
+            "mask_ids": [masks[0]["id"], masks[1]["id"]],
+            "color": "#ff0000",
+            "colors": {masks[1]["id"]: "#0000ff"}
+        })
+        assert response.status_code == 200
+
+        colored = Image.open(response.json()["colored_image_path"])
+        first = colored.getpixel(tuple(round(c) for c in masks[0]["centroid"]))
+        second = colored.getpixel(tuple(round(c) for c in masks[1]["centroid"]))
+        assert first[0] > 200 and first[2] < 60
+        assert second[2] > 200 and second[0] < 60
+
+    def test_apply_colors_invalid_color(self):
+        img = Image.new('RGB', (100, 100), color='black')
+        img_bytes = io.BytesIO()
+        img.save(img_bytes, format='JPEG')
+        img_bytes.seek(0)
+
+        files = {"file": ("test_image.jpg", img_bytes, "image/jpeg")}
+        image_id = client.post("/upload-image", files=files).json()["image_id"]
+        client.post("/generate-masks", json={"image_id": image_id})
+        response = client.post("/apply-colors", json={"image_id": image_id, "mask_ids": ["0"], "color": "red"})
+        assert response.status_code == 400
+
 class TestDownloadEndpoint:
     def test_download_no_image(self):
         """Test downloading non-existent image"""
@@ -175,6 +294,67 @@ class TestDownloadEndpoint:
         assert response.status_code == 200
         assert response.headers["content-type"] == "image/jpeg"
 
+class TestRenderCaching:
+    def upload_and_generate(self):
+        img = Image.new('RGB', (100, 100), color='white')
+        img_bytes = io.BytesIO()
+        img.save(img_bytes, format='JPEG')
+        img_bytes.seek(0)
+
+        files = {"file": ("test_image.jpg", img_bytes, "image/jpeg")}
+        image_id = client.post("/upload-image", files=files).json()["image_id"]
+        client.post("/generate-masks", json={"image_id": image_id})
+        return image_id
+
+    def apply(self, image_id, color):
+        return client.post("/apply-colors", json={"image_id": image_id, "mask_ids": ["0"], "color": color}).json()
+
+    def test_repeated_colors_not_recomputed(self, monkeypatch):
+        """Toggling back to an earlier palette is served from the cache"""
+        image_id = self.upload_and_generate()
+        first = self.apply(image_id, "#ff0000")
+        self.apply(image_id, "#00ff00")
+
+        monkeypatch.setattr(main, "render_colored_image", lambda *args: pytest.fail("re-rendered"))
+        again = self.apply(image_id, "#ff0000")
+        assert again["cached"] and not first["cached"]
+        assert again["render_id"] == first["render_id"]
+        assert again["colored_image_path"] == first["colored_image_path"]
+
+    def test_download_conditional(self):
+        """Downloads carry an ETag and answer If-None-Match with 304"""
+        image_id = self.upload_and_generate()
+        applied = self.apply(image_id, "#0000ff")
+
+        response = client.get(applied["download_url"])
+        assert response.status_code == 200
+        assert response.headers["etag"] == f'"{applied["render_id"]}"'
+        assert "immutable" in response.headers["cache-control"]
+
+        response = client.get(applied["download_url"], headers={"If-None-Match": response.headers["etag"]})
+        assert response.status_code == 304
+        assert response.content == b""
+
+    def test_download_latest_render(self):
+        image_id = self.upload_and_generate()
+        self.apply(image_id, "#0000ff")
+        latest = self.apply(image_id, "#ff00ff")
+        response = client.get(f"/download/{image_id}")
+        assert response.headers["etag"] == f'"{latest["render_id"]}"'
+        assert response.headers["cache-control"] == "no-cache"
+
+    def test_download_render_of_other_image(self):
+        """A render key only downloads under the image it was rendered from"""
+        first, second = self.upload_and_generate(), self.upload_and_generate()
+        applied = self.apply(first, "#0000ff")
+        assert client.get(f"/download/{first}", params={"render": applied["render_id"]}).status_code == 200
+        assert client.get(f"/download/{second}", params={"render": applied["render_id"]}).status_code == 404
+
+    def test_download_unknown_render(self):
+        image_id = self.upload_and_generate()
+        response = client.get(f"/download/{image_id}", params={"render": "0" * 32})
+        assert response.status_code == 404
+
 class TestDebugEndpoints:
     def test_debug_masks_no_image(self):
         """Test debug masks endpoint for non-existent image"""
@@ -213,6 +393,250 @@ class TestDebugEndpoints:
         assert "mask_size" in data
         assert "bbox" in data
 
+class TestMaskFormats:
+    def upload_and_generate(self, params=None, headers=None):
+        """Upload a test image and generate masks with the given format options"""
+        img = Image.new('RGB', (120, 80), color='white')
+        img_bytes = io.BytesIO()
+        img.save(img_bytes, format='JPEG')
+        img_bytes.seek(0)
+
+        files = {"file": ("test_image.jpg", img_bytes, "image/jpeg")}
+        image_id = client.post("/upload-image", files=files).json()["image_id"]
+        return client.post("/generate-masks", json={"image_id": image_id}, params=params, headers=headers)
+
+    def test_generate_masks_default_rle(self):
+        """Masks are returned as COCO RLE by default"""
+        response = self.upload_and_generate()
+        assert response.status_code == 200
+        assert response.headers["x-mask-format"] == "rle"
+        segmentation = response.json()["masks"][0]["segmentation"]
+        assert segmentation["size"] == [80, 120]
+        assert sum(segmentation["counts"]) == 80 * 120
+
+    def test_generate_masks_dense_opt_in(self):
+        """The legacy nested boolean list is still available"""
+        response = self.upload_and_generate(params={"mask_format": "dense"})
+        segmentation = response.json()["masks"][0]["segmentation"]
+        assert len(segmentation) == 80
+        assert len(segmentation[0]) == 120
+
+    def test_generate_masks_bitmask_via_accept(self):
+        """The Accept header selects the packed bitmask format"""
+        response = self.upload_and_generate(headers={"Accept": "application/vnd.sam2.mask-bitmask+json"})
+        assert response.headers["x-mask-format"] == "bitmask"
+        assert "bits" in response.json()["masks"][0]["segmentation"]
+
+    def test_generate_masks_polygon(self):
+        """Polygon output lists simplified outlines in original pixels"""
+        response = self.upload_and_generate(params={"mask_format": "polygon"})
+        assert response.headers["x-mask-format"] == "polygon"
+        segmentation = response.json()["masks"][0]["segmentation"]
+        assert segmentation["size"] == [80, 120]
+        # One outline per mock disk, with few vertices and inside the image
+        assert len(segmentation["polygons"]) == 1
+        polygon = segmentation["polygons"][0]
+        assert 6 <= len(polygon) <= 40
+        assert all(0 <= x < 120 for x in polygon[::2]) and all(0 <= y < 80 for y in polygon[1::2])
+
+    def test_nms_suppresses_duplicate_masks(self, monkeypatch):
+        """With POSTPROCESS_NMS_IOU set, near-identical masks are returned once"""
+        def generate_batch(images):
+            results = []
+            for image in images:
+                masks = main.segmentation_backend.generate_all(image)
+                results.append(masks + [dict(masks[0], id="dup", predicted_iou=0.0)])
+            return results
+        monkeypatch.setattr(main.segmentation_backend, "generate_batch", generate_batch)
+        monkeypatch.setattr(main, "POSTPROCESS_NMS_IOU", 0.9)
+        ids = [mask["id"] for mask in self.upload_and_generate().json()["masks"]]
+        assert "dup" not in ids
+        assert len(ids) == 4
+
+    def test_msgpack_falls_back_to_json(self, monkeypatch):
+        """Without msgpack installed, MessagePack requests get JSON"""
+        monkeypatch.setattr(responses, "MSGPACK_AVAILABLE", False)
+        response = self.upload_and_generate(headers={"Accept": "application/msgpack"})
+        assert response.headers["content-type"] == "application/json"
+        assert "Accept" in response.headers["vary"]
+        assert response.json()["masks"]
+
+    def test_msgpack_response(self):
+        """Accept: application/msgpack selects a MessagePack body"""
+        msgpack = pytest.importorskip("msgpack")
+        response = self.upload_and_generate(headers={"Accept": "application/msgpack"})
+        assert response.headers["content-type"] == "application/msgpack"
+        assert response.headers["x-mask-format"] == "rle"
+        assert msgpack.unpackb(response.content)["masks"][0]["segmentation"]["size"] == [80, 120]
+
+    def test_invalid_mask_format(self):
+        """Unknown mask formats are rejected"""
+        response = client.get("/test/mock-mask", params={"mask_format": "png"})
+        assert response.status_code == 400
+
+class TestWorkingResolution:
+    @pytest.fixture
+    def image_id(self, monkeypatch):
+        """A 200x100 upload segmented at a 50 pixel working size"""
+        monkeypatch.setattr(main, "WORKING_MAX_SIDE", 50)
+        img = Image.new('RGB', (200, 100), color='blue')
+        img_bytes = io.BytesIO()
+        img.save(img_bytes, format='PNG')
+        img_bytes.seek(0)
+
+        files = {"file": ("test_image.png", img_bytes, "image/png")}
+        return client.post("/upload-image", files=files, params={"return_image": "false"}).json()["image_id"]
+
+    def test_masks_stored_at_working_size(self, image_id):
+        """Segmentations are working size while metadata is in original pixels"""
+        response = client.post("/generate-masks", json={"image_id": image_id})
+        mask = response.json()["masks"][0]
+        assert mask["segmentation"]["size"] == [25, 50]
+        record = main.image_store[image_id]
+        assert (record.width, record.height) == (200, 100)
+        assert (record.working_width, record.working_height) == (50, 25)
+        assert mask["bbox"] == [4 * v for v in record.get(mask["id"]).bbox]
+
+    def test_original_resolution_opt_in(self, image_id):
+        response = client.post("/generate-masks", json={"image_id": image_id},
+                               params={"mask_resolution": "original"})
+        assert response.json()["masks"][0]["segmentation"]["size"] == [100, 200]
+
+    def test_get_mask_points_rescaled(self, image_id):
+        """Clicks in original pixels land on the matching working pixel"""
+        client.post("/generate-masks", json={"image_id": image_id})
+        response = client.post("/get-mask", json={
+            "image_id": image_id,
+            "points": [{"x": 100, "y": 50}],
+            "labels": [1]
+        }, params={"mask_format": "dense"})
+        segmentation = response.json()["segmentation"]
+        assert len(segmentation) == 25 and len(segmentation[0]) == 50
+        assert segmentation[12][25]
+
+    def test_apply_colors_full_resolution(self, image_id):
+        """Coloring upsamples masks onto the original image"""
+        masks = client.post("/generate-masks", json={"image_id": image_id}).json()["masks"]
+        response = client.post("/apply-colors", json={"image_id": image_id, "mask_ids": [masks[0]["id"]], "color": "#ff0000"})
+
+        colored = Image.open(response.json()["colored_image_path"])
+        assert colored.size == (200, 100)
+        x, y = (round(c) for c in masks[0]["centroid"])
+        red, green, blue = colored.getpixel((x, y))
+        assert red > 200 and blue < 60
+
+    def test_invalid_resolution(self, image_id):
+        response = client.post("/generate-masks", json={"image_id": image_id},
+                               params={"mask_resolution": "huge"})
+        assert response.status_code == 400
+
+class TestMaskTiles:
+    @pytest.fixture
+    def image_id(self):
+        img = Image.new('RGB', (200, 100), color='blue')
+        img_bytes = io.BytesIO()
+        img.save(img_bytes, format='PNG')
+        img_bytes.seek(0)
+
+        files = {"file": ("test_image.png", img_bytes, "image/png")}
+        image_id = client.post("/upload-image", files=files, params={"return_image": "false"}).json()["image_id"]
+        client.post("/generate-masks", json={"image_id": image_id})
+        return image_id
+
+    def test_index_has_no_pixels(self, image_id):
+        response = client.get(f"/masks/{image_id}")
+        assert response.status_code == 200
+        data = response.json()
+        assert data["mask_count"] == 4
+        assert all("segmentation" not in mask and "bbox" in mask for mask in data["masks"])
+
+    def test_index_filtered_by_viewport(self, image_id):
+        """Only masks overlapping the viewport are listed"""
+        data = client.get(f"/masks/{image_id}", params={"bbox": "0,0,100,50"}).json()
+        assert [mask["id"] for mask in data["masks"]] == ["0"]
+
+    def test_tile(self, image_id):
+        """A downscaled region of one mask, in the negotiated format"""
+        mask = client.get(f"/masks/{image_id}").json()["masks"][0]
+        x, y = (round(c) for c in mask["centroid"])
+        response = client.get(f"/masks/{image_id}/{mask['id']}", params={
+            "bbox": f"{x - 20},{y - 20},40,40", "scale": 0.5, "mask_format": "dense"
+        })
+        assert response.status_code == 200
+        data = response.json()
+        assert data["size"] == [20, 20]
+        assert data["segmentation"][10][10]
+
+    def test_tile_errors(self, image_id):
+        assert client.get(f"/masks/{image_id}/missing").status_code == 404
+        assert client.get(f"/masks/{image_id}/0", params={"scale": 2}).status_code == 422
+        assert client.get(f"/masks/{image_id}/0", params={"bbox": "500,500,10,10"}).status_code == 400
+
+class TestHitTest:
+    @pytest.fixture
+    def image_id(self, monkeypatch):
+        """A 200x100 upload segmented at a 50 pixel working size"""
+        monkeypatch.setattr(main, "WORKING_MAX_SIDE", 50)
+        img = Image.new('RGB', (200, 100), color='blue')
+        img_bytes = io.BytesIO()
+        img.save(img_bytes, format='PNG')
+        img_bytes.seek(0)
+
+        files = {"file": ("test_image.png", img_bytes, "image/png")}
+        image_id = client.post("/upload-image", files=files, params={"return_image": "false"}).json()["image_id"]
+        client.post("/generate-masks", json={"image_id": image_id})
+        return image_id
+
+    def test_point(self, image_id):
+        """The mock quadrant disks are found from original-pixel clicks"""
+        response = client.post("/hit-test", json={"image_id": image_id, "point": {"x": 50, "y": 25}})
+        assert response.status_code == 200
+        assert response.json()["top"] == "0"
+        assert response.json()["mask_ids"] == ["0"]
+        miss = client.post("/hit-test", json={"image_id": image_id, "point": {"x": 100, "y": 50}}).json()
+        assert miss["top"] is None and miss["mask_ids"] == []
+
+    def test_index_built_after_generation(self, image_id):
+        assert main.image_store[image_id].hit_index is not None
+
+    def test_rect_and_lasso(self, image_id):
+        response = client.post("/hit-test", json={"image_id": image_id, "rect": [0, 0, 200, 50]})
+        assert sorted(response.json()["mask_ids"]) == ["0", "1"]
+        lasso = [{"x": 40, "y": 60}, {"x": 60, "y": 60}, {"x": 50, "y": 90}]
+        response = client.post("/hit-test", json={"image_id": image_id, "lasso": lasso})
+        assert response.json()["mask_ids"] == ["2"]
+
+    def test_invalid_queries(self, image_id):
+        assert client.post("/hit-test", json={"image_id": image_id}).status_code == 400
+        both = {"image_id": image_id, "point": {"x": 1, "y": 1}, "rect": [0, 0, 5, 5]}
+        assert client.post("/hit-test", json=both).status_code == 400
+        outside = {"image_id": image_id, "point": {"x": 500, "y": 1}}
+        assert client.post("/hit-test", json=outside).status_code == 400
+        missing = {"image_id": "nonexistent", "point": {"x": 1, "y": 1}}
+        assert client.post("/hit-test", json=missing).status_code == 404
+
+class TestMetrics:
+    def test_stage_and_cache_metrics(self):
+        """Segmenting an image shows up in the stage histograms"""
+        img = Image.new('RGB', (100, 100), color='blue')
+        img_bytes = io.BytesIO()
+        img.save(img_bytes, format='JPEG')
+        img_bytes.seek(0)
+
+        files = {"file": ("test_image.jpg", img_bytes, "image/jpeg")}
+        image_id = client.post("/upload-image", files=files, params={"return_image": "false"}).json()["image_id"]
+        client.post("/generate-masks", json={"image_id": image_id})
+
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+        text = response.text
+        for stage in ("read", "decode", "segment", "serialize"):
+            assert f'sam2_stage_seconds_count{{stage="{stage}"}}' in text
+        assert 'sam2_payload_bytes_count{handler="/upload-image",direction="request"}' in text
+        assert "sam2_mask_store_bytes " in text
+        assert 'sam2_cache_hits_total{cache="image"}' in text
+
 class TestErrorHandling:
     def test_invalid_json(self):
         """Test handling of invalid JSON"""
@@ -224,5 +648,175 @@ class TestErrorHandling:
         response = client.post("/generate-masks", json={})
         assert response.status_code == 422
 
+class TestSharedState:
+    def test_other_worker_serves_masks(self, monkeypatch, tmp_path):
+        """Masks generated by one worker are served by another sharing the state backend"""
+        monkeypatch.setattr(main, "image_store", MaskStore(state=SQLiteState(tmp_path)))
+        files = {"file": ("test_image.jpg", make_jpeg(), "image/jpeg")}
+        image_id = client.post("/upload-image", files=files).json()["image_id"]
+        mask_ids = [mask["id"] for mask in client.post("/generate-masks", json={"image_id": image_id}).json()["masks"]]
+
+        # A second worker process starts with nothing in memory
+        monkeypatch.setattr(main, "image_store", MaskStore(state=SQLiteState(tmp_path)))
+        response = client.post("/apply-colors", json={"image_id": image_id, "mask_ids": mask_ids[:1], "color": "#ff0000"})
+        assert response.status_code == 200
+        assert main.image_store.stats()["reloads"] == 1
+
+    def test_other_worker_serves_latest_render(self, monkeypatch, tmp_path):
+        """/download on another worker serves the render this one made last"""
+        state = SQLiteState(tmp_path)
+        monkeypatch.setattr(main, "latest_renders", SharedValues(state, "latest-render:"))
+        files = {"file": ("test_image.jpg", make_jpeg(), "image/jpeg")}
+        image_id = client.post("/upload-image", files=files).json()["image_id"]
+        client.post("/generate-masks", json={"image_id": image_id})
+        applied = client.post("/apply-colors", json={"image_id": image_id, "mask_ids": ["0"], "color": "#ff0000"}).json()
+
+        monkeypatch.setattr(main, "latest_renders", SharedValues(SQLiteState(tmp_path), "latest-render:"))
+        monkeypatch.setattr(main, "render_cache", RenderCache(main.render_cache.directory))
+        response = client.get(f"/download/{image_id}")
+        assert response.status_code == 200
+        assert response.headers["etag"] == f'"{applied["render_id"]}"'
+
+class TestMmapStorage:
+    def test_endpoints_serve_mapped_masks_and_images(self, monkeypatch, tmp_path):
+        """Serialization, tiles and coloring work on memory-mapped storage"""
+        files = {"file": ("test_image.jpg", make_jpeg((160, 120)), "image/jpeg")}
+        image_id = client.post("/upload-image", files=files, params={"return_image": "false"}).json()["image_id"]
+        in_memory = client.post("/generate-masks", json={"image_id": image_id}).json()["masks"]
+
+        monkeypatch.setattr(main, "image_store", MaskStore(mmap_dir=tmp_path / "masks"))
+        monkeypatch.setattr(main, "image_cache", ArrayCache(spill_dir=tmp_path / "images", mmap=True))
+        main.forget_image(image_id)
+        assert client.post("/generate-masks", json={"image_id": image_id}).json()["masks"] == in_memory
+        assert (tmp_path / "masks" / f"{image_id}.npy").exists()
+        assert (tmp_path / "images" / f"{image_id}.npy").exists()
+        assert main.image_store.nbytes == 0
+
+        tile = client.get(f"/masks/{image_id}/0", params={"scale": 0.5, "mask_format": "dense"})
+        assert tile.status_code == 200
+        response = client.post("/apply-colors", json={"image_id": image_id, "mask_ids": ["0"], "color": "#ff0000"})
+        assert response.status_code == 200
+
+class TestUploadDedupe:
+    @pytest.fixture(autouse=True)
+    def dedupe(self, monkeypatch, tmp_path):
+        monkeypatch.setattr(main, "UPLOADS_DIR", tmp_path)
+        monkeypatch.setattr(main, "UPLOAD_DEDUPE", "exact")
+        monkeypatch.setattr(main, "upload_index", UploadIndex())
+
+    def upload(self, data):
+        files = {"file": ("facade.jpg", io.BytesIO(data), "image/jpeg")}
+        return client.post("/upload-image", files=files, params={"return_image": "false"}).json()
+
+    def test_identical_upload_reuses_segmentation(self, monkeypatch):
+        """A second upload of the same bytes gets its own id but the first one's masks"""
+        data = make_jpeg((140, 90)).getvalue()
+        first = self.upload(data)
+        first_masks = client.post("/generate-masks", json={"image_id": first["image_id"]}).json()["masks"]
+
+        second = self.upload(data)
+        assert second["image_id"] != first["image_id"]
+        assert second["duplicate"] is True
+        # The duplicate is a hard link, not a second copy
+        assert (main.UPLOADS_DIR / f"{second['image_id']}.jpg").stat().st_nlink == 2
+
+        calls = []
+        monkeypatch.setattr(main.segmentation_backend, "generate_all", lambda image: calls.append(1) or [])
+        response = client.post("/generate-masks", json={"image_id": second["image_id"]})
+        assert response.json()["image_id"] == second["image_id"]
+        assert response.json()["masks"] == first_masks
+        assert calls == []
+
+    def test_renders_shared_but_latest_render_per_upload(self):
+        data = make_jpeg((140, 90)).getvalue()
+        first, second = self.upload(data)["image_id"], self.upload(data)["image_id"]
+        client.post("/generate-masks", json={"image_id": first})
+        colors = {"mask_ids": ["0"], "color": "#00ff00"}
+        assert client.post("/apply-colors", json={"image_id": first, **colors}).json()["cached"] is False
+        rendered = client.post("/apply-colors", json={"image_id": second, **colors}).json()
+        assert rendered["cached"] is True
+        assert rendered["download_url"].startswith(f"/download/{second}")
+        assert main.latest_renders[second] == rendered["render_id"]
+
+    def test_janitor_releases_last_reference(self, monkeypatch):
+        """Shared state stays while any upload of the image does"""
+        data = make_jpeg((140, 90)).getvalue()
+        first, second = self.upload(data)["image_id"], self.upload(data)["image_id"]
+        monkeypatch.setattr(main, "UPLOAD_TTL_SECONDS", 0)
+        monkeypatch.setattr(main, "image_store", MaskStore())
+        asyncio.run(main.clean_up_expired())
+        assert main.upload_index.references(first) == 0
+        assert main.upload_index.resolve(second) == second
+
+    def test_different_upload_not_deduplicated(self):
+        first = self.upload(make_jpeg((140, 90)).getvalue())
+        second = self.upload(make_jpeg((150, 90)).getvalue())
+        assert "duplicate" not in second
+        assert main.upload_index.resolve(second["image_id"]) != first["image_id"]
+
+class TestOutputFormats:
+    @pytest.fixture(autouse=True)
+    def uploads(self, monkeypatch, tmp_path):
+        monkeypatch.setattr(main, "UPLOADS_DIR", tmp_path)
+        monkeypatch.setattr(main, "render_cache", main.RenderCache(tmp_path / "renders"))
+
+    def upload_png(self):
+        """A transparent PNG sent with a misleading filename and content type"""
+        image = Image.new("RGBA", (120, 80), (0, 0, 0, 0))
+        image.paste((0, 128, 255, 255), (20, 20, 100, 60))
+        data = io.BytesIO()
+        image.save(data, format="PNG")
+        files = {"file": ("facade.jpg", data.getvalue(), "image/jpeg")}
+        image_id = client.post("/upload-image", files=files, params={"return_image": "false"}).json()["image_id"]
+        client.post("/generate-masks", json={"image_id": image_id})
+        return image_id
+
+    def test_upload_keeps_its_container(self):
+        image_id = self.upload_png()
+        assert (main.UPLOADS_DIR / f"{image_id}.png").exists()
+        response = client.get(f"/download/{image_id}")
+        assert response.headers["content-type"] == "image/png"
+        assert response.content[:8] == b"\x89PNG\r\n\x1a\n"
+
+    @pytest.mark.parametrize("output_format,media_type", [("png", "image/png"), ("webp", "image/webp")])
+    def test_apply_colors_in_chosen_format(self, output_format, media_type):
+        image_id = self.upload_png()
+        applied = client.post("/apply-colors", json={
+            "image_id": image_id, "mask_ids": ["0"], "color": "#ff0000", "format": output_format, "quality": 70
+        }).json()
+        assert applied["format"] == output_format
+        assert applied["colored_image_path"].endswith(f".{output_format}")
+        response = client.get(applied["download_url"])
+        assert response.headers["content-type"] == media_type
+        assert Image.open(io.BytesIO(response.content)).size == (120, 80)
+
+    def test_direct_bytes_write_no_file(self):
+        image_id = self.upload_png()
+        response = client.post("/apply-colors", params={"direct": "true"}, json={
+            "image_id": image_id, "mask_ids": ["0"], "color": "#ff0000", "format": "webp"
+        })
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "image/webp"
+        assert Image.open(io.BytesIO(response.content)).format == "WEBP"
+        assert response.headers["etag"] == f'"{response.headers["x-render-id"]}"'
+        assert main.render_cache.stats()["entries"] == 0
+        assert image_id not in main.latest_renders
+
+    def test_download_transcodes_on_request(self):
+        image_id = self.upload_png()
+        applied = client.post("/apply-colors", json={"image_id": image_id, "mask_ids": ["0"], "color": "#ff0000"}).json()
+        response = client.get(applied["download_url"], params={"format": "png"})
+        assert response.headers["content-type"] == "image/png"
+        assert response.headers["etag"] != f'"{applied["render_id"]}"'
+        assert 'filename="colored_building_' in response.headers["content-disposition"]
+        assert main.render_cache.stats()["entries"] == 1
+
+    def test_invalid_format_rejected(self):
+        image_id = self.upload_png()
+        response = client.post("/apply-colors", json={
+            "image_id": image_id, "mask_ids": ["0"], "color": "#ff0000", "format": "gif"
+        })
+        assert response.status_code == 422
+
 if __name__ == "__main__":
-    pytest.main([__file__]) 
\ No newline at end of file
+    pytest.main([__file__]) 
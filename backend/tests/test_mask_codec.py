@@ -0,0 +1,89 @@
+import pytest
+import numpy as np
+from mask_codec import (
+    encode_rle,
+    decode_rle,
+    encode_bitmask,
+    decode_bitmask,
+    encode_mask,
+    encode_mask_crop,
+    encode_rle_crop,
+    negotiate_mask_format,
+)
+
+def make_mask():
+    """Create a small mask with runs touching both edges"""
+    mask = np.zeros((7, 11), dtype=bool)
+    mask[0, 0] = True
+    mask[2:5, 3:9] = True
+    mask[6, 10] = True
+    return mask
+
+class TestRle:
+    def test_round_trip(self):
+        """RLE decodes back to the original mask"""
+        mask = make_mask()
+        assert np.array_equal(decode_rle(encode_rle(mask)), mask)
+
+    def test_coco_layout(self):
+        """Counts are column-major and start with the False run"""
+        mask = np.array([[True, False], [True, True]])
+        rle = encode_rle(mask)
+        assert rle["size"] == [2, 2]
+        # Column-major order is T, T, F, T
+        assert rle["counts"] == [0, 2, 1, 1]
+
+    def test_empty_and_full(self):
+        """All-False and all-True masks encode as a single run"""
+        assert encode_rle(np.zeros((3, 4), dtype=bool))["counts"] == [12]
+        assert encode_rle(np.ones((3, 4), dtype=bool))["counts"] == [0, 12]
+
+class TestCropEncoding:
+    def test_rle_crop_matches_full_frame(self):
+        """Encoding from a bbox crop gives the same runs as the full mask"""
+        rng = np.random.default_rng(0)
+        for _ in range(200):
+            height, width = rng.integers(1, 12, 2)
+            x0, x1 = sorted(rng.integers(0, width + 1, 2))
+            y0, y1 = sorted(rng.integers(0, height + 1, 2))
+            crop = rng.random((y1 - y0, x1 - x0)) < 0.5
+            full = np.zeros((height, width), dtype=bool)
+            full[y0:y1, x0:x1] = crop
+            assert encode_rle_crop(crop, x0, y0, height, width) == encode_rle(full)
+
+    def test_empty_crop(self):
+        assert encode_rle_crop(np.zeros((0, 0), dtype=bool), 0, 0, 3, 4)["counts"] == [12]
+
+    def test_other_formats_fall_back_to_full_frame(self):
+        mask = make_mask()
+        assert encode_mask_crop(mask[1:5, 2:9], 2, 1, 7, 11, "bitmask") == encode_bitmask(
+            np.pad(mask[1:5, 2:9], ((1, 2), (2, 2)))
+        )
+
+class TestBitmask:
+    def test_round_trip(self):
+        """Packed bitmask decodes back to the original mask"""
+        mask = make_mask()
+        assert np.array_equal(decode_bitmask(encode_bitmask(mask)), mask)
+
+    def test_dense_matches_tolist(self):
+        """The legacy format is the nested list of booleans"""
+        mask = make_mask()
+        assert encode_mask(mask, "dense") == mask.tolist()
+
+class TestNegotiation:
+    def test_default_is_rle(self):
+        """Without a preference the compact RLE format is used"""
+        assert negotiate_mask_format() == "rle"
+        assert negotiate_mask_format(None, "application/json") == "rle"
+
+    def test_query_wins_over_accept(self):
+        """The query parameter overrides the Accept header"""
+        accept = "application/vnd.sam2.mask-bitmask+json"
+        assert negotiate_mask_format("dense", accept) == "dense"
+        assert negotiate_mask_format(None, accept) == "bitmask"
+
+    def test_unknown_query_format(self):
+        """Unknown formats are rejected"""
+        with pytest.raises(ValueError):
+            negotiate_mask_format("png")
@@ -0,0 +1,136 @@
+import time
+import numpy as np
+from mask_store import ImageRecord, MaskStore, StoredMask
+
+def make_disk(height=200, width=300, cx=120, cy=80, r=30):
+    """Create a boolean disk mask"""
+    yy, xx = np.ogrid[:height, :width]
+    return (xx - cx) ** 2 + (yy - cy) ** 2 <= r ** 2
+
+class TestStoredMask:
+    def test_precomputed_statistics(self):
+        """Area, bbox and centroid are computed from the pixels"""
+        mask = make_disk()
+        stored = StoredMask.from_array("0", mask)
+        assert stored.area == int(mask.sum())
+        assert stored.bbox == [90, 50, 61, 61]
+        assert np.allclose(stored.centroid, [120.0, 80.0])
+
+    def test_round_trip(self):
+        """The full-frame array and the crop decode back exactly"""
+        mask = make_disk()
+        stored = StoredMask.from_array("0", mask)
+        assert np.array_equal(stored.to_array(), mask)
+        x, y, w, h = stored.bbox
+        assert np.array_equal(stored.crop(), mask[y:y + h, x:x + w])
+
+    def test_empty_mask(self):
+        """Empty masks store no pixel data"""
+        stored = StoredMask.from_array("0", np.zeros((10, 10), dtype=bool))
+        assert stored.area == 0
+        assert stored.nbytes == 0
+        assert not stored.to_array().any()
+
+    def test_memory_reduction(self):
+        """Packed crops are at least 8x smaller than a boolean array"""
+        mask = make_disk(1000, 1000, 500, 500, 400)
+        stored = StoredMask.from_array("0", mask)
+        assert stored.nbytes * 8 <= mask.nbytes
+
+class TestMaskStore:
+    def test_put_and_index(self):
+        """Masks are looked up by id and keep extra metadata"""
+        store = MaskStore()
+        record = store.put("img", 300, 200, [
+            {"id": "a", "segmentation": make_disk(), "predicted_iou": 0.9},
+            {"id": "b", "segmentation": make_disk(cx=200)},
+        ])
+        assert "img" in store
+        assert len(store) == 1
+        assert record.get("a").meta["predicted_iou"] == 0.9
+        assert record.get("b").bbox[0] == 170
+        assert record.get("missing") is None
+        assert store.nbytes == record.nbytes > 0
+
+    def make_record(self, store, image_id, count=2):
+        return store.put(image_id, 300, 200, [
+            {"id": str(i), "segmentation": make_disk(cx=60 + 40 * i), "predicted_iou": 0.5 + i / 10}
+            for i in range(count)
+        ])
+
+    def test_lru_eviction_by_bytes(self):
+        """Least recently used records are dropped once over the byte budget"""
+        probe = self.make_record(MaskStore(), "probe")
+        store = MaskStore(max_bytes=2 * probe.nbytes)
+        self.make_record(store, "a")
+        self.make_record(store, "b")
+        store.get("a")
+        self.make_record(store, "c")
+        assert "a" in store and "c" in store
+        assert "b" not in store
+        assert store.nbytes == 2 * probe.nbytes
+        assert store.stats()["evictions"] == 1
+
+    def test_spill_and_reload(self, tmp_path):
+        """Evicted records are written to disk and reloaded exactly on access"""
+        probe = self.make_record(MaskStore(), "probe")
+        store = MaskStore(max_bytes=probe.nbytes, spill_dir=tmp_path)
+        original = store.add(ImageRecord("a", 400, 300, probe.masks, 300, 200))
+        self.make_record(store, "b")
+        assert store.stats()["spills"] == 1
+        assert "a" in store and len(store) == 2
+
+        reloaded = store.get("a")
+        assert reloaded is not original
+        assert store.stats()["reloads"] == 1
+        assert (reloaded.width, reloaded.working_width) == (400, 300)
+        for mask in original.masks:
+            copy = reloaded.get(mask.id)
+            assert copy.bbox == mask.bbox and copy.meta == mask.meta
+            assert np.array_equal(copy.to_array(), mask.to_array())
+
+    def test_spill_survives_restart(self, tmp_path):
+        store = MaskStore(spill_dir=tmp_path)
+        record = self.make_record(store, "a")
+        store.spill_all()
+        store.close()
+
+        restarted = MaskStore(spill_dir=tmp_path)
+        assert "a" in restarted
+        assert np.array_equal(restarted["a"].get("1").to_array(), record.get("1").to_array())
+
+    def test_ttl_expiry(self, tmp_path):
+        """Idle records are removed from memory and disk"""
+        store = MaskStore(ttl=60, spill_dir=tmp_path)
+        self.make_record(store, "a")
+        self.make_record(store, "b")
+        store.spill_all()
+        store.get("b")
+        assert store.expire(now=time.time() + 30) == []
+        assert sorted(store.expire(now=time.time() + 120)) == ["a", "b"]
+        assert "a" not in store and len(store) == 0
+        assert not list(tmp_path.glob("*.masks"))
+
+    def test_replacing_record_drops_spilled_copy(self, tmp_path):
+        store = MaskStore(spill_dir=tmp_path)
+        self.make_record(store, "a", count=2)
+        store.spill_all()
+        self.make_record(store, "a", count=1)
+        store.spill_all()
+        assert len(MaskStore(spill_dir=tmp_path)["a"].masks) == 1
+
+    def test_mmap_storage(self, tmp_path):
+        """Mask bits are served from a mapped .npy file and cost no heap"""
+        store = MaskStore(max_bytes=1, mmap_dir=tmp_path)
+        heap = self.make_record(MaskStore(), "heap", count=3)
+        record = self.make_record(store, "a", count=3)
+        assert all(isinstance(mask.bits, np.memmap) for mask in record.masks)
+        assert (tmp_path / "a.npy").exists()
+        assert store.nbytes == 0
+        assert store.stats()["mapped_bytes"] == heap.nbytes
+        self.make_record(store, "b")
+        assert store.stats()["evictions"] == 0
+        for mask in heap.masks:
+            assert np.array_equal(record.get(mask.id).to_array(), mask.to_array())
+        store.pop("a")
+        assert not (tmp_path / "a.npy").exists()
@@ -0,0 +1,78 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from metrics import MetricsMiddleware, Registry, counter, server_timing, stage, stage_seconds, timed_call
+
+def two_stages(value):
+    with stage("decode"):
+        pass
+    with stage("segment"):
+        return value * 2
+
+class TestHistogram:
+    def test_render_cumulative_buckets(self):
+        registry = Registry()
+        histogram = registry.histogram("latency_seconds", "Latency", ["stage"], buckets=[0.1, 1.0])
+        histogram.observe(0.05, stage="decode")
+        histogram.observe(0.5, stage="decode")
+        histogram.observe(5, stage="decode")
+        text = registry.render()
+        assert "# TYPE latency_seconds histogram" in text
+        assert 'latency_seconds_bucket{stage="decode",le="0.1"} 1' in text
+        assert 'latency_seconds_bucket{stage="decode",le="1"} 2' in text
+        assert 'latency_seconds_bucket{stage="decode",le="+Inf"} 3' in text
+        assert 'latency_seconds_count{stage="decode"} 3' in text
+        assert 'latency_seconds_sum{stage="decode"} 5.55' in text
+
+    def test_collectors_and_label_escaping(self):
+        registry = Registry()
+        registry.register(lambda: [counter("hits", "Cache hits", [({"cache": 'a"b'}, 3)])])
+        text = registry.render()
+        assert "# TYPE hits counter" in text
+        assert 'hits_total{cache="a\\"b"} 3' in text
+
+class TestStageTiming:
+    def test_timed_call_collects_inner_stages(self):
+        with ThreadPoolExecutor(1) as executor:
+            timings, result = executor.submit(timed_call, None, two_stages, 21).result()
+        assert result == 42
+        assert [name for name, _ in timings] == ["decode", "segment"]
+
+    def test_named_call_is_one_stage(self):
+        timings, result = timed_call("serialize", sorted, [2, 1])
+        assert result == [1, 2]
+        assert [name for name, _ in timings] == ["serialize"]
+
+    def test_stage_outside_worker_is_recorded(self):
+        before = stage_seconds.count(stage="composite")
+        with stage("composite"):
+            pass
+        assert stage_seconds.count(stage="composite") == before + 1
+
+    def test_server_timing_sums_repeats(self):
+        header = server_timing([("decode", 0.002), ("segment", 0.01), ("decode", 0.003)])
+        assert header == "decode;dur=5.0, segment;dur=10.0"
+
+class TestMiddleware:
+    def test_server_timing_header(self):
+        app = FastAPI()
+        app.add_middleware(MetricsMiddleware, server_timing=True)
+
+        @app.get("/work")
+        async def work():
+            with stage("encode"):
+                pass
+            return {"ok": True}
+
+        response = TestClient(app).get("/work")
+        assert response.status_code == 200
+        names = [entry.split(";")[0] for entry in response.headers["server-timing"].split(", ")]
+        assert names == ["encode", "total"]
+
+    def test_header_off_by_default(self):
+        app = FastAPI()
+        app.add_middleware(MetricsMiddleware)
+        app.get("/work")(lambda: {"ok": True})
+        assert "server-timing" not in TestClient(app).get("/work").headers
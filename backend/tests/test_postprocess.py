@@ -0,0 +1,137 @@
+import numpy as np
+import pytest
+
+import backends
+import postprocess
+from mask_store import StoredMask
+from postprocess import (
+    clean_mask,
+    fill_holes,
+    is_duplicate,
+    mask_iou,
+    mask_polygons,
+    nms,
+    postprocess_masks,
+    remove_small_components,
+)
+
+def box(x0, y0, x1, y1, mask_id, height=60, width=80, **meta):
+    mask = np.zeros((height, width), dtype=bool)
+    mask[y0:y1, x0:x1] = True
+    return StoredMask.from_array(mask_id, mask, **meta)
+
+@pytest.fixture(params=[False, True], ids=["numpy", "cv2"])
+def use_cv2(request, monkeypatch):
+    """Run a test with and without OpenCV"""
+    if request.param and not backends.CV2_AVAILABLE:
+        pytest.skip("OpenCV not installed")
+    monkeypatch.setattr(backends, "CV2_AVAILABLE", request.param)
+    monkeypatch.setattr(postprocess, "CV2_AVAILABLE", request.param)
+    return request.param
+
+class TestCleanup:
+    def test_small_components_removed(self, use_cv2):
+        mask = np.zeros((10, 10), dtype=bool)
+        mask[1:6, 1:6] = True
+        mask[8, 8] = True
+        cleaned = remove_small_components(mask, 2)
+        assert cleaned[3, 3] and not cleaned[8, 8]
+        assert np.count_nonzero(cleaned) == 25
+
+    def test_holes_filled_up_to_max_area(self, use_cv2):
+        mask = np.zeros((12, 12), dtype=bool)
+        mask[1:11, 1:11] = True
+        mask[3:5, 3:5] = False  # 4-pixel hole
+        mask[6:9, 6:9] = False  # 9-pixel hole
+        assert np.count_nonzero(fill_holes(mask)) == 100
+        assert np.count_nonzero(fill_holes(mask, 4)) == 100 - 9
+
+    def test_outside_background_is_not_a_hole(self, use_cv2):
+        """A notch open to the border stays empty"""
+        mask = np.ones((6, 6), dtype=bool)
+        mask[0:3, 2:4] = False
+        assert np.array_equal(fill_holes(mask), mask)
+
+    def test_clean_mask_keeps_frame_offset_and_meta(self):
+        mask = np.zeros((60, 80), dtype=bool)
+        mask[20:30, 40:50] = True
+        mask[22:24, 42:44] = False
+        mask[35, 55] = True
+        stored = StoredMask.from_array("7", mask, predicted_iou=0.9)
+        cleaned = clean_mask(stored, min_component_area=5, max_hole_area=10)
+        assert cleaned.id == "7"
+        assert cleaned.meta == {"predicted_iou": 0.9}
+        assert (cleaned.height, cleaned.width) == (60, 80)
+        assert cleaned.bbox == [40, 20, 10, 10]
+        assert cleaned.area == 100
+        assert cleaned.centroid == [44.5, 24.5]
+
+    def test_disabled_cleanup_returns_the_same_mask(self):
+        stored = box(10, 10, 20, 20, "0")
+        assert clean_mask(stored) is stored
+
+class TestNms:
+    def test_iou_uses_bbox_intersection(self):
+        a = box(0, 0, 20, 20, "a")
+        b = box(10, 0, 30, 20, "b")
+        assert mask_iou(a, b) == pytest.approx(200 / 600)
+        assert mask_iou(a, box(40, 40, 50, 50, "c")) == 0.0
+
+    def test_lower_scoring_duplicate_suppressed(self):
+        masks = [
+            box(0, 0, 20, 20, "low", predicted_iou=0.5),
+            box(1, 0, 21, 20, "high", predicted_iou=0.9),
+            box(40, 30, 60, 50, "other", predicted_iou=0.1),
+        ]
+        assert [mask.id for mask in nms(masks, 0.7)] == ["high", "other"]
+        # Below the threshold both are kept, in their original order
+        assert [mask.id for mask in nms(masks, 0.99)] == ["low", "high", "other"]
+
+    def test_nested_mask_kept(self):
+        """A part inside a larger surface has low IoU with it"""
+        masks = [box(0, 0, 40, 40, "wall", score=0.9), box(10, 10, 20, 20, "window", score=0.8)]
+        assert len(nms(masks, 0.5)) == 2
+
+    def test_is_duplicate(self):
+        kept = [box(0, 0, 20, 20, "a")]
+        assert is_duplicate(box(0, 0, 20, 19, "b"), kept, 0.9)
+        assert not is_duplicate(box(0, 0, 20, 10, "c"), kept, 0.9)
+
+    def test_postprocess_drops_emptied_masks(self):
+        masks = [box(0, 0, 2, 2, "speck"), box(10, 10, 30, 30, "kept")]
+        assert [mask.id for mask in postprocess_masks(masks, min_component_area=10)] == ["kept"]
+
+class TestPolygons:
+    def test_rectangle_has_four_vertices(self, use_cv2):
+        mask = np.zeros((20, 30), dtype=bool)
+        mask[5:15, 4:24] = True
+        polygons = mask_polygons(mask)
+        assert len(polygons) == 1
+        points = set(zip(polygons[0][::2], polygons[0][1::2]))
+        assert points == {(4, 5), (23, 5), (23, 14), (4, 14)}
+
+    def test_offset_and_one_polygon_per_component(self, use_cv2):
+        mask = np.zeros((20, 30), dtype=bool)
+        mask[2:8, 2:8] = True
+        mask[10:18, 15:28] = True
+        polygons = mask_polygons(mask, x=100, y=50)
+        assert len(polygons) == 2
+        xs = sorted(min(polygon[::2]) for polygon in polygons)
+        assert xs == [102, 115]
+
+    def test_tiny_components_dropped(self, use_cv2):
+        mask = np.zeros((10, 10), dtype=bool)
+        mask[4, 4] = True
+        mask[7, 1:5] = True
+        assert mask_polygons(mask) == []
+
+    def test_fallback_matches_opencv(self, monkeypatch):
+        """The NumPy tracer finds the same simplified outline as OpenCV"""
+        if not backends.CV2_AVAILABLE:
+            pytest.skip("OpenCV not installed")
+        yy, xx = np.mgrid[:40, :50]
+        mask = (xx - 25) ** 2 / 400 + (yy - 20) ** 2 / 225 <= 1
+        expected = mask_polygons(mask, 1.5)
+        monkeypatch.setattr(backends, "CV2_AVAILABLE", False)
+        monkeypatch.setattr(postprocess, "CV2_AVAILABLE", False)
+        assert mask_polygons(mask, 1.5) == expected
@@ -0,0 +1,58 @@
+from render_cache import RenderCache
+
+def render(cache, key, size):
+    temp = cache.temp_path("jpg")
+    temp.write_bytes(b"x" * size)
+    return cache.put(key, "jpg", temp)
+
+class TestRenderCache:
+    def test_hit_and_miss(self, tmp_path):
+        cache = RenderCache(tmp_path)
+        assert cache.get("a", "jpg") is None
+        path = render(cache, "a", 10)
+        assert cache.get("a", "jpg") == path
+        assert path.read_bytes() == b"x" * 10
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["misses"] == 1
+
+    def test_size_cap_evicts_lru(self, tmp_path):
+        cache = RenderCache(tmp_path, max_bytes=25)
+        render(cache, "a", 10)
+        render(cache, "b", 10)
+        cache.get("a", "jpg")
+        render(cache, "c", 10)
+        assert cache.get("b", "jpg") is None
+        assert not (tmp_path / "b.jpg").exists()
+        assert cache.get("a", "jpg") and cache.get("c", "jpg")
+        assert cache.stats()["bytes"] == 20
+
+    def test_no_temp_files_left(self, tmp_path):
+        cache = RenderCache(tmp_path)
+        render(cache, "a", 10)
+        assert [p.name for p in tmp_path.iterdir()] == ["a.jpg"]
+
+    def test_existing_renders_reused(self, tmp_path):
+        render(RenderCache(tmp_path), "a", 10)
+        restarted = RenderCache(tmp_path)
+        assert restarted.get("a", "jpg") is not None
+        assert restarted.stats()["bytes"] == 10
+
+    def test_find_any_extension(self, tmp_path):
+        cache = RenderCache(tmp_path)
+        temp = cache.temp_path("png")
+        temp.write_bytes(b"png")
+        path = cache.put("a", "png", temp)
+        assert cache.find("a", ("jpg", "png", "webp")) == path
+        assert cache.find("b", ("jpg", "png", "webp")) is None
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["misses"] == 1
+
+    def test_renders_from_other_workers(self, tmp_path):
+        """A render put by another process is found, and one it evicted is not"""
+        cache, other = RenderCache(tmp_path), RenderCache(tmp_path)
+        path = render(other, "a", 10)
+        assert cache.find("a", ("jpg",)) == path
+        assert cache.stats()["bytes"] == 10
+        path.unlink()
+        assert cache.find("a", ("jpg",)) is None
+        assert cache.stats()["bytes"] == 0
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+from backends import disk_mask
+from mask_store import ImageRecord, StoredMask
+from resampling import working_size, to_working_points, upsample_region, upsample_mask
+
+class TestWorkingSize:
+    def test_downscales_longest_side(self):
+        assert working_size(4000, 3000, 1024) == (1024, 768)
+        assert working_size(3000, 4000, 1024) == (768, 1024)
+
+    def test_small_or_disabled_unchanged(self):
+        assert working_size(800, 600, 1024) == (800, 600)
+        assert working_size(4000, 3000, 0) == (4000, 3000)
+
+class TestPoints:
+    def test_points_scaled_and_clamped(self):
+        points = to_working_points([[0, 0], [399, 199], [1000, -5]], 4.0, 4.0, 100, 50)
+        assert points == [[0, 0], [99, 49], [99, 0]]
+
+class TestUpsampling:
+    def test_identity_scale(self):
+        """A scale of one returns the crop unchanged for both methods"""
+        mask = disk_mask(40, 30, 20, 15, 8)
+        stored = StoredMask.from_array("0", mask)
+        for method in ("nearest", "bilinear"):
+            np.testing.assert_array_equal(upsample_mask(stored.crop(), stored.bbox, 1.0, 1.0, 40, 30, method), mask)
+
+    def test_nearest_integer_scale_repeats_pixels(self):
+        mask = disk_mask(40, 30, 20, 15, 8)
+        stored = StoredMask.from_array("0", mask)
+        full = upsample_mask(stored.crop(), stored.bbox, 2.0, 2.0, 80, 60, "nearest")
+        np.testing.assert_array_equal(full, mask.repeat(2, axis=0).repeat(2, axis=1))
+
+    @pytest.mark.parametrize("method", ["nearest", "bilinear"])
+    def test_matches_full_resolution_shape(self, method):
+        """An upsampled disk stays close to the disk rasterized at full size"""
+        small = StoredMask.from_array("0", disk_mask(100, 75, 50, 37, 20))
+        full = upsample_mask(small.crop(), small.bbox, 4.0, 4.0, 400, 300, method)
+        reference = disk_mask(400, 300, 200, 150, 80)
+        iou = np.count_nonzero(full & reference) / np.count_nonzero(full | reference)
+        assert iou > 0.95
+
+    def test_region_covers_scaled_bbox_only(self):
+        crop = np.ones((2, 3), dtype=bool)
+        x0, y0, region = upsample_region(crop, [10, 5, 3, 2], 2.5, 2.5, 1000, 1000)
+        assert (x0, y0) == (25, 12)
+        assert region.shape == (6, 8)
+
+    def test_unknown_method(self):
+        with pytest.raises(ValueError):
+            upsample_region(np.ones((2, 2), dtype=bool), [0, 0, 2, 2], 2.0, 2.0, 4, 4, "cubic")
+
+class TestRecordScale:
+    def test_metadata_in_original_coordinates(self):
+        stored = StoredMask.from_array("0", disk_mask(100, 50, 50, 25, 10), point_coords=[[50, 25]])
+        record = ImageRecord("img", 400, 200, [stored], 100, 50)
+        meta = record.mask_metadata(stored)
+        x, y, w, h = stored.bbox
+        assert meta["bbox"] == [4 * x, 4 * y, 4 * w, 4 * h]
+        assert meta["area"] == stored.area * 16
+        assert meta["point_coords"] == [[202, 102]]
+        assert meta["centroid"] == pytest.approx([201.5, 101.5], abs=0.5)
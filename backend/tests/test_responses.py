@@ -0,0 +1,43 @@
+import json
+
+import pytest
+
+from responses import EncodedResponse, encode_body, negotiate_encoding
+import responses
+
+class TestNegotiation:
+    def test_json_by_default(self):
+        assert negotiate_encoding(None) == "json"
+        assert negotiate_encoding("application/json") == "json"
+
+    def test_msgpack_only_when_available(self, monkeypatch):
+        monkeypatch.setattr(responses, "MSGPACK_AVAILABLE", True)
+        assert negotiate_encoding("application/json;q=0.5, application/msgpack") == "msgpack"
+        assert negotiate_encoding("application/x-msgpack") == "msgpack"
+        monkeypatch.setattr(responses, "MSGPACK_AVAILABLE", False)
+        assert negotiate_encoding("application/msgpack") == "json"
+
+class TestEncoding:
+    def test_json_round_trip(self):
+        content = {"masks": [{"bbox": [1, 2, 3, 4], "segmentation": {"size": [2, 2], "counts": [0, 4]}}]}
+        body, media_type = encode_body(content)
+        assert media_type == "application/json"
+        assert json.loads(body) == content
+
+    def test_stdlib_fallback(self, monkeypatch):
+        monkeypatch.setattr(responses, "ORJSON_AVAILABLE", False)
+        body, _ = encode_body({"score": 0.9, "ok": True})
+        assert json.loads(body) == {"score": 0.9, "ok": True}
+
+    def test_msgpack_round_trip(self):
+        msgpack = pytest.importorskip("msgpack")
+        content = {"counts": [0, 4, 2], "id": "a"}
+        body, media_type = encode_body(content, "msgpack")
+        assert media_type == "application/msgpack"
+        assert msgpack.unpackb(body) == content
+
+    def test_response_keeps_headers(self):
+        response = EncodedResponse(encode_body({"a": 1}), headers={"X-Mask-Format": "rle"})
+        assert response.headers["x-mask-format"] == "rle"
+        assert response.headers["content-type"] == "application/json"
+        assert json.loads(response.body) == {"a": 1}
@@ -0,0 +1,168 @@
+import io
+import time
+import numpy as np
+from fastapi.testclient import TestClient
+from PIL import Image
+from backends import disk_mask
+import main
+from main import app
+from mask_codec import decode_rle
+from sessions import RefinementSession, SessionManager, decode_session, encode_session, mask_diff
+from state import SQLiteState
+
+client = TestClient(app)
+
+def apply_diff(previous, diff):
+    """Client-side reconstruction: XOR the diff crop into the previous mask"""
+    mask = previous.copy()
+    x, y, w, h = diff["bbox"]
+    if diff["changed_pixels"]:
+        mask[y:y + h, x:x + w] ^= decode_rle(diff["segmentation"])
+    return mask
+
+class TestMaskDiff:
+    def test_first_mask_is_its_own_diff(self):
+        mask = disk_mask(80, 60, 30, 30, 10)
+        stored, diff = mask_diff(None, mask, "rle")
+        assert np.array_equal(stored.to_array(), mask)
+        assert diff["bbox"] == stored.bbox
+        assert np.array_equal(apply_diff(np.zeros_like(mask), diff), mask)
+
+    def test_diff_reconstructs_next_mask(self):
+        first = disk_mask(80, 60, 30, 30, 10)
+        second = disk_mask(80, 60, 36, 28, 12)
+        previous, _ = mask_diff(None, first, "rle")
+        _, diff = mask_diff(previous, second, "rle")
+        assert np.array_equal(apply_diff(first, diff), second)
+        assert diff["changed_pixels"] == np.count_nonzero(first ^ second)
+
+    def test_unchanged_mask_has_empty_diff(self):
+        mask = disk_mask(80, 60, 30, 30, 10)
+        previous, _ = mask_diff(None, mask, "rle")
+        _, diff = mask_diff(previous, mask, "bitmask")
+        assert diff["changed_pixels"] == 0
+        assert diff["bbox"] == [0, 0, 0, 0]
+
+class TestSessionManager:
+    def test_lru_and_ttl(self):
+        manager = SessionManager(max_sessions=2, ttl=60)
+        manager.get_or_create("img", "a")
+        manager.get_or_create("img", "b")
+        manager.get_or_create("img", "a")
+        manager.get_or_create("img", "c")
+        assert manager.get("img", "b") is None
+        assert manager.expire(now=time.time() + 120) == 2
+        assert len(manager) == 0
+
+    def test_discard_image(self):
+        manager = SessionManager()
+        manager.get_or_create("img", "a")
+        manager.get_or_create("other", "a")
+        manager.discard("img")
+        assert manager.get("img", "a") is None and manager.get("other", "a") is not None
+
+    def test_session_encoding_round_trip(self):
+        session = RefinementSession("img", "a")
+        session.points, session.labels = [[10, 20], [30, 40]], [1, 0]
+        session.mask, _ = mask_diff(None, disk_mask(40, 60, 30, 20, 10), "rle")
+        session.logits = np.arange(12, dtype=np.float32).reshape(1, 3, 4)
+        restored = RefinementSession("img", "a")
+        decode_session(restored, encode_session(session))
+        assert restored.points == session.points and restored.labels == session.labels
+        assert np.array_equal(restored.mask.to_array(), session.mask.to_array())
+        assert restored.mask.bbox == session.mask.bbox and restored.mask.area == session.mask.area
+        assert np.array_equal(restored.logits, session.logits)
+
+    def test_session_continues_on_another_worker(self, tmp_path):
+        first = SessionManager(state=SQLiteState(tmp_path))
+        second = SessionManager(state=SQLiteState(tmp_path))
+        session = first.get_or_create("img", "a")
+        first.load(session)
+        session.points, session.labels = [[1, 2]], [1]
+        first.save(session)
+
+        elsewhere = second.get_or_create("img", "a")
+        second.load(elsewhere)
+        assert elsewhere.points == [[1, 2]] and elsewhere.mask is None and elsewhere.logits is None
+        elsewhere.points.append([3, 4])
+        elsewhere.labels.append(0)
+        second.save(elsewhere)
+
+        first.load(session)
+        assert session.points == [[1, 2], [3, 4]] and session.labels == [1, 0]
+        second.discard("img")
+        first.load(session)
+        assert session.points == []
+
+class TestRefinementEndpoint:
+    def setup_image(self):
+        img_bytes = io.BytesIO()
+        Image.new('RGB', (160, 120), color='gray').save(img_bytes, format='PNG')
+        img_bytes.seek(0)
+        files = {"file": ("test_image.png", img_bytes, "image/png")}
+        image_id = client.post("/upload-image", files=files).json()["image_id"]
+        client.post("/generate-masks", json={"image_id": image_id})
+        return image_id
+
+    def click(self, image_id, points, labels, **extra):
+        response = client.post("/get-mask", json={
+            "image_id": image_id,
+            "points": [{"x": x, "y": y} for x, y in points],
+            "labels": labels,
+            "session_id": "s1",
+            **extra
+        })
+        assert response.status_code == 200
+        return response.json()
+
+    def test_clicks_send_only_deltas(self):
+        """Later clicks append to the session and return diffs that rebuild the mask"""
+        image_id = self.setup_image()
+        first = self.click(image_id, [(40, 40)], [1])
+        assert first["clicks"] == 1
+        mask = apply_diff(np.zeros(first["diff"]["size"], dtype=bool), first["diff"])
+        assert mask[40, 40] and mask.sum() == first["area"]
+
+        # The mock backend only follows the first click, so this changes nothing
+        second = self.click(image_id, [(100, 80)], [0])
+        assert second["clicks"] == 2
+        assert second["diff"]["changed_pixels"] == 0
+
+        third = self.click(image_id, [(100, 80)], [1], reset=True)
+        assert third["clicks"] == 1
+        mask = apply_diff(mask, third["diff"])
+        assert mask[80, 100] and not mask[40, 40]
+
+    def test_sessions_are_independent(self):
+        image_id = self.setup_image()
+        self.click(image_id, [(40, 40)], [1])
+        other = client.post("/get-mask", json={
+            "image_id": image_id, "points": [{"x": 40, "y": 40}], "labels": [1], "session_id": "s2"
+        }).json()
+        assert other["clicks"] == 1
+
+    def test_original_resolution_diffs(self, monkeypatch):
+        """With ?mask_resolution=original, diffs rebuild the mask in original pixels"""
+        monkeypatch.setattr(main, "WORKING_MAX_SIDE", 80)
+        image_id = self.setup_image()
+        params = {"mask_resolution": "original"}
+        first = client.post("/get-mask", params=params, json={
+            "image_id": image_id, "points": [{"x": 40, "y": 40}], "labels": [1], "session_id": "s1"
+        }).json()
+        assert first["diff"]["size"] == [120, 160]
+        mask = apply_diff(np.zeros(first["diff"]["size"], dtype=bool), first["diff"])
+        assert mask[40, 40]
+        assert abs(int(mask.sum()) - first["area"]) < first["area"] * 0.1
+
+        second = client.post("/get-mask", params=params, json={
+            "image_id": image_id, "points": [{"x": 120, "y": 90}], "labels": [1], "session_id": "s1", "reset": True
+        }).json()
+        mask = apply_diff(mask, second["diff"])
+        assert mask[90, 120] and not mask[40, 40]
+
+    def test_mismatched_labels(self):
+        image_id = self.setup_image()
+        response = client.post("/get-mask", json={
+            "image_id": image_id, "points": [{"x": 1, "y": 1}], "labels": [], "session_id": "s1"
+        })
+        assert response.status_code == 400
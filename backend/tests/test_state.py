@@ -0,0 +1,229 @@
+import fnmatch
+import time
+
+import numpy as np
+import pytest
+
+from mask_store import MaskStore, decode_record, encode_record
+from state import HashRing, RedisState, SharedValues, SQLiteState, create_state, new_stamp
+
+def make_disk(height=200, width=300, cx=120, cy=80, r=30):
+    yy, xx = np.ogrid[:height, :width]
+    return (xx - cx) ** 2 + (yy - cy) ** 2 <= r ** 2
+
+class FakeRedis:
+    """In-process stand-in for the redis-py client methods RedisState uses"""
+
+    def __init__(self):
+        self.data = {}
+        self.lists = {}
+        self.ttls = {}
+
+    def set(self, key, value, ex=None):
+        self.data[key] = bytes(value)
+        self.ttls[key] = ex
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def getrange(self, key, start, end):
+        return self.data.get(key, b"")[start:end + 1]
+
+    def rpush(self, key, value):
+        self.lists.setdefault(key, []).append(bytes(value))
+
+    def lrange(self, key, start, end):
+        values = self.lists.get(key, [])
+        return values[start:] if end == -1 else values[start:end + 1]
+
+    def expire(self, key, seconds):
+        if key in self.data or key in self.lists:
+            self.ttls[key] = seconds
+
+    def delete(self, key):
+        self.data.pop(key, None)
+        self.lists.pop(key, None)
+        self.ttls.pop(key, None)
+
+    def scan_iter(self, match):
+        return [key.encode() for key in self.data if fnmatch.fnmatchcase(key, match)]
+
+@pytest.fixture(params=["sqlite", "redis"])
+def make_state(request, tmp_path):
+    """Factory for backends that share data, like separate worker processes would"""
+    if request.param == "sqlite":
+        return lambda: SQLiteState(tmp_path)
+    client = FakeRedis()
+    return lambda: RedisState(ttl=3600, client=client)
+
+def make_record(store, image_id, count=2):
+    return store.put(image_id, 300, 200, [
+        {"id": str(i), "segmentation": make_disk(cx=60 + 40 * i), "predicted_iou": 0.5 + i / 10}
+        for i in range(count)
+    ])
+
+class TestBackends:
+    def test_blob_round_trip(self, make_state):
+        state = make_state()
+        stamp = new_stamp()
+        state.save("a", b"blob", stamp, time.time())
+        assert state.load("a") == (b"blob", stamp)
+        assert state.stamp("a") == stamp
+        assert state.keys() == ["a"]
+        state.delete("a")
+        assert state.load("a") is None and state.stamp("a") is None
+
+    def test_sqlite_expiry_by_access_time(self, tmp_path):
+        state = SQLiteState(tmp_path)
+        state.save("old", b"x", new_stamp(), 100.0)
+        state.save("new", b"y", new_stamp(), 100.0)
+        state.touch("new", 200.0)
+        assert state.expired(150.0) == ["old"]
+
+    def test_redis_keys_carry_ttl(self):
+        client = FakeRedis()
+        state = RedisState(ttl=60, client=client)
+        state.save("a", b"blob", new_stamp(), time.time())
+        assert client.ttls["sam2:record:a"] == 60
+
+    def test_create_state(self, tmp_path):
+        assert create_state("memory", tmp_path) is None
+        assert isinstance(create_state("sqlite", tmp_path), SQLiteState)
+        with pytest.raises(ValueError):
+            create_state("etcd", tmp_path)
+
+class TestValues:
+    def test_value_round_trip(self, make_state):
+        writer, reader = make_state(), make_state()
+        writer.set_value("k", b"v")
+        assert reader.get_value("k") == b"v"
+        writer.set_value("k", b"w")
+        assert reader.get_value("k") == b"w"
+        reader.delete_value("k")
+        assert writer.get_value("k") is None
+
+    def test_list_appends_in_order(self, make_state):
+        writer, reader = make_state(), make_state()
+        for value in (b"a", b"b", b"c"):
+            writer.append_value("l", value, ttl=60)
+        assert reader.list_values("l") == [b"a", b"b", b"c"]
+        assert reader.list_values("l", start=2) == [b"c"]
+        writer.delete_value("l")
+        assert reader.list_values("l") == []
+
+    def test_sqlite_values_expire(self, tmp_path):
+        state = SQLiteState(tmp_path)
+        state.set_value("short", b"x", ttl=10)
+        state.append_value("items", b"y", ttl=10)
+        state.set_value("forever", b"z")
+        assert state.get_value("short") == b"x"
+        assert state.purge_values(now=time.time() + 20) == 2
+        assert state.get_value("short") is None and state.list_values("items") == []
+        assert state.get_value("forever") == b"z"
+
+    def test_redis_values_carry_ttl(self):
+        client = FakeRedis()
+        state = RedisState(client=client)
+        state.set_value("k", b"v", ttl=0.5)
+        state.append_value("l", b"v", ttl=90)
+        assert client.ttls["sam2:value:k"] == 1
+        assert client.ttls["sam2:value:l"] == 90
+
+    def test_shared_values(self, make_state):
+        first = SharedValues(make_state(), "ns:")
+        second = SharedValues(make_state(), "ns:")
+        first["a"] = "1"
+        assert second["a"] == "1" and "a" in second and "b" not in second
+        assert second.pop("a") == "1"
+        assert first.get("a") is None
+        with pytest.raises(KeyError):
+            first["a"]
+
+    def test_local_values(self):
+        values = SharedValues()
+        values["a"] = "1"
+        assert values.get("a") == "1" and "a" in values
+        assert values.pop("a") == "1" and values.pop("a") is None
+
+class TestRecordBlob:
+    def test_round_trip(self):
+        record = make_record(MaskStore(), "img", count=3)
+        record.working_width, record.working_height = 150, 100
+        blob = encode_record(record)
+        # Packed bits plus a small header
+        assert len(blob) < record.nbytes + 1024
+        decoded = decode_record("img", blob)
+        assert (decoded.width, decoded.height, decoded.working_width, decoded.working_height) == (300, 200, 150, 100)
+        for mask in record.masks:
+            copy = decoded.get(mask.id)
+            assert copy.bbox == mask.bbox and copy.meta == mask.meta
+            assert np.array_equal(copy.to_array(), mask.to_array())
+
+class TestSharedStore:
+    def test_record_visible_to_other_workers(self, make_state):
+        """A record added by one worker is served by another"""
+        first, second = MaskStore(state=make_state()), MaskStore(state=make_state())
+        record = make_record(first, "img")
+        assert "img" in second
+        assert np.array_equal(second["img"].get("1").to_array(), record.get("1").to_array())
+        assert list(second) == ["img"]
+
+    def test_replaced_record_not_served_stale(self, make_state):
+        first, second = MaskStore(state=make_state()), MaskStore(state=make_state())
+        make_record(first, "img", count=2)
+        assert len(second["img"].masks) == 2
+        make_record(first, "img", count=1)
+        assert len(second["img"].masks) == 1
+
+    def test_recheck_window_skips_stamp_reads(self, make_state, monkeypatch):
+        first, second = MaskStore(state=make_state()), MaskStore(state=make_state(), recheck=60)
+        make_record(first, "img", count=2)
+        assert len(second["img"].masks) == 2
+        make_record(first, "img", count=1)
+        # Within the window the copy in memory is served without asking the backend
+        assert len(second["img"].masks) == 2
+        later = time.time() + 61
+        monkeypatch.setattr(time, "time", lambda: later)
+        assert len(second["img"].masks) == 1
+
+    def test_removed_record_gone_everywhere(self, make_state):
+        first, second = MaskStore(state=make_state()), MaskStore(state=make_state())
+        make_record(first, "img")
+        assert second.get("img") is not None
+        first.pop("img")
+        assert "img" not in second
+        assert second.nbytes == 0
+
+    def test_eviction_keeps_shared_copy(self, make_state):
+        probe = make_record(MaskStore(), "probe")
+        store = MaskStore(max_bytes=probe.nbytes, state=make_state())
+        make_record(store, "a")
+        make_record(store, "b")
+        assert store.stats()["records"] == 1
+        assert store.get("a") is not None
+        assert store.stats()["reloads"] == 1
+
+    def test_expiry_follows_shared_access_time(self, tmp_path):
+        first, second = MaskStore(ttl=60, state=SQLiteState(tmp_path)), MaskStore(ttl=60, state=SQLiteState(tmp_path))
+        make_record(first, "img")
+        second.get("img")
+        # Idle in both processes: removed from the backend once
+        assert first.expire(now=time.time() + 120) == ["img"]
+        assert second.get("img") is None
+
+class TestHashRing:
+    def test_keys_spread_and_stay_put(self):
+        nodes = ["api-0", "api-1", "api-2"]
+        ring = HashRing(nodes)
+        keys = [f"image-{i}" for i in range(3000)]
+        owners = {key: ring.node_for(key) for key in keys}
+        counts = [list(owners.values()).count(node) for node in nodes]
+        assert min(counts) > 600
+        # Adding a node only moves keys onto it
+        grown = HashRing(nodes + ["api-3"])
+        moved = [key for key in keys if grown.node_for(key) != owners[key]]
+        assert all(grown.node_for(key) == "api-3" for key in moved)
+        assert len(moved) < len(keys) / 2
+
+    def test_empty_ring(self):
+        assert HashRing([]).node_for("image") is None
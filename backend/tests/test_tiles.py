@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from mask_store import StoredMask
+from resampling import upsample_mask
+from tiles import intersects, mask_tile, parse_region, tile_size
+
+def make_mask(height=40, width=60):
+    mask = np.zeros((height, width), dtype=bool)
+    mask[10:30, 15:45] = True
+    mask[12:18, 20:25] = False
+    return StoredMask.from_array("m", mask), mask
+
+class TestParseRegion:
+    def test_default_is_whole_image(self):
+        assert parse_region(None, 60, 40) == (0, 0, 60, 40)
+
+    def test_clipped_to_image(self):
+        assert parse_region("-5,30,100,100", 60, 40) == (0, 30, 60, 10)
+
+    @pytest.mark.parametrize("region", ["1,2,3", "a,b,c,d", "0,0,0,5", "70,0,10,10"])
+    def test_invalid(self, region):
+        with pytest.raises(ValueError):
+            parse_region(region, 60, 40)
+
+class TestMaskTile:
+    def test_full_scale_region_matches_mask(self):
+        stored, mask = make_mask()
+        tile = mask_tile(stored, (1, 1), (5, 8, 30, 20), 1.0)
+        assert np.array_equal(tile, mask[8:28, 5:35])
+
+    def test_integer_downscale_is_strided(self):
+        stored, mask = make_mask()
+        tile = mask_tile(stored, (1, 1), (0, 0, 60, 40), 0.5)
+        assert tile.shape == (20, 30)
+        assert np.array_equal(tile, mask[1::2, 1::2])
+
+    def test_fractional_scale(self):
+        stored, mask = make_mask()
+        tile = mask_tile(stored, (1, 1), (0, 0, 60, 40), 0.3)
+        assert tile.shape == tile_size((0, 0, 60, 40), 0.3)[::-1]
+        rows = np.floor((np.arange(12) + 0.5) * 40 / 12).astype(int)
+        cols = np.floor((np.arange(18) + 0.5) * 60 / 18).astype(int)
+        assert np.array_equal(tile, mask[np.ix_(rows, cols)])
+
+    def test_working_resolution_mask(self):
+        """Tiles of downscaled masks are in original coordinates"""
+        stored, mask = make_mask()
+        tile = mask_tile(stored, (2, 2), (20, 20, 80, 60), 1.0)
+        full = upsample_mask(stored.crop(), stored.bbox, 2, 2, 120, 80)
+        assert np.array_equal(tile, full[20:80, 20:100])
+
+    def test_region_outside_mask_is_empty(self):
+        stored, _ = make_mask()
+        assert not mask_tile(stored, (1, 1), (50, 0, 10, 10), 1.0).any()
+
+def test_intersects():
+    assert intersects([10, 10, 5, 5], (12, 12, 10, 10))
+    assert not intersects([10, 10, 5, 5], (15, 0, 10, 10))
+    assert not intersects([0, 0, 0, 0], (0, 0, 10, 10))
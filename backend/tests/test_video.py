@@ -0,0 +1,265 @@
+import asyncio
+import io
+import json
+import threading
+import time
+import zipfile
+
+import httpx
+import numpy as np
+import pytest
+from PIL import Image
+
+import main
+import video
+from backends import MockBackend
+from workers import WorkerPool
+from video import MaskWriter, Prefetcher, iter_frames, probe_video, sniff_video, track_video
+
+def textured(width=300, height=220, seed=0):
+    rng = np.random.default_rng(seed)
+    noise = Image.fromarray((rng.random((height // 10, width // 10, 3)) * 255).astype(np.uint8))
+    return np.asarray(noise.resize((width, height), Image.BICUBIC))
+
+def panning_frames(count=5, step=4):
+    """Frames of a camera panning left, so the scene moves ``step`` pixels right per frame"""
+    scene = textured(240 + step * count, 200)
+    left = step * (count - 1)
+    return [scene[20:180, left - step * i:left - step * i + 240] for i in range(count)]
+
+def frame_zip(path, frames):
+    with zipfile.ZipFile(path, "w") as archive:
+        # Out of order on purpose: frames are read in natural name order
+        for index in reversed(range(len(frames))):
+            data = io.BytesIO()
+            Image.fromarray(frames[index]).save(data, format="PNG")
+            archive.writestr(f"frames/frame{index}.png", data.getvalue())
+    return path
+
+class TestSniff:
+    def test_containers(self, tmp_path):
+        assert sniff_video(b"\x00\x00\x00\x18ftypmp42") == "mp4"
+        assert sniff_video(b"\x1a\x45\xdf\xa3\x01") == "mkv"
+        assert sniff_video(b"RIFF\x00\x00\x00\x00AVI LIST") == "avi"
+        assert sniff_video(frame_zip(tmp_path / "f.zip", panning_frames(1)).read_bytes()[:16]) == "zip"
+        assert sniff_video(b"GIF89a") == "gif"
+        assert sniff_video(b"\xff\xd8\xff\xe0") is None
+
+class TestFrames:
+    def test_zip_in_natural_order(self, tmp_path):
+        frames = panning_frames(12)
+        path = frame_zip(tmp_path / "frames.zip", frames)
+        assert probe_video(path) == {"frames": 12, "width": 240, "height": 160, "fps": None}
+        decoded = list(iter_frames(path, start=9))
+        assert len(decoded) == 3
+        assert np.array_equal(decoded[0], frames[9])
+
+    def test_animated_gif_at_working_size(self, tmp_path):
+        frames = [Image.fromarray(frame) for frame in panning_frames(4)]
+        path = tmp_path / "clip.gif"
+        frames[0].save(path, save_all=True, append_images=frames[1:], duration=100)
+        assert probe_video(path)["frames"] == 4
+        assert probe_video(path)["fps"] == 10
+        decoded = list(iter_frames(path, max_side=120, start=1, stop=3))
+        assert [frame.shape for frame in decoded] == [(80, 120, 3)] * 2
+
+    def test_video_file(self, tmp_path):
+        if not video.CV2_AVAILABLE:
+            pytest.skip("OpenCV not installed")
+        cv2 = video.cv2
+        path = tmp_path / "clip.avi"
+        writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"MJPG"), 10, (240, 160))
+        if not writer.isOpened():
+            pytest.skip("No MJPG encoder")
+        for frame in panning_frames(6):
+            writer.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+        writer.release()
+        assert sniff_video(path.read_bytes()[:16]) == "avi"
+        info = probe_video(path)
+        assert (info["frames"], info["width"], info["height"]) == (6, 240, 160)
+        assert len(list(iter_frames(path, max_side=120, start=2))) == 4
+
+class TestPrefetcher:
+    def test_bounded(self):
+        produced = []
+
+        def source():
+            for index in range(100):
+                produced.append(index)
+                yield index
+
+        with Prefetcher(source(), depth=3) as items:
+            assert next(items) == 0
+            time.sleep(0.05)
+            # One handed over, three queued and one waiting to be queued
+            assert len(produced) <= 5
+            assert list(items) == list(range(1, 100))
+
+    def test_errors_reach_consumer(self):
+        def source():
+            yield 1
+            raise ValueError("broken frame")
+
+        with Prefetcher(source(), depth=2) as items:
+            assert next(items) == 1
+            with pytest.raises(ValueError, match="broken frame"):
+                next(items)
+
+    def test_close_stops_and_closes_source(self):
+        closed = threading.Event()
+
+        def source():
+            try:
+                while True:
+                    yield 0
+            finally:
+                closed.set()
+
+        items = Prefetcher(source(), depth=2)
+        next(items)
+        items.close()
+        assert closed.wait(1)
+        assert list(items) == []
+
+class TestTracking:
+    def test_mask_follows_pan(self, tmp_path):
+        path = frame_zip(tmp_path / "frames.zip", panning_frames(6))
+        tracked = list(track_video(MockBackend(), path, 1, [[100, 80]], [1], max_frames=4, prefetch=2))
+        assert [index for index, _ in tracked] == [1, 2, 3, 4]
+        centroids = [np.nonzero(mask)[1].mean() for _, mask in tracked]
+        assert np.allclose(np.diff(centroids), 4, atol=1)
+
+    def test_missing_prompt_frame(self, tmp_path):
+        path = frame_zip(tmp_path / "frames.zip", panning_frames(2))
+        with pytest.raises(ValueError):
+            list(track_video(MockBackend(), path, 5, [[10, 10]], [1]))
+
+    def test_writer_flushes_each_frame(self, tmp_path):
+        with MaskWriter(tmp_path / "masks.ndjson") as writer:
+            writer.write({"frame": 0})
+            assert (tmp_path / "masks.ndjson").read_text() == '{"frame":0}\n'
+            writer.write({"frame": 1})
+        lines = (tmp_path / "masks.ndjson").read_text().splitlines()
+        assert [json.loads(line)["frame"] for line in lines] == [0, 1]
+
+class TestVideoEndpoints:
+    @pytest.fixture(autouse=True)
+    def uploads(self, monkeypatch, tmp_path):
+        monkeypatch.setattr(main, "UPLOADS_DIR", tmp_path)
+
+    def run(self, data, prompt):
+        async def run():
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                uploaded = await client.post("/upload-video", files={"file": ("clip.zip", data, "application/zip")})
+                video_id = uploaded.json()["video_id"]
+                started = await client.post(f"/videos/{video_id}/propagate", json=prompt)
+                if started.status_code != 202:
+                    return uploaded, started, None, None, None
+                job_id = started.json()["job_id"]
+                # The event stream ends when the job does
+                events = await client.get(f"/jobs/{job_id}/events")
+                status = await client.get(f"/jobs/{job_id}")
+                masks = await client.get(started.json()["masks_url"])
+                return uploaded, started, events, status, masks
+        return asyncio.run(run())
+
+    def test_propagate_frame_sequence(self, tmp_path):
+        data = frame_zip(tmp_path / "frames.zip", panning_frames(5)).read_bytes()
+        uploaded, started, events, status, masks = self.run(data, {
+            "frame_index": 1, "points": [{"x": 100, "y": 80}], "labels": [1]
+        })
+        assert uploaded.json()["frame_count"] == 5
+        assert (uploaded.json()["width"], uploaded.json()["height"]) == (240, 160)
+        assert started.status_code == 202
+        assert "event: done" in events.text
+
+        summary = status.json()
+        assert summary["status"] == "completed"
+        assert summary["progress"] == {"masks_ready": 4, "total": 4}
+        assert [mask["frame"] for mask in summary["masks"]] == [1, 2, 3, 4]
+
+        lines = [json.loads(line) for line in masks.text.splitlines()]
+        assert masks.headers["content-type"] == "application/x-ndjson"
+        assert [line["frame"] for line in lines] == [1, 2, 3, 4]
+        assert lines[0]["segmentation"]["size"] == [160, 240]
+        # The scene pans right by 4 pixels a frame and the mask goes with it
+        xs = [line["centroid"][0] for line in lines]
+        assert np.allclose(np.diff(xs), 4, atol=1)
+
+    def test_jobs_run_on_video_pool(self, tmp_path, monkeypatch):
+        """A running propagation holds a video worker, not a stage worker; extra jobs get 503"""
+        monkeypatch.setattr(main, "video_pool", WorkerPool(max_workers=1, max_queue=0))
+        release = threading.Event()
+        monkeypatch.setattr(main, "track_video_job", lambda *args: release.wait(5))
+        data = frame_zip(tmp_path / "frames.zip", panning_frames(2)).read_bytes()
+        prompt = {"frame_index": 0, "points": [{"x": 1, "y": 1}], "labels": [1]}
+
+        async def run():
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                uploaded = await client.post("/upload-video", files={"file": ("clip.zip", data, "application/zip")})
+                url = f"/videos/{uploaded.json()['video_id']}/propagate"
+                started = await client.post(url, json=prompt)
+                while main.video_pool.stats()["pending"] == 0:
+                    await asyncio.sleep(0.01)
+                stage_workers = main.worker_pool.stats()["pending"]
+                rejected = await client.post(url, json=prompt)
+                release.set()
+                events = await client.get(f"/jobs/{started.json()['job_id']}/events")
+                return started, stage_workers, rejected, events
+
+        started, stage_workers, rejected, events = asyncio.run(run())
+        assert started.status_code == 202
+        assert stage_workers == 0
+        assert rejected.status_code == 503 and "retry-after" in rejected.headers
+        assert "event: done" in events.text
+
+    def test_propagation_leaves_stage_workers_free(self, tmp_path, monkeypatch):
+        """Segmentation and clicks on a single stage worker are served while a propagation runs"""
+        monkeypatch.setattr(main, "worker_pool", WorkerPool(max_workers=1))
+        entered, release = threading.Event(), threading.Event()
+        monkeypatch.setattr(main, "track_video_job", lambda *args: entered.set() or release.wait(10))
+        data = frame_zip(tmp_path / "frames.zip", panning_frames(2)).read_bytes()
+        image = io.BytesIO()
+        Image.fromarray(textured()).save(image, format="JPEG")
+
+        async def run():
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                uploaded = await client.post("/upload-video", files={"file": ("clip.zip", data, "application/zip")})
+                started = await client.post(f"/videos/{uploaded.json()['video_id']}/propagate", json={
+                    "frame_index": 0, "points": [{"x": 1, "y": 1}], "labels": [1]
+                })
+                while not entered.is_set():
+                    await asyncio.sleep(0.01)
+                try:
+                    uploaded = await asyncio.wait_for(client.post(
+                        "/upload-image", files={"file": ("facade.jpg", image.getvalue(), "image/jpeg")}
+                    ), 5)
+                    image_id = uploaded.json()["image_id"]
+                    generated = await asyncio.wait_for(client.post("/generate-masks", json={"image_id": image_id}), 5)
+                    clicked = await asyncio.wait_for(client.post("/get-mask", json={
+                        "image_id": image_id, "points": [{"x": 100, "y": 80}], "labels": [1]
+                    }), 5)
+                    still_running = not main.job_manager.get(started.json()["job_id"]).finished
+                finally:
+                    release.set()
+                return generated, clicked, still_running
+
+        generated, clicked, still_running = asyncio.run(run())
+        assert generated.status_code == 200 and clicked.status_code == 200
+        assert still_running
+
+    def test_frame_out_of_range(self, tmp_path):
+        data = frame_zip(tmp_path / "frames.zip", panning_frames(2)).read_bytes()
+        _, started, *_ = self.run(data, {"frame_index": 2, "points": [{"x": 1, "y": 1}], "labels": [1]})
+        assert started.status_code == 400
+
+    def test_rejects_non_video(self):
+        async def run():
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                return await client.post("/upload-video", files={"file": ("clip.mp4", b"not a video", "video/mp4")})
+        assert asyncio.run(run()).status_code == 400
+        assert list(main.UPLOADS_DIR.iterdir()) == []
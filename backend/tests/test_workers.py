@@ -0,0 +1,107 @@
+import asyncio
+import io
+import threading
+import httpx
+import numpy as np
+import pytest
+from PIL import Image
+import main
+from main import app
+from workers import WorkerPool, PoolOverloaded
+
+def make_jpeg(width, height):
+    """Create a noisy JPEG so decoding does real work"""
+    rng = np.random.default_rng(0)
+    img = Image.fromarray(rng.integers(0, 255, (height, width, 3), dtype=np.uint8))
+    img_bytes = io.BytesIO()
+    img.save(img_bytes, format='JPEG')
+    return img_bytes.getvalue()
+
+class TestWorkerPool:
+    def test_runs_off_the_event_loop(self):
+        """Stages run on worker threads, not the event loop thread"""
+        pool = WorkerPool(max_workers=2)
+
+        async def run():
+            return await pool.run(threading.get_ident), threading.get_ident()
+
+        worker_thread, loop_thread = asyncio.run(run())
+        assert worker_thread != loop_thread
+        pool.shutdown()
+
+    def test_rejects_when_full(self):
+        """Submissions beyond workers plus queue depth are rejected"""
+        pool = WorkerPool(max_workers=1, max_queue=1)
+        release = threading.Event()
+
+        async def run():
+            first = asyncio.ensure_future(pool.run(release.wait, 5))
+            second = asyncio.ensure_future(pool.run(release.wait, 5))
+            await asyncio.sleep(0.01)
+            with pytest.raises(PoolOverloaded):
+                await pool.run(release.wait, 5)
+            release.set()
+            await asyncio.gather(first, second)
+
+        asyncio.run(run())
+        assert pool.stats()["rejected"] == 1
+        pool.shutdown()
+
+class TestBackpressure:
+    def test_overload_returns_503(self, monkeypatch):
+        """Requests beyond pool capacity get 503 with Retry-After"""
+        pool = WorkerPool(max_workers=1, max_queue=0)
+        monkeypatch.setattr(main, "worker_pool", pool)
+        release = threading.Event()
+        monkeypatch.setattr(main, "segment_image", lambda *args: release.wait(5) and None)
+
+        async def run():
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+                files = {"file": ("test_image.jpg", make_jpeg(64, 64), "image/jpeg")}
+                image_id = (await client.post("/upload-image", files=files)).json()["image_id"]
+                blocked = asyncio.ensure_future(client.post("/generate-masks", json={"image_id": image_id}))
+                await asyncio.sleep(0.05)
+                rejected = await client.post("/generate-masks", json={"image_id": image_id})
+                release.set()
+                await asyncio.gather(blocked, return_exceptions=True)
+                return rejected
+
+        rejected = asyncio.run(run())
+        pool.shutdown()
+        assert rejected.status_code == 503
+        assert rejected.headers["retry-after"] == "1"
+
+class TestHealthUnderLoad:
+    def test_health_answered_while_pool_saturated(self, monkeypatch):
+        """/health is served from the event loop while every worker is busy with segmentation"""
+        pool = WorkerPool(max_workers=1, max_queue=0)
+        monkeypatch.setattr(main, "worker_pool", pool)
+        entered, release = threading.Event(), threading.Event()
+        segment_threads = []
+
+        def segment(*args):
+            segment_threads.append(threading.get_ident())
+            entered.set()
+            release.wait(5)
+
+        monkeypatch.setattr(main, "segment_image", segment)
+
+        async def run():
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+                files = {"file": ("test_image.jpg", make_jpeg(64, 64), "image/jpeg")}
+                image_id = (await client.post("/upload-image", files=files)).json()["image_id"]
+                heavy = asyncio.ensure_future(client.post("/generate-masks", json={"image_id": image_id}))
+                while not entered.is_set():
+                    await asyncio.sleep(0.01)
+                try:
+                    health = await asyncio.wait_for(client.get("/health"), 5)
+                finally:
+                    release.set()
+                await asyncio.gather(heavy, return_exceptions=True)
+                return health, threading.get_ident()
+
+        health, loop_thread = asyncio.run(run())
+        pool.shutdown()
+        assert health.status_code == 200
+        assert health.json()["workers"]["pending"] == 1
+        assert segment_threads and segment_threads[0] != loop_thread
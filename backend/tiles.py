@@ -0,0 +1,88 @@
+"""Viewport tiles of stored masks.
+
+A tile is the part of one mask inside a region of the original image,
+resampled to ``scale`` output pixels per original pixel. Tiles are cut
+straight from the stored working-resolution bbox crop by nearest-neighbour
+sampling: a strided slice when the sample spacing is a whole number of
+working pixels, an index gather otherwise. Neither path builds the
+full-frame mask.
+"""
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from mask_store import StoredMask
+
+
+def parse_region(region: Optional[str], width: int, height: int) -> Tuple[int, int, int, int]:
+    """Parse an ``x,y,width,height`` region, clipped to the image; the whole image when omitted"""
+    if not region:
+        return 0, 0, width, height
+    try:
+        x, y, region_width, region_height = (int(value) for value in region.split(","))
+    except ValueError:
+        raise ValueError("bbox must be four integers: x,y,width,height")
+    if region_width <= 0 or region_height <= 0:
+        raise ValueError("bbox width and height must be positive")
+    x0, y0 = max(0, x), max(0, y)
+    x1, y1 = min(width, x + region_width), min(height, y + region_height)
+    if x1 <= x0 or y1 <= y0:
+        raise ValueError("bbox is outside the image")
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def tile_size(region: Tuple[int, int, int, int], scale: float) -> Tuple[int, int]:
+    """Output (width, height) of a region at ``scale``"""
+    _, _, width, height = region
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _sample_indices(start: int, length: int, count: int, working_scale: float) -> np.ndarray:
+    """Working pixel under the centre of each of ``count`` output pixels spanning ``length`` original pixels"""
+    centres = start + (np.arange(count) + 0.5) * (length / count)
+    return np.floor(centres / working_scale).astype(np.int64)
+
+
+def _take(crop: np.ndarray, indices: np.ndarray, axis: int) -> np.ndarray:
+    """Select ``indices`` along ``axis``, as a strided view when they are evenly spaced"""
+    if indices.size > 1:
+        steps = np.diff(indices)
+        if steps[0] > 0 and np.all(steps == steps[0]):
+            view = slice(int(indices[0]), int(indices[-1]) + 1, int(steps[0]))
+            return crop[view] if axis == 0 else crop[:, view]
+    return np.take(crop, indices, axis=axis)
+
+
+def mask_tile(mask: StoredMask, scale_xy: Tuple[float, float], region: Tuple[int, int, int, int],
+              scale: float) -> np.ndarray:
+    """Boolean tile of ``mask`` over ``region`` (original pixels) at ``scale`` output pixels per pixel.
+
+    ``scale_xy`` is the record's original-per-working-pixel scale.
+    """
+    out_width, out_height = tile_size(region, scale)
+    tile = np.zeros((out_height, out_width), dtype=bool)
+    if not mask.area:
+        return tile
+
+    x, y, width, height = region
+    bbox_x, bbox_y, bbox_width, bbox_height = mask.bbox
+    cols = _sample_indices(x, width, out_width, scale_xy[0]) - bbox_x
+    rows = _sample_indices(y, height, out_height, scale_xy[1]) - bbox_y
+
+    # Samples are increasing, so the ones inside the mask bbox are a contiguous run
+    valid_cols = np.flatnonzero((cols >= 0) & (cols < bbox_width))
+    valid_rows = np.flatnonzero((rows >= 0) & (rows < bbox_height))
+    if valid_cols.size == 0 or valid_rows.size == 0:
+        return tile
+
+    sampled = _take(_take(mask.crop(), rows[valid_rows], 0), cols[valid_cols], 1)
+    tile[valid_rows[0]:valid_rows[-1] + 1, valid_cols[0]:valid_cols[-1] + 1] = sampled
+    return tile
+
+
+def intersects(bbox: List[int], region: Tuple[int, int, int, int]) -> bool:
+    """Whether an ``[x, y, width, height]`` bbox overlaps a region"""
+    x, y, width, height = bbox
+    region_x, region_y, region_width, region_height = region
+    return (width > 0 and height > 0 and x < region_x + region_width and region_x < x + width
+            and y < region_y + region_height and region_y < y + height)
@@ -0,0 +1,295 @@
+"""Video and frame-sequence decoding for mask propagation.
+
+A video is a video file decoded with OpenCV, a zip of frame images in
+natural name order, or a multi-frame GIF, WebP or TIFF. Frames are decoded
+one at a time at the working resolution and handed over through a bounded
+:class:`Prefetcher`, so decoding the next frames overlaps with propagating
+the current one while at most ``depth`` decoded frames are held.
+
+:func:`track_video` prompts the backend on one frame and propagates the
+mask forward through the following frames; :class:`MaskWriter` appends each
+frame's mask to an NDJSON file as soon as it is ready, so clients can read
+finished frames while the rest are still being tracked.
+"""
+import json
+import queue
+import re
+import threading
+import zipfile
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageSequence
+
+from backends import CV2_AVAILABLE, SegmentationBackend, cv2
+from batch import list_archive_images
+from image_codec import decode_image, sniff_container, to_rgb
+from metrics import stage
+from resampling import working_size
+
+# Extensions uploads are stored under; image containers hold animations
+VIDEO_EXTENSIONS = ("mp4", "mkv", "avi", "zip", "gif", "webp", "tif")
+ANIMATED_EXTENSIONS = ("gif", "webp", "tif")
+
+
+def sniff_video(header: bytes) -> Optional[str]:
+    """File extension for a video upload starting with ``header``, or None if it isn't one"""
+    if header[4:8] == b"ftyp":
+        return "mp4"  # MP4 and QuickTime
+    if header.startswith(b"\x1a\x45\xdf\xa3"):
+        return "mkv"  # Matroska and WebM
+    if header[:4] == b"RIFF" and header[8:12] == b"AVI ":
+        return "avi"
+    if header.startswith(b"PK\x03\x04"):
+        return "zip"
+    container = sniff_container(header)
+    if container in ("gif", "webp", "tiff"):
+        return "tif" if container == "tiff" else container
+    return None
+
+
+def _natural_key(name: str) -> List[Any]:
+    """Sort key putting ``frame2.png`` before ``frame10.png``"""
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r"(\d+)", name)]
+
+
+def archive_frames(path: Path, max_size: int) -> List[str]:
+    """Image members of a frame-sequence zip in playback order"""
+    return sorted(list_archive_images(path, 1 << 31, max_size), key=_natural_key)
+
+
+def probe_video(path: Path, max_frame_size: int = 64 * 1024 * 1024) -> Dict[str, Any]:
+    """Frame count, frame size and frame rate (None if unknown) of a video"""
+    path = Path(path)
+    extension = path.suffix.lstrip(".")
+    if extension == "zip":
+        names = archive_frames(path, max_frame_size)
+        if not names:
+            raise ValueError("Archive holds no frame images")
+        with zipfile.ZipFile(path) as archive, archive.open(names[0]) as first, Image.open(first) as image:
+            size = image.size
+        return {"frames": len(names), "width": size[0], "height": size[1], "fps": None}
+    if extension in ANIMATED_EXTENSIONS:
+        with Image.open(path) as image:
+            duration = image.info.get("duration")
+            return {"frames": getattr(image, "n_frames", 1), "width": image.size[0], "height": image.size[1],
+                    "fps": round(1000 / duration, 3) if duration else None}
+    if not CV2_AVAILABLE:
+        raise RuntimeError("Decoding video files requires OpenCV; upload a zip of frames instead")
+    capture = cv2.VideoCapture(str(path))
+    try:
+        if not capture.isOpened():
+            raise ValueError("Video could not be decoded")
+        width, height = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        if width <= 0 or height <= 0:
+            raise ValueError("Video could not be decoded")
+        fps = capture.get(cv2.CAP_PROP_FPS)
+        return {"frames": int(capture.get(cv2.CAP_PROP_FRAME_COUNT)), "width": width, "height": height,
+                "fps": round(fps, 3) if fps > 0 else None}
+    finally:
+        capture.release()
+
+
+def iter_frames(path: Path, max_side: int = 0, start: int = 0, stop: Optional[int] = None,
+                max_frame_size: int = 64 * 1024 * 1024) -> Iterator[np.ndarray]:
+    """Decode frames ``start`` to ``stop`` one at a time as RGB uint8 arrays at most ``max_side`` on their longest side.
+
+    Every frame is brought to the size of the first, so a sequence mixing
+    frame sizes still yields masks of one shape.
+    """
+    path = Path(path)
+    extension = path.suffix.lstrip(".")
+    size = None
+    for frame in _decode_frames(path, extension, max_side, start, stop, max_frame_size):
+        if size is None:
+            size = frame.shape[1::-1]
+        elif frame.shape[1::-1] != size:
+            frame = np.asarray(Image.fromarray(frame).resize(size, Image.BILINEAR))
+        yield frame
+
+
+def _decode_frames(path: Path, extension: str, max_side: int, start: int, stop: Optional[int],
+                   max_frame_size: int) -> Iterator[np.ndarray]:
+    if extension == "zip":
+        with zipfile.ZipFile(path) as archive:
+            for name in archive_frames(path, max_frame_size)[start:stop]:
+                with stage("decode"):
+                    frame, _ = decode_image(archive.read(name), max_side)
+                yield frame
+        return
+
+    if extension in ANIMATED_EXTENSIONS:
+        with Image.open(path) as image:
+            for index, frame in enumerate(ImageSequence.Iterator(image)):
+                if stop is not None and index >= stop:
+                    return
+                if index < start:
+                    continue
+                with stage("decode"):
+                    rgb = to_rgb(frame)
+                    size = working_size(*rgb.size, max_side)
+                    if rgb.size != size:
+                        rgb = rgb.resize(size, Image.BILINEAR)
+                    decoded = np.asarray(rgb)
+                yield decoded
+        return
+
+    if not CV2_AVAILABLE:
+        raise RuntimeError("Decoding video files requires OpenCV; upload a zip of frames instead")
+    capture = cv2.VideoCapture(str(path))
+    try:
+        index = 0
+        while stop is None or index < stop:
+            if index < start:
+                # Demux without decoding up to the prompt frame
+                if not capture.grab():
+                    return
+                index += 1
+                continue
+            with stage("decode"):
+                ok, frame = capture.read()
+                if not ok:
+                    return
+                height, width = frame.shape[:2]
+                size = working_size(width, height, max_side)
+                if size != (width, height):
+                    frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            yield frame
+            index += 1
+    finally:
+        capture.release()
+
+
+class _Failure:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+_DONE = object()
+
+
+class Prefetcher:
+    """Iterate over ``source`` in a background thread, keeping at most ``depth`` items ready.
+
+    The producer blocks once the queue is full, so a slow consumer bounds
+    memory instead of letting decoded frames pile up. Errors raised by the
+    source are re-raised by the consumer. :meth:`close` stops the producer
+    and closes the source.
+    """
+
+    def __init__(self, source: Iterable, depth: int = 4):
+        if depth < 1:
+            raise ValueError("depth must be at least 1")
+        self.depth = depth
+        self._queue: "queue.Queue" = queue.Queue(maxsize=depth)
+        self._stopped = threading.Event()
+        self._finished = False
+        self.stalls = 0  # times the consumer had to wait for the producer
+        self._thread = threading.Thread(target=self._produce, args=(iter(source),), daemon=True)
+        self._thread.start()
+
+    def _produce(self, source: Iterator) -> None:
+        try:
+            for item in source:
+                if not self._put(item):
+                    return
+            self._put(_DONE)
+        except BaseException as e:
+            self._put(_Failure(e))
+        finally:
+            close = getattr(source, "close", None)
+            if close is not None:
+                close()
+
+    def _put(self, item: Any) -> bool:
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self) -> "Prefetcher":
+        return self
+
+    def __next__(self) -> Any:
+        if self._finished:
+            raise StopIteration
+        if self._queue.empty():
+            self.stalls += 1
+        item = self._queue.get()
+        if item is _DONE:
+            self._finished = True
+            raise StopIteration
+        if isinstance(item, _Failure):
+            self._finished = True
+            raise item.error
+        return item
+
+    def close(self) -> None:
+        self._stopped.set()
+        self._finished = True
+        # Unblock a producer waiting on a full queue
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        self._thread.join(timeout=5)
+
+    def __enter__(self) -> "Prefetcher":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class MaskWriter:
+    """Append one JSON line per frame to a file, flushed as each frame is written"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._file = open(self.path, "w", encoding="utf-8")
+        self.frames = 0
+
+    def write(self, entry: Dict[str, Any]) -> None:
+        self._file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        self._file.flush()
+        self.frames += 1
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self) -> "MaskWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def track_video(backend: SegmentationBackend, path: Path, frame_index: int, points: List[List[int]],
+                labels: List[int], max_side: int = 0, max_frames: Optional[int] = None,
+                prefetch: int = 4) -> Iterator[Tuple[int, np.ndarray]]:
+    """Prompt ``backend`` on frame ``frame_index`` and yield ``(index, mask)`` for it and each later frame.
+
+    ``points`` are in working pixels. At most ``max_frames`` frames are
+    tracked, the prompt frame included.
+    """
+    stop = frame_index + max_frames if max_frames else None
+    with Prefetcher(iter_frames(path, max_side, frame_index, stop), prefetch) as frames:
+        first = next(frames, None)
+        if first is None:
+            raise ValueError(f"Video has no frame {frame_index}")
+        with stage("segment"):
+            mask = backend.predict(backend.encode(first), points, labels)["segmentation"]
+        yield frame_index, mask
+
+        def following() -> Iterator[np.ndarray]:
+            yield first
+            yield from frames
+
+        for index, mask in enumerate(backend.propagate(following(), mask), frame_index + 1):
+            yield index, mask
@@ -0,0 +1,81 @@
+"""Bounded worker pool for CPU-bound request stages.
+
+Decoding, mask generation, serialization and compositing are dispatched to a
+thread or process pool so the event loop stays free for other clients. The
+pool admits at most ``max_workers + max_queue`` stages at once; beyond that
+:class:`PoolOverloaded` is raised so the API can shed load instead of
+queueing without bound.
+"""
+import asyncio
+import functools
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+
+class PoolOverloaded(Exception):
+    """Raised when the worker pool has no room for another stage"""
+
+    def __init__(self, retry_after: int = 1):
+        super().__init__("Server is busy, retry later")
+        self.retry_after = retry_after
+
+
+class WorkerPool:
+    """Run blocking callables on an executor with a bounded admission count"""
+
+    def __init__(self, kind: str = "thread", max_workers: Optional[int] = None, max_queue: int = 32):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown worker pool kind '{kind}', expected 'thread' or 'process'")
+        self.kind = kind
+        self.max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+        self.max_queue = max(0, max_queue)
+        self.rejected = 0
+        self.completed = 0
+        self._pending = 0
+        self._executor: Optional[Executor] = None
+
+    @property
+    def capacity(self) -> int:
+        return self.max_workers + self.max_queue
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="worker")
+        return self._executor
+
+    def has_capacity(self) -> bool:
+        return self._pending < self.capacity
+
+    async def run(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """Run ``func(*args, **kwargs)`` on the pool, or raise PoolOverloaded when full"""
+        if self._pending >= self.capacity:
+            self.rejected += 1
+            raise PoolOverloaded()
+
+        self._pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(self._get_executor(), functools.partial(func, *args, **kwargs))
+            self.completed += 1
+            return result
+        finally:
+            self._pending -= 1
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "kind": self.kind,
+            "max_workers": self.max_workers,
+            "max_queue": self.max_queue,
+            "pending": self._pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
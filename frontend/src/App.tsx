@@ -19,6 +19,27 @@ interface Mask {
   stability_score: number;
 }
 
+interface RleMask {
+  size: [number, number];
+  counts: number[];
+}
+
+// Decode COCO uncompressed RLE (column-major runs, starting with a False run)
+const decodeRle = (rle: RleMask): boolean[][] => {
+  const [height, width] = rle.size;
+  const mask: boolean[][] = Array.from({ length: height }, () => new Array<boolean>(width).fill(false));
+  let offset = 0;
+  rle.counts.forEach((count, index) => {
+    if (index % 2 === 1) {
+      for (let i = offset; i < offset + count; i++) {
+        mask[i % height][Math.floor(i / height)] = true;
+      }
+    }
+    offset += count;
+  });
+  return mask;
+};
+
 interface ColorMask {
   id: string;
   mask: boolean[][];
@@ -31,6 +52,7 @@ const App: React.FC = () => {
   const [masks, setMasks] = useState<Mask[]>([]);
   const [selectedMasks, setSelectedMasks] = useState<Set<string>>(new Set());
   const [colorMasks, setColorMasks] = useState<ColorMask[]>([]);
+  const [downloadUrl, setDownloadUrl] = useState<string | null>(null);
   const [selectedColor, setSelectedColor] = useState<string>('#ff0000');
   const [showColorPicker, setShowColorPicker] = useState(false);
   const [showAllMasks, setShowAllMasks] = useState(false);
@@ -67,15 +89,17 @@ const App: React.FC = () => {
         headers: {
           'Content-Type': 'multipart/form-data',
         },
+        params: { return_image: false },  // We already have the file locally
         timeout: 30000, // 30 second timeout
       });
 
       console.log('Upload response:', response.data);
-      setImage(response.data.image_data);
+      setImage(URL.createObjectURL(file));
       setImageId(response.data.image_id);
       setMasks([]);
       setSelectedMasks(new Set());
       setColorMasks([]);
+      setDownloadUrl(null);
       showStatus('success', 'Image uploaded successfully!');
     } catch (error: any) {
       console.error('Upload error:', error);
@@ -116,19 +140,31 @@ const App: React.FC = () => {
 
     try {
       console.log('Generating masks for image:', imageId);
-      const response = await axios.post(`${API_BASE_URL}/generate-masks`, { image_id: imageId });
-      console.log('Mask generation response:', response.data);
-      
-      setMasks(response.data.masks);
-      const maskCount = response.data.masks.length;
-      console.log(`Generated ${maskCount} masks:`, response.data.masks);
+      const response = await axios.post(`${API_BASE_URL}/generate-masks`, { image_id: imageId }, {
+        params: { mask_format: 'rle', async: true }
+      });
+      console.log('Mask generation job:', response.data);
+      setMasks([]);
+
+      // Draw each mask as soon as the server streams it
+      const maskCount = await new Promise<number>((resolve, reject) => {
+        const events = new EventSource(`${API_BASE_URL}${response.data.events_url}`);
+        events.addEventListener('mask', (event) => {
+          const mask = JSON.parse((event as MessageEvent).data);
+          setMasks(previous => [...previous, { ...mask, segmentation: decodeRle(mask.segmentation) }]);
+        });
+        events.addEventListener('done', (event) => {
+          events.close();
+          resolve(JSON.parse((event as MessageEvent).data).mask_count);
+        });
+        events.addEventListener('error', (event) => {
+          events.close();
+          reject(event);
+        });
+      });
+      console.log(`Generated ${maskCount} masks`);
       
       showStatus('success', `Generated ${maskCount} masks!`);
-      
-      // If using mock masks (for demo without Modal), show a note
-      if (maskCount === 1 && response.data.masks[0].id === "0") {
-        showStatus('info', 'Demo mode: Using mock masks. Set up Modal credentials for real SAM2 inference.');
-      }
     } catch (error) {
       console.error('Mask generation error:', error);
       showStatus('error', 'Failed to generate masks');
@@ -283,11 +319,13 @@ const App: React.FC = () => {
     setStatus(null);
 
     try {
-      await axios.post(`${API_BASE_URL}/apply-colors`, {
+      const response = await axios.post(`${API_BASE_URL}/apply-colors`, {
         image_id: imageId,
         mask_ids: Array.from(selectedMasks),
         color: selectedColor
       });
+      // Content-addressed URL of this render, cacheable by the browser
+      setDownloadUrl(response.data.download_url);
 
       // Add to color masks for visualization
       const newColorMasks: ColorMask[] = Array.from(selectedMasks).map(maskId => {
@@ -319,7 +357,7 @@ const App: React.FC = () => {
     }
 
     try {
-      const response = await axios.get(`${API_BASE_URL}/download/${imageId}`, {
+      const response = await axios.get(`${API_BASE_URL}${downloadUrl ?? `/download/${imageId}`}`, {
         responseType: 'blob'
       });
 
@@ -342,6 +380,7 @@ const App: React.FC = () => {
   const clearAll = () => {
     setSelectedMasks(new Set());
     setColorMasks([]);
+    setDownloadUrl(null);
     setShowAllMasks(false);
   };
 
@@ -370,6 +409,12 @@ const App: React.FC = () => {
     const scaleX = displayRect.width / naturalWidth;
     const scaleY = displayRect.height / naturalHeight;
 
+    // Masks arrive at the server's working resolution, which may be smaller than the image
+    const maskScale = (maskArray: boolean[][]): [number, number] => [
+      maskArray.length ? displayRect.width / maskArray[0].length : scaleX,
+      maskArray.length ? displayRect.height / maskArray.length : scaleY
+    ];
+
     console.log(`Canvas size: ${canvas.width}x${canvas.height}`);
     console.log(`Scale factors: ${scaleX}, ${scaleY}`);
 
@@ -396,14 +441,15 @@ const App: React.FC = () => {
         
         console.log(`Rendering mask ${index} (${mask.id}) with color ${color}`);
         ctx.fillStyle = color;
+        const [maskScaleX, maskScaleY] = maskScale(maskArray);
         
         let pixelsRendered = 0;
         for (let y = 0; y < maskArray.length; y++) {
           for (let x = 0; x < maskArray[y].length; x++) {
             if (maskArray[y][x]) {
-              const scaledX = Math.floor(x * scaleX);
-              const scaledY = Math.floor(y * scaleY);
-              ctx.fillRect(scaledX, scaledY, Math.max(1, scaleX), Math.max(1, scaleY));
+              const scaledX = Math.floor(x * maskScaleX);
+              const scaledY = Math.floor(y * maskScaleY);
+              ctx.fillRect(scaledX, scaledY, Math.max(1, maskScaleX), Math.max(1, maskScaleY));
               pixelsRendered++;
             }
           }
@@ -422,15 +468,16 @@ const App: React.FC = () => {
           ctx.fillStyle = 'rgba(255, 255, 0, 0.8)';
           ctx.strokeStyle = 'rgba(255, 0, 0, 1)';
           ctx.lineWidth = 2;
+          const [maskScaleX, maskScaleY] = maskScale(maskArray);
           
           let pixelsRendered = 0;
           for (let y = 0; y < maskArray.length; y++) {
             for (let x = 0; x < maskArray[y].length; x++) {
               if (maskArray[y][x]) {
-                const scaledX = Math.floor(x * scaleX);
-                const scaledY = Math.floor(y * scaleY);
-                const pixelWidth = Math.max(1, scaleX);
-                const pixelHeight = Math.max(1, scaleY);
+                const scaledX = Math.floor(x * maskScaleX);
+                const scaledY = Math.floor(y * maskScaleY);
+                const pixelWidth = Math.max(1, maskScaleX);
+                const pixelHeight = Math.max(1, maskScaleY);
                 
                 ctx.fillRect(scaledX, scaledY, pixelWidth, pixelHeight);
                 // Add border every few pixels for better visibility
@@ -449,12 +496,13 @@ const App: React.FC = () => {
       colorMasks.forEach(colorMask => {
         const maskArray = colorMask.mask;
         ctx.fillStyle = colorMask.color + '80'; // Add transparency
+        const [maskScaleX, maskScaleY] = maskScale(maskArray);
         for (let y = 0; y < maskArray.length; y++) {
           for (let x = 0; x < maskArray[y].length; x++) {
             if (maskArray[y][x]) {
-              const scaledX = Math.floor(x * scaleX);
-              const scaledY = Math.floor(y * scaleY);
-              ctx.fillRect(scaledX, scaledY, Math.max(1, scaleX), Math.max(1, scaleY));
+              const scaledX = Math.floor(x * maskScaleX);
+              const scaledY = Math.floor(y * maskScaleY);
+              ctx.fillRect(scaledX, scaledY, Math.max(1, maskScaleX), Math.max(1, maskScaleY));
             }
           }
         }
@@ -634,10 +682,12 @@ const App: React.FC = () => {
                   className="btn-secondary" 
                   onClick={async () => {
                     try {
-                      const response = await axios.get(`${API_BASE_URL}/test/mock-mask`);
+                      const response = await axios.get(`${API_BASE_URL}/test/mock-mask`, {
+                        params: { mask_format: 'rle' }
+                      });
                       console.log('Test mock mask response:', response.data);
                       const testMask = response.data.mask;
-                      setMasks([testMask]);
+                      setMasks([{ ...testMask, segmentation: decodeRle(testMask.segmentation) }]);
                       showStatus('success', 'Test mock mask generated!');
                     } catch (error) {
                       console.error('Test mock mask error:', error);